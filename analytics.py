@@ -0,0 +1,149 @@
+"""
+Departmental analytics over incrementally maintained aggregates.
+
+Every signed-out case contributes a handful of counters (entity family,
+COO / double-expressor among LBCLs, limited core biopsies, qualifier,
+nTFHL TFH-marker count), bucketed by the month of original sign-out.
+CaseArchive applies the difference between a case's old and new
+contributions inside the same transaction that stores a version, so the
+dashboard only ever reads the small aggregates table and its cost does not
+grow with the number of archived cases.
+
+    python analytics.py rebuild archive.db   # one-off backfill / repair
+"""
+
+import argparse
+import collections
+import time
+
+from lnreport_core import (
+    DIAGNOSTIC_FAMILIES,
+    TFH_MARKERS,
+    double_expressor_status,
+    hans_algorithm,
+    is_large_b_cell,
+    is_tfh_entity,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS aggregates (
+    metric  TEXT NOT NULL,
+    key     TEXT NOT NULL,
+    month   TEXT NOT NULL,
+    count   INTEGER NOT NULL,
+    PRIMARY KEY (metric, key, month)
+);
+"""
+
+NO_ENTITY = "No specific entity"
+
+_ENTITY_FAMILY = {}
+for _family, _entities in DIAGNOSTIC_FAMILIES.items():
+    for _entity in _entities:
+        _ENTITY_FAMILY.setdefault(_entity, _family)
+
+
+def sign_out_month(ts):
+    return time.strftime("%Y-%m", time.localtime(ts))
+
+
+def contributions(fields):
+    """The (metric, key) counters one case adds to its sign-out month."""
+    if not fields:
+        return []
+    entity = fields.get("primary_entity") or ""
+    family = fields.get("diag_family") or _ENTITY_FAMILY.get(entity, "")
+    out = [
+        ("cases", "total"),
+        ("family", family if entity else NO_ENTITY),
+        ("entity", entity or NO_ENTITY),
+        ("qualifier", fields.get("qualifier") or "Definitive"),
+    ]
+
+    if is_large_b_cell(entity):
+        out.append(("lbcl", "total"))
+        out.append(("coo", hans_algorithm(fields.get("cd10"), fields.get("bcl6"), fields.get("mum1"))))
+        de = double_expressor_status(fields.get("myc_pct"), fields.get("bcl2_pct"))
+        out.append(("double_expressor", "yes" if de.startswith("Meets") else "not assessable" if de == "Not assessable" else "no"))
+
+    if fields.get("specimen_class") == "Lymph node" and fields.get("procedure_type") == "Needle core biopsy":
+        out.append(("core_biopsy", "total"))
+        core_length = fields.get("core_length")
+        if core_length is not None and core_length < 0.5:
+            out.append(("core_biopsy", "limited"))
+
+    if is_tfh_entity(entity):
+        out.append(("tfh_markers", str(sum(bool(fields.get(f)) for f in TFH_MARKERS))))
+    return out
+
+
+def update_aggregates(conn, old_fields, new_fields, month):
+    """
+    Apply the change from `old_fields` to `new_fields` (either may be None)
+    for a case signed out in `month`. Runs in the caller's transaction.
+    """
+    delta = collections.Counter(contributions(new_fields))
+    delta.subtract(contributions(old_fields))
+    for (metric, key), n in delta.items():
+        if n:
+            conn.execute(
+                "INSERT INTO aggregates VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (metric, key, month) DO UPDATE SET count = count + excluded.count",
+                (metric, key, month, n),
+            )
+
+
+def load_aggregates(conn):
+    """{metric: {key: {month: count}}}"""
+    out = collections.defaultdict(lambda: collections.defaultdict(dict))
+    for metric, key, month, count in conn.execute(
+        "SELECT metric, key, month, count FROM aggregates WHERE count != 0"
+    ):
+        out[metric][key][month] = count
+    return out
+
+
+def totals(aggregates, metric):
+    """{key: count} summed over all months."""
+    return {key: sum(months.values()) for key, months in aggregates.get(metric, {}).items()}
+
+
+def monthly(aggregates, metric, key):
+    return dict(sorted(aggregates.get(metric, {}).get(key, {}).items()))
+
+
+def rate(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+
+def rebuild_aggregates(archive):
+    """Recompute the aggregates table from the latest version of every case."""
+    cases = []
+    for case in archive.iter_latest():
+        created_at = archive.created_at(case.accession)
+        cases.append((case.fields, sign_out_month(created_at)))
+    with archive.transaction() as conn:
+        conn.execute("DELETE FROM aggregates")
+        for fields, month in cases:
+            update_aggregates(conn, None, fields, month)
+    return len(cases)
+
+
+def main(argv=None):
+    from archive import CaseArchive
+
+    parser = argparse.ArgumentParser(description="Maintain departmental analytics aggregates")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_rebuild = sub.add_parser("rebuild", help="recompute aggregates from the archive")
+    p_rebuild.add_argument("path")
+    args = parser.parse_args(argv)
+
+    archive = CaseArchive(args.path)
+    n = rebuild_aggregates(archive)
+    archive.close()
+    print(f"Rebuilt aggregates from {n} case(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,403 @@
+"""
+Signed-out case archive with amendment / addendum versioning.
+
+Each version of a case is stored as a delta against the previous one: the
+structured fields that changed, plus a word-level diff of each report text.
+A full snapshot is kept every SNAPSHOT_EVERY versions, so rebuilding any
+version replays at most SNAPSHOT_EVERY - 1 deltas regardless of how many
+addenda a case has accumulated. Saving a version also updates the
+departmental analytics aggregates in the same transaction (see analytics.py).
+"""
+
+import contextlib
+import dataclasses
+import difflib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import analytics
+from lnreport_core import CASE_DEFAULTS
+
+SNAPSHOT_EVERY = 8
+
+ORIGINAL = "Original sign-out"
+AMENDMENT = "Amended diagnosis"
+ADDENDUM = "Addendum"
+VERSION_KINDS = [ORIGINAL, AMENDMENT, ADDENDUM]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    accession       TEXT PRIMARY KEY,
+    latest_version  INTEGER NOT NULL,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    accession  TEXT NOT NULL,
+    version    INTEGER NOT NULL,
+    ts         REAL NOT NULL,
+    user       TEXT NOT NULL,
+    kind       TEXT NOT NULL,
+    reason     TEXT NOT NULL,
+    snapshot   INTEGER NOT NULL,
+    fields     TEXT NOT NULL,
+    texts      TEXT NOT NULL,
+    PRIMARY KEY (accession, version)
+);
+-- What the rule set generated for a version (lnreport_core.generated_record),
+-- kept out of the delta-stored fields: rule set plus output digest, and per
+-- rule its version and the values of its inputs.
+CREATE TABLE IF NOT EXISTS generated (
+    accession  TEXT NOT NULL,
+    version    INTEGER NOT NULL,
+    ruleset    TEXT NOT NULL,
+    output     TEXT NOT NULL,
+    PRIMARY KEY (accession, version)
+);
+CREATE TABLE IF NOT EXISTS rule_inputs (
+    accession     TEXT NOT NULL,
+    version       INTEGER NOT NULL,
+    rule          TEXT NOT NULL,
+    rule_version  INTEGER NOT NULL,
+    inputs        TEXT NOT NULL,
+    PRIMARY KEY (accession, version, rule)
+);
+CREATE INDEX IF NOT EXISTS rule_inputs_by_rule ON rule_inputs (rule, rule_version, inputs);
+"""
+
+# Whitespace is kept as its own token so joining tokens rebuilds the text exactly
+_TOKEN_RE = re.compile(r"\s+|[^\s]+")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class CaseVersion:
+    accession: str
+    version: int
+    ts: float
+    user: str
+    kind: str
+    reason: str
+    fields: dict
+    texts: dict
+
+
+# =========================================
+# Deltas
+# =========================================
+
+def _tokens(text):
+    return _TOKEN_RE.findall(text or "")
+
+
+def text_delta(old, new):
+    """[[i1, i2, replacement], ...] over the word tokens of `old`."""
+    a, b = _tokens(old), _tokens(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag != "equal":
+            ops.append([i1, i2, "".join(b[j1:j2])])
+    return ops
+
+
+def apply_text_delta(old, ops):
+    a = _tokens(old)
+    out = []
+    pos = 0
+    for i1, i2, replacement in ops:
+        out.extend(a[pos:i1])
+        out.append(replacement)
+        pos = i2
+    out.extend(a[pos:])
+    return "".join(out)
+
+
+def fields_delta(old, new):
+    return {
+        "set": {k: v for k, v in new.items() if k not in old or old[k] != v},
+        "unset": [k for k in old if k not in new],
+    }
+
+
+def apply_fields_delta(old, delta):
+    out = dict(old)
+    out.update(delta["set"])
+    for k in delta["unset"]:
+        out.pop(k, None)
+    return out
+
+
+# =========================================
+# Archive
+# =========================================
+
+class CaseArchive:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA + analytics.SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def latest_version(self, accession):
+        with self._lock:
+            return self._latest_version(accession)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock, self._conn:
+            yield self._conn
+
+    def created_at(self, accession):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at FROM cases WHERE accession = ?", (accession,)
+            ).fetchone()
+        if not row:
+            raise ArchiveError(f"{accession} is not in the archive.")
+        return row[0]
+
+    def load_aggregates(self):
+        with self._lock:
+            return analytics.load_aggregates(self._conn)
+
+    def _latest_version(self, accession):
+        row = self._conn.execute(
+            "SELECT latest_version FROM cases WHERE accession = ?", (accession,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def save_version(self, accession, fields, texts, user="", kind=None, reason="", generated=None):
+        """
+        Store a new version of `accession` and return it. `fields` is the
+        structured case (see lnreport_core.CASE_DEFAULTS), `texts` maps
+        section name -> report text, and `generated` is the optional
+        lnreport_core.generated_record for it. Raises ArchiveError when
+        nothing changed.
+        """
+        if not accession:
+            raise ArchiveError("An accession number is required to sign out a case.")
+        fields = json.loads(json.dumps(fields))  # normalize to what will be read back
+        with self._lock, self._conn:
+            version = self._save_version(accession, fields, dict(texts), user, kind, reason)
+            if generated:
+                self._save_generated(accession, version, generated)
+            return version
+
+    def _save_generated(self, accession, version, generated):
+        self._conn.execute(
+            "INSERT INTO generated VALUES (?, ?, ?, ?)",
+            (accession, version, generated["ruleset"], json.dumps(generated["output"], ensure_ascii=False)),
+        )
+        self._conn.executemany(
+            "INSERT INTO rule_inputs VALUES (?, ?, ?, ?, ?)",
+            [
+                (accession, version, name, rule["version"],
+                 json.dumps(rule["inputs"], ensure_ascii=False, sort_keys=True))
+                for name, rule in generated["rules"].items()
+            ],
+        )
+
+    def _save_version(self, accession, fields, texts, user, kind, reason):
+        now = time.time()
+        previous = self._latest_version(accession)
+        version = previous + 1
+        kind = kind or (ORIGINAL if version == 1 else AMENDMENT)
+        if version > 1 and kind == ORIGINAL:
+            raise ArchiveError(f"{accession} is already signed out; choose an amendment or addendum.")
+        if version > 1 and not (reason or "").strip():
+            raise ArchiveError("A reason is required for an amendment or addendum.")
+
+        prev = self._get(accession, previous) if previous else None
+        if prev is not None and prev.fields == fields and prev.texts == texts:
+            raise ArchiveError(f"No changes since version {previous}.")
+
+        if (version - 1) % SNAPSHOT_EVERY == 0:
+            snapshot, stored_fields, stored_texts = 1, fields, texts
+        else:
+            snapshot = 0
+            stored_fields = fields_delta(prev.fields, fields)
+            stored_texts = {
+                "set": {k: text_delta(prev.texts.get(k, ""), v) for k, v in texts.items()
+                        if prev.texts.get(k) != v},
+                "unset": [k for k in prev.texts if k not in texts],
+            }
+
+        self._conn.execute(
+            "INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (accession, version, now, user or "", kind, reason or "", snapshot,
+             json.dumps(stored_fields, ensure_ascii=False), json.dumps(stored_texts, ensure_ascii=False)),
+        )
+        if version == 1:
+            self._conn.execute("INSERT INTO cases VALUES (?, ?, ?, ?)", (accession, 1, now, now))
+            created_at = now
+        else:
+            self._conn.execute(
+                "UPDATE cases SET latest_version = ?, updated_at = ? WHERE accession = ?",
+                (version, now, accession),
+            )
+            created_at = self._conn.execute(
+                "SELECT created_at FROM cases WHERE accession = ?", (accession,)
+            ).fetchone()[0]
+
+        # Aggregates follow the latest version, counted in the original sign-out month
+        analytics.update_aggregates(
+            self._conn, prev.fields if prev else None, fields, analytics.sign_out_month(created_at)
+        )
+        return version
+
+    def get_version(self, accession, version=None):
+        with self._lock:
+            if version is None:
+                version = self._latest_version(accession)
+            return self._get(accession, version)
+
+    def _get(self, accession, version):
+        # Replay from the nearest snapshot at or below `version`
+        base = version - (version - 1) % SNAPSHOT_EVERY
+        rows = self._conn.execute(
+            "SELECT version, ts, user, kind, reason, snapshot, fields, texts FROM versions "
+            "WHERE accession = ? AND version BETWEEN ? AND ? ORDER BY version",
+            (accession, base, version),
+        ).fetchall()
+        if not rows or rows[-1][0] != version:
+            raise ArchiveError(f"{accession} has no version {version}.")
+
+        fields, texts = None, None
+        for _, ts, user, kind, reason, snapshot, f, t in rows:
+            f, t = json.loads(f), json.loads(t)
+            if snapshot:
+                fields, texts = f, t
+            else:
+                fields = apply_fields_delta(fields, f)
+                texts = {k: v for k, v in texts.items() if k not in t["unset"]}
+                for k, ops in t["set"].items():
+                    texts[k] = apply_text_delta(texts.get(k, ""), ops)
+        return CaseVersion(accession, version, ts, user, kind, reason, fields, texts)
+
+    def iter_updated(self, since=0.0):
+        """
+        Yield (latest CaseVersion, created_at, updated_at) for every case
+        signed out or amended after `since`, oldest update first.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT accession, created_at, updated_at FROM cases WHERE updated_at > ? ORDER BY updated_at",
+                (since,),
+            ).fetchall()
+        for accession, created_at, updated_at in rows:
+            yield self.get_version(accession), created_at, updated_at
+
+    def history(self, accession):
+        """[(version, ts, user, kind, reason), ...] oldest first, without reconstructing."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT version, ts, user, kind, reason FROM versions WHERE accession = ? ORDER BY version",
+                (accession,),
+            ).fetchall()
+
+    def get_generated(self, accession, version):
+        """(ruleset, output digest) recorded for a version, or None if it has none."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT ruleset, output FROM generated WHERE accession = ? AND version = ?",
+                (accession, version),
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def rule_input_groups(self, rule, exclude_version=None):
+        """
+        {inputs JSON: [(accession, version), ...]} over the latest version of
+        every case that recorded `rule`, optionally skipping those generated
+        under `exclude_version`. Cases sharing input values share a group.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.inputs, r.accession, r.version FROM rule_inputs r "
+                "JOIN cases c ON c.accession = r.accession AND c.latest_version = r.version "
+                "WHERE r.rule = ? AND r.rule_version IS NOT ?",
+                (rule, exclude_version),
+            ).fetchall()
+        groups = {}
+        for inputs, accession, version in rows:
+            groups.setdefault(inputs, []).append((accession, version))
+        return groups
+
+    def cases_without_rule(self, rule):
+        """
+        [(accession, version)] over the latest version of every case that has
+        a generated record but none for `rule`, i.e. was signed out before the
+        rule existed.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT g.accession, g.version FROM generated g "
+                "JOIN cases c ON c.accession = g.accession AND c.latest_version = g.version "
+                "WHERE NOT EXISTS (SELECT 1 FROM rule_inputs r "
+                "WHERE r.accession = g.accession AND r.version = g.version AND r.rule = ?)",
+                (rule,),
+            ).fetchall()
+
+    def count_cases(self):
+        """(cases, cases whose latest version has no generated record)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*), COUNT(*) - COUNT(g.accession) FROM cases c "
+                "LEFT JOIN generated g ON g.accession = c.accession AND g.version = c.latest_version"
+            ).fetchone()
+
+    def iter_latest(self):
+        """Yield the latest CaseVersion of every archived case."""
+        with self._lock:
+            accessions = [r[0] for r in self._conn.execute("SELECT accession FROM cases ORDER BY accession")]
+        for accession in accessions:
+            yield self.get_version(accession)
+
+
+# =========================================
+# "Changes since previous"
+# =========================================
+
+def changes_since_previous(archive, accession, version):
+    """
+    Returns (field_changes, text_diffs): field_changes is
+    [(field, old, new), ...] over the case fields in CASE_DEFAULTS (derived
+    keys such as "terminology" are left out) and text_diffs maps section ->
+    unified diff. Version 1 is compared against an empty case.
+    """
+    current = archive.get_version(accession, version)
+    if version > 1:
+        previous = archive.get_version(accession, version - 1)
+        old_fields, old_texts = previous.fields, previous.texts
+    else:
+        old_fields, old_texts = {}, {}
+
+    field_changes = [
+        (k, old_fields.get(k), current.fields.get(k))
+        for k in sorted(set(old_fields) | set(current.fields))
+        if k in CASE_DEFAULTS and old_fields.get(k) != current.fields.get(k)
+    ]
+    text_diffs = {}
+    for section in sorted(set(old_texts) | set(current.texts)):
+        old, new = old_texts.get(section, ""), current.texts.get(section, "")
+        if old != new:
+            text_diffs[section] = "\n".join(difflib.unified_diff(
+                _wrap_sentences(old), _wrap_sentences(new),
+                f"version {version - 1}", f"version {version}", lineterm="",
+            ))
+    return field_changes, text_diffs
+
+
+def _wrap_sentences(text):
+    # One sentence per line so a diff of a prose paragraph stays readable
+    return [s for s in re.split(r"(?<=[.;])\s+|\n", text or "") if s]
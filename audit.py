@@ -0,0 +1,271 @@
+"""
+Audit trail of report generation and manual edits.
+
+`AuditLog.record()` only appends to an in-memory buffer; a background
+thread drains it in batches into a local SQLite store, so logging does not
+add measurable latency to a Streamlit rerun. Records are hash-chained at
+flush time (each hash covers the previous hash and the record), which makes
+any later edit, deletion or reordering detectable with `verify_chain()`.
+
+The chain head is read inside the write transaction, so several server
+processes (or several AuditLog instances) can share one store safely.
+
+    python audit.py verify audit.db
+    python audit.py show audit.db --last 20
+"""
+
+import argparse
+import atexit
+import collections
+import difflib
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+GENESIS_HASH = "0" * 64
+BUSY_TIMEOUT_S = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit (
+    seq        INTEGER PRIMARY KEY,
+    ts         REAL NOT NULL,
+    event      TEXT NOT NULL,
+    user       TEXT NOT NULL,
+    accession  TEXT NOT NULL,
+    session    TEXT NOT NULL,
+    payload    TEXT NOT NULL,
+    prev_hash  TEXT NOT NULL,
+    hash       TEXT NOT NULL
+)
+"""
+
+# Events written by lnreport.py
+GENERATE_MICROSCOPIC = "generate_microscopic"
+GENERATE_FINAL_DIAGNOSIS = "generate_final_diagnosis"
+EDIT_MICROSCOPIC = "edit_microscopic"
+EDIT_FINAL_DIAGNOSIS = "edit_final_diagnosis"
+SIGN_OUT = "sign_out"
+
+
+class AuditError(Exception):
+    pass
+
+
+def _record_hash(prev_hash, seq, ts, event, user, accession, session, payload):
+    h = hashlib.sha256()
+    for part in (prev_hash, str(seq), repr(ts), event, user, accession, session, payload):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+class AuditLog:
+    """
+    capacity       buffered records at which `record()` also tries to flush
+                   inline (back-pressure rather than dropping). The inline
+                   attempt does not wait for a busy store, is skipped while
+                   the flusher is writing, is retried every `batch_size`
+                   records, and a failed one leaves the records buffered, so
+                   `record()` neither stalls nor raises a storage error.
+    max_buffered   hard cap on buffered records. Once the store has been
+                   unwritable for that long, `record()` and `check()` raise
+                   AuditError instead of letting the buffer grow further.
+    batch_size     buffered records that wake the flusher early
+    flush_interval seconds between flushes when the buffer is quiet
+    """
+
+    def __init__(self, path, capacity=4096, max_buffered=65536, batch_size=256, flush_interval=0.5):
+        if max_buffered < capacity:
+            raise ValueError("max_buffered must be at least capacity")
+        self.path = path
+        self.capacity = capacity
+        self.max_buffered = max_buffered
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = collections.deque()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()  # serializes flushes from this instance
+        self._closed = False
+        self._in_flight = 0  # records taken out of the buffer by the running flush
+        self.failed_flushes = 0
+        self.last_error = None
+
+        # Autocommit mode; flush() manages its own BEGIN IMMEDIATE transaction
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=BUSY_TIMEOUT_S)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+
+        self._thread = threading.Thread(target=self._run, name="audit-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, event, user, accession, session, **payload):
+        """
+        Queue one audit record. `payload` must be JSON-serializable and is not
+        copied, so callers pass freshly built values. Raises AuditError, and
+        keeps nothing, when the buffer is full (see `check()`).
+        """
+        self.check()
+        self._buffer.append((time.time(), event, user or "", accession or "", session or "", payload))
+        n = len(self._buffer)
+        if n >= self.capacity and (n - self.capacity) % self.batch_size == 0:
+            if self._write_lock.acquire(blocking=False):
+                try:
+                    self._conn.execute("PRAGMA busy_timeout = 0")
+                    self._flush_locked()
+                except sqlite3.Error:
+                    pass  # still buffered; the flusher retries
+                finally:
+                    self._conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_S * 1000}")
+                    self._write_lock.release()
+        elif n >= self.batch_size:
+            self._wake.set()
+
+    def check(self):
+        """Raise AuditError if the store has stopped accepting records."""
+        n = len(self._buffer) + self._in_flight
+        if n >= self.max_buffered:
+            raise AuditError(
+                f"The audit trail cannot be written ({n} records waiting; last error: {self.last_error}). "
+                "Actions that must be audited are refused until the store at "
+                f"{self.path} accepts writes again."
+            )
+
+    def flush(self):
+        with self._write_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        pending = []
+        while self._buffer:
+            ts, event, user, accession, session, payload = self._buffer.popleft()
+            payload_json = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+            pending.append((ts, event, user, accession, session, payload_json))
+        if not pending:
+            return
+
+        self._in_flight = len(pending)
+        began = False
+        try:
+            # Inside the try: a lock timeout here must re-buffer the records too
+            self._conn.execute("BEGIN IMMEDIATE")
+            began = True
+            row = self._conn.execute("SELECT seq, hash FROM audit ORDER BY seq DESC LIMIT 1").fetchone()
+            seq, prev_hash = row if row else (0, GENESIS_HASH)
+            rows = []
+            for ts, event, user, accession, session, payload_json in pending:
+                seq += 1
+                digest = _record_hash(prev_hash, seq, ts, event, user, accession, session, payload_json)
+                rows.append((seq, ts, event, user, accession, session, payload_json, prev_hash, digest))
+                prev_hash = digest
+            self._conn.executemany("INSERT INTO audit VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        except BaseException as exc:
+            self.failed_flushes += 1
+            self.last_error = f"{type(exc).__name__}: {exc}"
+            if began:
+                self._conn.execute("ROLLBACK")
+            # Put the records back so a later flush can retry them
+            self._buffer.extendleft(reversed([
+                (ts, event, user, accession, session, json.loads(payload_json))
+                for ts, event, user, accession, session, payload_json in pending
+            ]))
+            raise
+        finally:
+            self._in_flight = 0
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Keep the flusher alive; records stay buffered for the next attempt
+                pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._conn.close()
+
+
+# =========================================
+# Reading / verification
+# =========================================
+
+def verify_chain(path):
+    """
+    Recompute the hash chain. Returns (True, None) when intact, otherwise
+    (False, seq) for the first record that does not verify.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        prev_hash, expected_seq = GENESIS_HASH, 1
+        for seq, ts, event, user, accession, session, payload, stored_prev, stored_hash in conn.execute(
+            "SELECT seq, ts, event, user, accession, session, payload, prev_hash, hash FROM audit ORDER BY seq"
+        ):
+            if seq != expected_seq or stored_prev != prev_hash:
+                return False, seq
+            if _record_hash(prev_hash, seq, ts, event, user, accession, session, payload) != stored_hash:
+                return False, seq
+            prev_hash, expected_seq = stored_hash, seq + 1
+        return True, None
+    finally:
+        conn.close()
+
+
+def edit_diff(payload):
+    """Unified diff of a manual edit record against the generated text it replaced."""
+    return "\n".join(difflib.unified_diff(
+        (payload.get("base_text") or "").splitlines(),
+        (payload.get("text") or "").splitlines(),
+        "generated", "edited", lineterm="",
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect the report audit trail")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_verify = sub.add_parser("verify", help="check the hash chain")
+    p_verify.add_argument("path")
+    p_show = sub.add_parser("show", help="print recent records")
+    p_show.add_argument("path")
+    p_show.add_argument("--last", type=int, default=20)
+    p_show.add_argument("--accession")
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        ok, seq = verify_chain(args.path)
+        print("chain intact" if ok else f"chain broken at record {seq}")
+        return 0 if ok else 1
+
+    conn = sqlite3.connect(args.path)
+    query = "SELECT seq, ts, event, user, accession, payload FROM audit"
+    params = ()
+    if args.accession:
+        query += " WHERE accession = ?"
+        params = (args.accession,)
+    rows = conn.execute(query + " ORDER BY seq DESC LIMIT ?", params + (args.last,)).fetchall()
+    conn.close()
+    for seq, ts, event, user, accession, payload in reversed(rows):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+        print(f"#{seq} {stamp} {event} user={user or '-'} accession={accession or '-'}")
+        payload = json.loads(payload)
+        if event.startswith("edit_"):
+            print(edit_diff(payload))
+        else:
+            print(payload.get("text", ""))
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
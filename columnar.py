@@ -0,0 +1,453 @@
+"""
+Columnar, memory-mapped store of structured case fields for research queries.
+
+Layout of a store directory:
+
+    meta.json           dictionaries, segment list, ingest watermark
+    seg-000001/         one directory per ingest batch
+        accession_blob.npy, accession_offsets.npy
+                        UTF-8 accession numbers, concatenated, with row offsets
+        live.npy        packed bits; cleared when a later segment holds a newer version,
+                        by writing live-<segment>.npy and pointing meta.json at it
+        cd30.npy ...    IHC / FISH / morphology flags as packed bit arrays
+        ki67_pct.npy    percentages as uint8 (255 = not recorded)
+        primary_entity.npy ...   categorical fields as uint16 dictionary codes
+        pattern.npy ... multi-select fields as packed rows of one bit per option
+
+Every column is opened with numpy's mmap_mode="r", so a query only pages in
+the columns it touches, and group-bys run per segment with bincount rather
+than materializing rows. Free-text fields are not stored here.
+
+    python columnar.py export archive.db cases.col        # full rebuild
+    python columnar.py ingest archive.db cases.col        # cases changed since last run
+    python columnar.py count cases.col primary_entity --flag eber --flag cd30 --family "Hodgkin lymphoma"
+    python columnar.py distribution cases.col ki67_pct --by primary_entity
+
+From Python:
+
+    store = ColumnarStore("cases.col")
+    store.count_by("primary_entity", where=lambda s: s.flag("eber") & s.flag("cd30"))
+    store.distribution("ki67_pct", by="primary_entity")
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from lnreport_core import CASE_DEFAULTS
+
+FORMAT_VERSION = 2
+PCT_MISSING = 255
+COUNT_MISSING = 255
+
+PCT_COLUMNS = ["ki67_pct", "myc_pct", "bcl2_pct"]
+FLAG_COLUMNS = [k for k, v in CASE_DEFAULTS.items() if isinstance(v, bool)]
+MULTI_COLUMNS = [k for k, v in CASE_DEFAULTS.items() if isinstance(v, list)]
+CODE_COLUMNS = [
+    "specimen_class",
+    "procedure_type",
+    "integrity",
+    "nodal_arch",
+    "follicle_desc",
+    "mantle_zones",
+    "cell_size",
+    "chromatin",
+    "nucleoli",
+    "cytoplasm",
+    "sclerosis_pattern",
+    "flow_status",
+    "diag_family",
+    "primary_entity",
+    "qualifier",
+    "signed_out_month",
+]
+
+
+class ColumnarError(Exception):
+    pass
+
+
+# =========================================
+# Bit helpers
+# =========================================
+
+def _pack(bools):
+    return np.packbits(np.asarray(bools, dtype=bool), bitorder="little")
+
+
+def _unpack(packed, n):
+    return np.unpackbits(packed, count=n, bitorder="little").view(bool)
+
+
+def _pack_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    raw = blob.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+# =========================================
+# Reading
+# =========================================
+
+class Segment:
+    def __init__(self, store, name, rows, live="live"):
+        self.store = store
+        self.name = name
+        self.rows = rows
+        self.live_column = live
+        self.path = os.path.join(store.path, name)
+        self._arrays = {}
+
+    def _array(self, column):
+        if column not in self._arrays:
+            self._arrays[column] = np.load(os.path.join(self.path, column + ".npy"), mmap_mode="r")
+        return self._arrays[column]
+
+    def live(self):
+        return _unpack(self._array(self.live_column), self.rows)
+
+    def flag(self, column):
+        return _unpack(self._array(column), self.rows)
+
+    def pct(self, column):
+        """uint8 array; PCT_MISSING where not recorded."""
+        return self._array(column)
+
+    def codes(self, column):
+        return self._array(column)
+
+    def is_in(self, column, values):
+        wanted = [self.store.code_of(column, v) for v in values]
+        wanted = [c for c in wanted if c is not None]
+        return np.isin(self.codes(column), wanted)
+
+    def has(self, column, value):
+        """Multi-select `column` includes `value`."""
+        try:
+            i = self.store.meta["dictionaries"][column].index(value)
+        except ValueError:
+            return np.zeros(self.rows, dtype=bool)
+        packed = self._array(column)
+        if i // 8 >= packed.shape[1]:
+            return np.zeros(self.rows, dtype=bool)  # option first seen in a later segment
+        return (packed[:, i // 8] >> (i % 8)) & 1 == 1
+
+    def core_length(self):
+        return self._array("core_length")
+
+    def accessions(self):
+        return _unpack_strings(self._array("accession_blob"), self._array("accession_offsets"))
+
+
+class ColumnarStore:
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            raise ColumnarError(f"{path} is not a columnar case store")
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        if self.meta["format"] != FORMAT_VERSION:
+            raise ColumnarError(f"Unsupported store format {self.meta['format']}")
+        self.segments = [Segment(self, s["name"], s["rows"], s.get("live", "live"))
+                         for s in self.meta["segments"]]
+
+    def __len__(self):
+        return sum(int(seg.live().sum()) for seg in self.segments)
+
+    def dictionary(self, column):
+        return self.meta["dictionaries"][column]
+
+    def code_of(self, column, value):
+        try:
+            return self.dictionary(column).index(value or "")
+        except ValueError:
+            return None
+
+    def _selected(self, seg, where):
+        mask = seg.live()
+        if where is not None:
+            mask = mask & where(seg)
+        return mask
+
+    def count(self, where=None):
+        return sum(int(self._selected(seg, where).sum()) for seg in self.segments)
+
+    def count_by(self, column, where=None):
+        """{value: count} of live rows matching `where` (a Segment -> bool array callable)."""
+        dictionary = self.dictionary(column)
+        counts = np.zeros(len(dictionary), dtype=np.int64)
+        for seg in self.segments:
+            codes = seg.codes(column)[self._selected(seg, where)]
+            counts += np.bincount(codes, minlength=len(dictionary))[:len(dictionary)]
+        return {dictionary[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def distribution(self, pct_column, by, where=None, percentiles=(10, 25, 50, 75, 90)):
+        """
+        Per-group summary of a percentage column. Works on a (groups x 101)
+        histogram, so memory does not depend on the number of rows.
+        """
+        dictionary = self.dictionary(by)
+        hist = np.zeros((len(dictionary), 101), dtype=np.int64)
+        for seg in self.segments:
+            values = seg.pct(pct_column)
+            mask = self._selected(seg, where) & (values != PCT_MISSING)
+            flat = seg.codes(by)[mask].astype(np.int64) * 101 + values[mask]
+            hist += np.bincount(flat, minlength=hist.size).reshape(hist.shape)
+
+        out = {}
+        for g in np.flatnonzero(hist.sum(axis=1)):
+            row = hist[g]
+            n = int(row.sum())
+            cumulative = np.cumsum(row)
+            summary = {"n": n, "mean": float((row * np.arange(101)).sum() / n)}
+            for p in percentiles:
+                summary[f"p{p}"] = int(np.searchsorted(cumulative, n * p / 100))
+            out[dictionary[g]] = summary
+        return out
+
+
+# =========================================
+# Writing
+# =========================================
+
+def _empty_meta():
+    return {
+        "format": FORMAT_VERSION,
+        "watermark": 0.0,
+        "dictionaries": {c: [""] for c in CODE_COLUMNS} | {c: [] for c in MULTI_COLUMNS},
+        "segments": [],
+    }
+
+
+def _load_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return _empty_meta()
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _save_meta(path, meta):
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+
+def _save_array(directory, column, array):
+    tmp = os.path.join(directory, column + ".tmp.npy")
+    np.save(tmp, array)
+    os.replace(tmp, os.path.join(directory, column + ".npy"))
+
+
+class _Encoder:
+    """Append-only dictionary encoding over a meta.json dictionary list."""
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.index = {v: i for i, v in enumerate(dictionary)}
+
+    def __call__(self, value):
+        value = value or ""
+        code = self.index.get(value)
+        if code is None:
+            if len(self.dictionary) > np.iinfo(np.uint16).max:
+                raise ColumnarError("Dictionary overflow; a categorical column has more than 65535 values")
+            code = self.index[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        return code
+
+
+def append_cases(path, rows, watermark=None):
+    """
+    Append `rows` [(accession, fields, signed_out_ts), ...] as a new segment.
+    Rows for accessions already in the store supersede the older ones.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = _load_meta(path)
+    if meta["format"] != FORMAT_VERSION:
+        raise ColumnarError(f"Unsupported store format {meta['format']}; rebuild it with export")
+    if not rows:
+        if watermark is not None:
+            meta["watermark"] = watermark
+            _save_meta(path, meta)
+        return 0
+
+    # Later duplicates within the batch win as well
+    latest = {}
+    for accession, fields, ts in rows:
+        latest[accession] = (fields, ts)
+    accessions = list(latest)
+    records = [latest[a][0] for a in accessions]
+    n = len(accessions)
+    dictionaries = meta["dictionaries"]
+
+    def missing_as(column, sentinel):
+        return [sentinel if r.get(column) is None else r[column] for r in records]
+
+    columns = {}
+    columns["accession_blob"], columns["accession_offsets"] = _pack_strings(accessions)
+    columns["live"] = _pack(np.ones(n, dtype=bool))
+    for column in FLAG_COLUMNS:
+        columns[column] = _pack(np.fromiter((bool(r.get(column)) for r in records), dtype=bool, count=n))
+    for column in PCT_COLUMNS:
+        columns[column] = np.array(missing_as(column, PCT_MISSING), dtype=np.uint8)
+    core_count = np.array(missing_as("core_count", -1), dtype=np.int64)
+    columns["core_count"] = np.where(core_count < 0, COUNT_MISSING,
+                                     np.minimum(core_count, COUNT_MISSING - 1)).astype(np.uint8)
+    columns["core_length"] = np.array(missing_as("core_length", np.nan), dtype=np.float32)
+    for column in CODE_COLUMNS:
+        if column == "signed_out_month":
+            values = [time.strftime("%Y-%m", time.localtime(latest[a][1])) for a in accessions]
+        else:
+            values = [r.get(column) for r in records]
+        encode = _Encoder(dictionaries[column])
+        columns[column] = np.fromiter(map(encode, values), dtype=np.uint16, count=n)
+    for column in MULTI_COLUMNS:
+        encode = _Encoder(dictionaries[column])
+        rows_idx, cols_idx = [], []
+        for row, r in enumerate(records):
+            for v in r.get(column) or ():
+                rows_idx.append(row)
+                cols_idx.append(encode(v))
+        bits = np.zeros((n, max(len(encode.dictionary), 1)), dtype=bool)
+        bits[rows_idx, cols_idx] = True
+        columns[column] = np.packbits(bits, axis=1, bitorder="little")
+
+    # New segment first; it only becomes visible when meta.json is replaced
+    name = f"seg-{len(meta['segments']) + 1:06d}"
+    seg_dir = os.path.join(path, name)
+    os.makedirs(seg_dir, exist_ok=True)
+    for column, array in columns.items():
+        _save_array(seg_dir, column, array)
+
+    # Retire superseded rows in earlier segments. The new live bits go to a
+    # file named after this segment, and the current ones are left alone, so
+    # readers and a crash before meta.json is replaced still see the old state
+    new_keys = set(accessions)
+    replaced = []
+    for seg in meta["segments"]:
+        old_dir = os.path.join(path, seg["name"])
+        old_keys = _unpack_strings(np.load(os.path.join(old_dir, "accession_blob.npy")),
+                                   np.load(os.path.join(old_dir, "accession_offsets.npy")))
+        superseded = np.fromiter((a in new_keys for a in old_keys), dtype=bool, count=seg["rows"])
+        if superseded.any():
+            current = seg.get("live", "live")
+            live = _unpack(np.load(os.path.join(old_dir, current + ".npy")), seg["rows"]) & ~superseded
+            _save_array(old_dir, f"live-{name}", _pack(live))
+            seg["live"] = f"live-{name}"
+            replaced.append((old_dir, {current + ".npy", f"live-{name}.npy"}))
+
+    meta["segments"].append({"name": name, "rows": n})
+    if watermark is not None:
+        meta["watermark"] = watermark
+    _save_meta(path, meta)
+
+    # Keep the generation just replaced for stores opened before this ingest
+    for old_dir, keep in replaced:
+        for entry in os.listdir(old_dir):
+            if entry.startswith("live") and entry.endswith(".npy") and entry not in keep:
+                os.remove(os.path.join(old_dir, entry))
+    return n
+
+
+def ingest_archive(archive, path, batch_size=100_000):
+    """Append every case signed out or amended since the store's watermark."""
+    since = _load_meta(path)["watermark"]
+    total = 0
+    batch, watermark = [], since
+    for case, created_at, updated_at in archive.iter_updated(since):
+        batch.append((case.accession, case.fields, created_at))
+        watermark = max(watermark, updated_at)
+        if len(batch) >= batch_size:
+            total += append_cases(path, batch, watermark)
+            batch = []
+    total += append_cases(path, batch, watermark)
+    return total
+
+
+def export_archive(archive, path, batch_size=100_000):
+    """Rebuild the store from scratch."""
+    if os.path.exists(os.path.join(path, "meta.json")):
+        shutil.rmtree(path)
+    return ingest_archive(archive, path, batch_size)
+
+
+# =========================================
+# CLI
+# =========================================
+
+def _where_from_args(args):
+    def where(seg):
+        mask = np.ones(seg.rows, dtype=bool)
+        for column in args.flag or []:
+            mask &= seg.flag(column)
+        for column in args.no_flag or []:
+            mask &= ~seg.flag(column)
+        if args.family:
+            mask &= seg.is_in("diag_family", args.family)
+        if args.entity:
+            mask &= seg.is_in("primary_entity", args.entity)
+        return mask
+    return where
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Columnar case store for research queries")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for command in ("export", "ingest"):
+        p = sub.add_parser(command)
+        p.add_argument("archive")
+        p.add_argument("store")
+    p_count = sub.add_parser("count", help="count cases by a categorical column")
+    p_count.add_argument("store")
+    p_count.add_argument("column", choices=CODE_COLUMNS)
+    p_dist = sub.add_parser("distribution", help="percentage distribution by group")
+    p_dist.add_argument("store")
+    p_dist.add_argument("column", choices=PCT_COLUMNS)
+    p_dist.add_argument("--by", default="primary_entity", choices=CODE_COLUMNS)
+    for p in (p_count, p_dist):
+        p.add_argument("--flag", action="append", choices=FLAG_COLUMNS, help="require flag (repeatable)")
+        p.add_argument("--no-flag", action="append", choices=FLAG_COLUMNS, help="exclude flag (repeatable)")
+        p.add_argument("--family", action="append")
+        p.add_argument("--entity", action="append")
+    args = parser.parse_args(argv)
+
+    if args.command in ("export", "ingest"):
+        from archive import CaseArchive
+
+        archive = CaseArchive(args.archive)
+        start = time.perf_counter()
+        n = (export_archive if args.command == "export" else ingest_archive)(archive, args.store)
+        archive.close()
+        print(f"Wrote {n} case(s) in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    store = ColumnarStore(args.store)
+    start = time.perf_counter()
+    if args.command == "count":
+        result = sorted(store.count_by(args.column, _where_from_args(args)).items(), key=lambda kv: -kv[1])
+        for value, n in result:
+            print(f"{n:>10}  {value or '(blank)'}")
+    else:
+        result = store.distribution(args.column, args.by, _where_from_args(args))
+        for group, s in sorted(result.items(), key=lambda kv: -kv[1]["n"]):
+            print(f"{s['n']:>8}  mean {s['mean']:5.1f}  p50 {s['p50']:>3}  "
+                  f"p10-p90 {s['p10']:>3}-{s['p90']:<3}  {group or '(blank)'}")
+    print(f"({time.perf_counter() - start:.3f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,7 +1,78 @@
+import time
+
+# Taken before the other imports so that the first render in a cold process
+# includes them (reported through startup.record_render at the end)
+_render_started = time.perf_counter()
+
+import os
+import uuid
+
 import streamlit as st
 
+import analytics
+import startup
+from archive import (
+    ADDENDUM,
+    AMENDMENT,
+    ORIGINAL,
+    ArchiveError,
+    CaseArchive,
+    changes_since_previous,
+)
+from audit import (
+    EDIT_FINAL_DIAGNOSIS,
+    EDIT_MICROSCOPIC,
+    GENERATE_FINAL_DIAGNOSIS,
+    GENERATE_MICROSCOPIC,
+    SIGN_OUT,
+    AuditError,
+    AuditLog,
+)
+from lnreport_core import (
+    BACKGROUND_CELLS,
+    CASE_DEFAULTS,
+    CELL_SIZES,
+    CHROMATIN_OPTIONS,
+    CYTOPLASM_OPTIONS,
+    DIAGNOSTIC_FAMILIES,
+    ENTITY_OPTIONS,
+    FLOW_STATUSES,
+    FOLLICLE_TYPES,
+    GROWTH_PATTERNS,
+    INTEGRITY_OPTIONS,
+    MANTLE_ZONE_OPTIONS,
+    NODAL_ARCH_OPTIONS,
+    NUCLEAR_FEATURES,
+    NUCLEOLI_OPTIONS,
+    PROCEDURE_TYPES,
+    QUALIFIERS,
+    RULESET_VERSION,
+    SCLEROSIS_PATTERNS,
+    SKIN_DEPTH_OPTIONS,
+    SKIN_DERMIS_FEATURES,
+    SKIN_EPIDERMIS_FEATURES,
+    SKIN_OTHER_FEATURES,
+    SPECIMEN_CLASSES,
+    TFH_MARKERS,
+    build_ancillary_text,
+    build_fish_summary,
+    build_final_diagnosis,
+    build_flow_sentence,
+    build_microscopic_description,
+    build_specimen_sentence,
+    build_tfh_comment,
+    default_recommendations,
+    double_expressor_status,
+    generated_record,
+    hans_algorithm,
+    has_lbcl_addons,
+    is_tfh_entity,
+    tfh_marker_summary,
+)
+from terminology import highlight_html, tag, tag_case
+
 # =========================================
-# Utility / Constants
+# Page config
 # =========================================
 
 st.set_page_config(
@@ -9,369 +80,95 @@ st.set_page_config(
     layout="wide"
 )
 
-# ---------- WHO5-style entity lists (filtered to nodal / cutaneous lymphomas) ----------
-
-REACTIVE_ENTITIES = [
-    "Reactive follicular hyperplasia",
-    "Paracortical (interfollicular) hyperplasia",
-    "Sinus histiocytosis",
-    "Granulomatous lymphadenitis",
-    "Necrotizing lymphadenitis",
-    "Dermatopathic lymphadenitis",
-    "Castleman disease, hyaline-vascular type",
-    "Castleman disease, plasma cell type",
-    "Atypical lymphoid hyperplasia (indeterminate for lymphoma)",
-]
-
-B_CELL_NODAL = [
-    # Classic nodal / systemic B-cell neoplasms
-    "Chronic lymphocytic leukemia / Small lymphocytic lymphoma (CLL/SLL)",
-    "Follicular lymphoma, classic (WHO5)",
-    "Follicular large B-cell lymphoma",
-    "Follicular lymphoma with unusual cytologic features",
-    "Primary cutaneous follicle center lymphoma (PCFCL)",
-    "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)",
-    "Diffuse large B-cell lymphoma, EBV-positive",
-    "Primary mediastinal (thymic) large B-cell lymphoma",
-    "High-grade B-cell lymphoma (HGBL) with MYC and BCL2 and/or BCL6 rearrangements",
-    "High-grade B-cell lymphoma with 11q aberration",
-    "Burkitt lymphoma",
-    "Mantle cell lymphoma, classic",
-    "Mantle cell lymphoma, blastoid / pleomorphic",
-    "Leukemic non-nodal mantle cell lymphoma",
-    "Marginal zone lymphoma, nodal",
-    "Marginal zone lymphoma, extranodal (MALT-type)",
-    "Splenic marginal zone lymphoma",
-    "Lymphoplasmacytic lymphoma / Waldenström macroglobulinemia",
-    "Primary cutaneous diffuse large B-cell lymphoma, leg type (PCDLBCL-LT)",
-]
-
-T_NK_NODAL = [
-    # WHO5 nTFH family
-    "Nodal T-follicular helper cell lymphoma, angioimmunoblastic type (nTFHL-AI)",
-    "Nodal T-follicular helper cell lymphoma, follicular type (nTFHL-F)",
-    "Nodal T-follicular helper cell lymphoma, NOS (nTFHL-NOS)",
-    # Other mature T/NK
-    "Peripheral T-cell lymphoma, NOS",
-    "Anaplastic large cell lymphoma (ALCL), ALK-positive",
-    "Anaplastic large cell lymphoma (ALCL), ALK-negative",
-    "EBV-positive nodal T- or NK-cell lymphoma, NOS",
-    "Extranodal NK/T-cell lymphoma, nasal type",
-    "Hepatosplenic T-cell lymphoma",
-]
-
-HODGKIN = [
-    "Classical Hodgkin lymphoma, nodular sclerosis",
-    "Classical Hodgkin lymphoma, mixed cellularity",
-    "Classical Hodgkin lymphoma, lymphocyte-rich",
-    "Classical Hodgkin lymphoma, lymphocyte-depleted",
-    "Nodular lymphocyte-predominant Hodgkin lymphoma (NLPHL)",
-]
-
-CUTANEOUS_T = [
-    "Mycosis fungoides (MF)",
-    "Sézary syndrome (SS)",
-    "Primary cutaneous CD4+ small/medium T-cell lymphoproliferative disorder",
-    "Primary cutaneous acral CD8+ T-cell lymphoproliferative disorder",
-    "Primary cutaneous CD8+ aggressive epidermotropic cytotoxic T-cell lymphoma",
-    "Subcutaneous panniculitis-like T-cell lymphoma",
-    "Primary cutaneous gamma/delta T-cell lymphoma",
-    "Primary cutaneous peripheral T-cell lymphoma, NOS",
-    "Lymphomatoid papulosis (LyP), type A",
-    "Lymphomatoid papulosis (LyP), type B",
-    "Lymphomatoid papulosis (LyP), type C",
-    "Lymphomatoid papulosis (LyP), type D",
-    "Lymphomatoid papulosis (LyP), type E",
-    "Primary cutaneous anaplastic large cell lymphoma (pcALCL)",
-]
-
-CUTANEOUS_B = [
-    "Primary cutaneous follicle center lymphoma (PCFCL)",
-    "Primary cutaneous marginal zone lymphoma (PCMZL)",
-    "Primary cutaneous diffuse large B-cell lymphoma, leg type (PCDLBCL-LT)",
-]
-
-OTHER_STROMAL_HISTIOCYTIC = [
-    "Rosai-Dorfman disease",
-    "Langerhans cell histiocytosis",
-    "Follicular dendritic cell sarcoma",
-    "Fibroblastic reticular cell tumor",
-]
-
-ALL_ENTITIES = (
-    REACTIVE_ENTITIES
-    + B_CELL_NODAL
-    + T_NK_NODAL
-    + HODGKIN
-    + CUTANEOUS_T
-    + CUTANEOUS_B
-    + OTHER_STROMAL_HISTIOCYTIC
-)
+# =========================================
+# Session state initialization
+# =========================================
 
-# ---------- Helper functions ----------
-
-def hans_algorithm(cd10, bcl6, mum1):
-    """
-    Implement Hans cell-of-origin algorithm for DLBCL.
-    Inputs are True/False for positivity.
-    Returns 'GCB', 'Non-GCB', or 'Indeterminate'.
-    """
-    if cd10:
-        return "Germinal center B-cell (GCB) type"
-    if not cd10 and not bcl6:
-        return "Activated B-cell (ABC / non-GCB) type"
-    if not cd10 and bcl6 and mum1:
-        return "Activated B-cell (ABC / non-GCB) type"
-    if not cd10 and bcl6 and not mum1:
-        return "Germinal center B-cell (GCB) type"
-    return "Indeterminate by Hans algorithm"
-
-
-def tfh_marker_summary(markers_dict):
-    """
-    markers_dict: dict of {marker_name: bool}
-    Returns text and count.
-    """
-    positive = [m for m, v in markers_dict.items() if v]
-    return positive, len(positive)
-
-
-def double_expressor_status(myc_pct, bcl2_pct, myc_cutoff=40, bcl2_cutoff=50):
-    if myc_pct is None or bcl2_pct is None:
-        return "Not assessable"
-    if myc_pct >= myc_cutoff and bcl2_pct >= bcl2_cutoff:
-        return "Meets immunohistochemical criteria for MYC/BCL2 double-expressor status."
-    return "Does not meet double-expressor cutoffs."
-
-
-def build_specimen_sentence(specimen_class, procedure_type, site_text, core_count,
-                            core_length, integrity, skin_depth):
-    parts = []
-    if specimen_class == "Lymph node":
-        if procedure_type == "Needle core biopsy":
-            base = f"Needle core biopsy of {site_text} lymph node."
-            cores = []
-            if core_count:
-                cores.append(f"{core_count} cores")
-            if core_length:
-                cores.append(f"aggregate length {core_length:.1f} cm")
-            if cores:
-                base += f" The specimen consists of {', '.join(cores)}."
-            if integrity:
-                base += f" The cores are {integrity.lower()}."
-            if core_length is not None and core_length < 0.5:
-                base += " The limited tissue sampling may restrict comprehensive architectural assessment."
-            parts.append(base)
-        elif procedure_type in ["Excisional biopsy", "Incisional biopsy"]:
-            parts.append(f"{procedure_type} of {site_text} lymph node.")
-        else:
-            parts.append(f"{procedure_type} of {site_text}.")
-    elif specimen_class == "Skin":
-        base = f"{procedure_type} of skin, {site_text}."
-        if skin_depth:
-            base += " The biopsy includes: " + ", ".join(skin_depth) + "."
-        parts.append(base)
-    else:
-        parts.append(f"{procedure_type} of {site_text}.")
-    return " ".join(parts)
-
-
-def build_microscopic_description(
-    specimen_class,
-    nodal_arch,
-    pattern,
-    follicles_present,
-    follicle_desc,
-    follicles_polarized,
-    tingible_macrophages,
-    mantle_zones,
-    cell_size,
-    nuclear_features,
-    chromatin,
-    nucleoli,
-    cytoplasm,
-    background_cells,
-    sclerosis_pattern,
-    skin_epidermis,
-    skin_dermis,
-    skin_other
-):
-    sentences = []
-
-    # Architecture
-    if specimen_class == "Lymph node":
-        if nodal_arch == "Preserved":
-            s = "Sections show a lymph node with preserved overall architecture."
-        elif nodal_arch == "Partially effaced":
-            s = "Sections show partial effacement of the lymph node architecture."
-        elif nodal_arch == "Effaced":
-            s = "Sections show near-complete effacement of the lymph node architecture."
-        else:
-            s = "Sections show lymphoid tissue."
-        if pattern:
-            s += " The infiltrate is arranged in a " + " and ".join(pattern).lower() + " pattern."
-        sentences.append(s)
+if "microscopic_text" not in st.session_state:
+    st.session_state["microscopic_text"] = ""
 
-        if follicles_present:
-            follicle_sentence = "Numerous follicles are present, showing "
-            if follicle_desc:
-                follicle_sentence += follicle_desc.lower()
-            else:
-                follicle_sentence += "reactive features"
-            extras = []
-            if follicles_polarized:
-                extras.append("polarization with dark and light zones")
-            if tingible_macrophages:
-                extras.append("prominent tingible-body macrophages")
-            if mantle_zones:
-                extras.append(f"mantle zones that are {mantle_zones.lower()}")
-            if extras:
-                follicle_sentence += ", with " + ", ".join(extras)
-            follicle_sentence += "."
-            sentences.append(follicle_sentence)
-
-    # Cytology
-    if cell_size or nuclear_features or chromatin or nucleoli or cytoplasm:
-        cyto_parts = []
-        if cell_size:
-            cyto_parts.append(f"{cell_size.lower()} to intermediate-sized lymphoid cells")
-        else:
-            cyto_parts.append("lymphoid cells")
-        if nuclear_features:
-            cyto_parts.append("with " + ", ".join([nf.lower() for nf in nuclear_features]) + " nuclei")
-        if chromatin:
-            cyto_parts.append(f"and {chromatin.lower()} chromatin")
-        if nucleoli:
-            cyto_parts.append(f"and {nucleoli.lower()} nucleoli")
-        if cytoplasm:
-            cyto_parts.append(f"and {cytoplasm.lower()} cytoplasm")
-        cyto_sentence = "The infiltrate is composed predominantly of " + " ".join(cyto_parts) + "."
-        sentences.append(cyto_sentence)
-
-    # Background cells
-    if background_cells or sclerosis_pattern:
-        bg = []
-        if background_cells:
-            bg.append("a background rich in " + ", ".join([b.lower() for b in background_cells]))
-        if sclerosis_pattern:
-            bg.append(sclerosis_pattern.lower() + " fibrosis")
-        if bg:
-            sentences.append("The microenvironment shows " + " and ".join(bg) + ".")
-
-    # Skin-specific description
-    if specimen_class == "Skin":
-        if skin_epidermis or skin_dermis or skin_other:
-            skin_sentence = "In the skin biopsy, "
-            subparts = []
-            if skin_epidermis:
-                subparts.append("epidermis with " + ", ".join([e.lower() for e in skin_epidermis]))
-            if skin_dermis:
-                subparts.append("dermis with " + ", ".join([d.lower() for d in skin_dermis]))
-            if skin_other:
-                subparts.append(", ".join([o.lower() for o in skin_other]))
-            skin_sentence += "; ".join(subparts) + "."
-            sentences.append(skin_sentence)
-
-    if not sentences:
-        sentences.append("Sections show lymphoid tissue; please see immunophenotypic and molecular studies.")
-    return " ".join(sentences)
-
-
-def build_flow_sentence(flow_status):
-    if flow_status == "Polyclonal / no evidence of clonal population":
-        return "Flow cytometry shows a polytypic B-cell population without evidence of a clonal B- or aberrant T-cell population."
-    elif flow_status == "Clonal B-cell population":
-        return "Flow cytometry identifies a clonal B-cell population with light chain restriction."
-    elif flow_status == "Clonal T-cell population":
-        return "Flow cytometry identifies an aberrant T-cell population."
-    elif flow_status == "Not performed / not available":
-        return "Flow cytometry was not performed or not available for review."
-    return ""
-
-
-def build_molecular_sentence(molecular_findings):
-    if not molecular_findings:
-        return ""
-    return "Molecular studies: " + molecular_findings.strip()
-
-
-def build_final_diagnosis(
-    qualifier,
-    primary_entity,
-    site_text,
-    specimen_class,
-    procedure_type,
-    coo_text,
-    de_status,
-    fish_summary,
-    tfh_text,
-    core_length,
-    integrity,
-    recommendations,
-    comment
-):
-    lines = []
-
-    # Line 1: Diagnosis header
-    if primary_entity:
-        prefix = ""
-        if qualifier in ["Suspicious for", "Favour", "Indeterminate, cannot exclude"]:
-            prefix = qualifier + " "
-        elif qualifier == "Limited for diagnosis; see comment":
-            prefix = "Limited for diagnosis. Features are suggestive of "
-        elif qualifier == "Definitive":
-            prefix = ""
-        diagnosis_line = prefix + primary_entity
-        if site_text:
-            diagnosis_line += f", {site_text}"
-        diagnosis_line += "."
-        lines.append(diagnosis_line)
-    else:
-        lines.append("No specific lymphoma identified. See comment.")
+if "final_diagnosis_text" not in st.session_state:
+    st.session_state["final_diagnosis_text"] = ""
 
-    # Disclaimers for core biopsies
-    if specimen_class == "Lymph node" and procedure_type == "Needle core biopsy":
-        disc = "This diagnosis is rendered on a needle core biopsy. "
-        if core_length is not None and core_length < 0.5:
-            disc += "The limited tissue and fragmented cores restrict evaluation of nodal architecture; correlation with clinical, radiologic, and, if indicated, an excisional biopsy is recommended."
-        else:
-            disc += "Architectural assessment is inherently limited in core biopsies; correlation with clinical and imaging findings is advised."
-        lines.append(disc)
+if "_session_id" not in st.session_state:
+    st.session_state["_session_id"] = uuid.uuid4().hex
 
-    # DLBCL / HGBL add-ons
-    if primary_entity and "large B-cell lymphoma" in primary_entity.lower():
-        if coo_text:
-            lines.append(f"Cell-of-origin (Hans algorithm): {coo_text}.")
-        if de_status:
-            lines.append(de_status)
-        if fish_summary:
-            lines.append(fish_summary)
 
-    # nTFHL / TFH markers
-    if primary_entity and "t-follicular helper" in primary_entity.lower():
-        if tfh_text:
-            lines.append(tfh_text)
+# =========================================
+# Audit trail
+# =========================================
+
+@st.cache_resource
+def get_audit_log():
+    return AuditLog(os.environ.get("LNREPORT_AUDIT_DB", "audit.db"))
+
+
+@st.cache_resource
+def get_archive():
+    return CaseArchive(os.environ.get("LNREPORT_ARCHIVE_DB", "archive.db"))
 
-    # Recommendations
-    if recommendations:
-        lines.append("Recommendations: " + recommendations.strip())
 
-    # Comment
-    if comment:
-        lines.append("Comment: " + comment.strip())
+@st.cache_resource
+def get_similarity_index():
+    # Imported on first use: similarity pulls in numpy, which a session that
+    # never looks up similar cases should not pay for on its first render.
+    from similarity import open_index
 
-    return "\n".join(lines)
+    return open_index(get_archive(), os.environ.get("LNREPORT_SIMILARITY_INDEX", "similarity.npz"))
+
+
+def current_case_inputs():
+    """Structured inputs collected so far in this rerun (see CASE_DEFAULTS)."""
+    ns = globals()
+    return {key: ns[key] for key in CASE_DEFAULTS if key in ns}
+
+
+def log_generation(text_key, event, text):
+    generation_id = uuid.uuid4().hex
+    st.session_state["_generated_" + text_key] = text
+    st.session_state["_generation_id_" + text_key] = generation_id
+    try:
+        get_audit_log().record(
+            event,
+            st.session_state.get("reporting_user", ""),
+            st.session_state.get("accession", ""),
+            st.session_state["_session_id"],
+            generation_id=generation_id,
+            inputs=current_case_inputs(),
+            text=text,
+        )
+    except AuditError as exc:
+        st.error(str(exc))
+
+
+def log_manual_edit(text_key, event):
+    # on_change callback for the editable text areas
+    try:
+        get_audit_log().record(
+            event,
+            st.session_state.get("reporting_user", ""),
+            st.session_state.get("accession", ""),
+            st.session_state["_session_id"],
+            generation_id=st.session_state.get("_generation_id_" + text_key),
+            base_text=st.session_state.get("_generated_" + text_key, ""),
+            text=st.session_state[text_key],
+        )
+    except AuditError as exc:
+        st.error(str(exc))
 
 
 # =========================================
-# Session state initialization
+# Terminology tagging
 # =========================================
 
-if "microscopic_text" not in st.session_state:
-    st.session_state["microscopic_text"] = ""
-
-if "final_diagnosis_text" not in st.session_state:
-    st.session_state["final_diagnosis_text"] = ""
+def show_terms(text, container=st):
+    """Echo `text` under its input with recognized terms highlighted."""
+    mentions = tag(text)
+    if mentions:
+        container.markdown(
+            f'<div style="font-size: 0.85em; opacity: 0.8">{highlight_html(text, mentions)}</div>',
+            unsafe_allow_html=True,
+        )
 
 
 # =========================================
@@ -380,19 +177,24 @@ if "final_diagnosis_text" not in st.session_state:
 
 st.sidebar.title("Specimen & Clinical")
 
+accession = st.sidebar.text_input("Accession number", key="accession")
+
+reporting_user = st.sidebar.text_input("Reporting pathologist", key="reporting_user")
+
 specimen_class = st.sidebar.selectbox(
     "Specimen class",
-    ["Lymph node", "Skin", "Other"],
+    SPECIMEN_CLASSES,
 )
 
 procedure_type = st.sidebar.selectbox(
     "Procedure type",
-    ["Needle core biopsy", "Excisional biopsy", "Incisional biopsy", "Punch biopsy", "Shave biopsy", "Excision (skin)"],
+    PROCEDURE_TYPES,
 )
 
 site_text = st.sidebar.text_input("Site (e.g., 'left axillary', 'right cervical', 'left forearm')")
 
 clinical_hx = st.sidebar.text_area("Clinical history / Indication", height=120)
+show_terms(clinical_hx, st.sidebar)
 
 # Core details
 core_count = None
@@ -404,14 +206,14 @@ if procedure_type == "Needle core biopsy":
         core_count = st.number_input("Number of cores", min_value=0, max_value=30, value=3)
     with col_c2:
         core_length = st.number_input("Aggregate length (cm)", min_value=0.0, max_value=10.0, value=1.0, step=0.1)
-    integrity = st.sidebar.selectbox("Specimen integrity", ["Intact", "Fragmented", "Crushed"])
+    integrity = st.sidebar.selectbox("Specimen integrity", INTEGRITY_OPTIONS)
 
 # Skin depth
 skin_depth = []
 if specimen_class == "Skin":
     skin_depth = st.sidebar.multiselect(
         "Biopsy depth represented",
-        ["Epidermis", "Papillary dermis", "Reticular dermis", "Subcutis"]
+        SKIN_DEPTH_OPTIONS,
     )
 
 st.sidebar.markdown("---")
@@ -422,13 +224,21 @@ st.sidebar.write("This app assembles **Microscopic Description** and **Final Dia
 # Main layout – tabs
 # =========================================
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs([
-    "Morphology",
-    "Immunophenotype",
-    "Ancillary Studies",
-    "Diagnosis",
-    "Generated Report",
-])
+# Switching tabs reruns the script, so the report and analytics tabs (which
+# only display) are built only while open. The input tabs always run: their
+# widgets must render on every run to keep their values.
+tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(
+    [
+        "Morphology",
+        "Immunophenotype",
+        "Ancillary Studies",
+        "Diagnosis",
+        "Generated Report",
+        "Department Analytics",
+    ],
+    key="main_tab",
+    on_change="rerun",
+)
 
 # ---------- Tab 1: Morphology ----------
 with tab1:
@@ -437,13 +247,13 @@ with tab1:
     if specimen_class == "Lymph node":
         nodal_arch = st.radio(
             "Overall nodal architecture",
-            ["Preserved", "Partially effaced", "Effaced", "Not assessable"],
+            NODAL_ARCH_OPTIONS,
             horizontal=True,
         )
 
         pattern = st.multiselect(
             "Growth pattern (low power)",
-            ["Nodular", "Follicular", "Diffuse", "Interfollicular", "Sinusoidal", "Mantle zone", "Marginal zone"],
+            GROWTH_PATTERNS,
         )
 
         st.subheader("Follicular / germinal center features")
@@ -457,20 +267,14 @@ with tab1:
             with col_f1:
                 follicle_desc = st.selectbox(
                     "Follicle type",
-                    [
-                        "",
-                        "Secondary, reactive",
-                        "Crowded / back-to-back, suspicious for neoplastic",
-                        "Regressed / atrophic (AITL / nTFHL-like)",
-                        "Expanded mantle zones",
-                    ],
+                    FOLLICLE_TYPES,
                 )
             with col_f2:
                 follicles_polarized = st.checkbox("Polarization (dark and light zones)")
                 tingible_macrophages = st.checkbox("Tingible-body macrophages present")
                 mantle_zones = st.selectbox(
                     "Mantle zone status",
-                    ["", "Intact", "Attenuated", "Absent"],
+                    MANTLE_ZONE_OPTIONS,
                 )
         else:
             follicle_desc = None
@@ -491,60 +295,39 @@ with tab1:
 
     cell_size = st.selectbox(
         "Cell size",
-        ["", "Small", "Medium", "Large", "Mixed (polymorphous)"],
+        CELL_SIZES,
     )
 
     nuclear_features = st.multiselect(
         "Nuclear contours / features",
-        [
-            "Round",
-            "Irregular",
-            "Cleaved / angulated (centrocyte-like)",
-            "Cerebriform (Sezary / MF-like)",
-            "Kidney-shaped / reniform (hallmark cells, ALCL-like)",
-            "Multilobated / 'popcorn' (LP cells)",
-        ],
+        NUCLEAR_FEATURES,
     )
 
     chromatin = st.selectbox(
         "Chromatin",
-        ["", "Condensed / clumped", "Fine", "Vesicular / open"],
+        CHROMATIN_OPTIONS,
     )
 
     nucleoli = st.selectbox(
         "Nucleoli",
-        ["", "Inconspicuous", "Small basophilic", "Multiple peripheral", "Prominent central / single eosinophilic"],
+        NUCLEOLI_OPTIONS,
     )
 
     cytoplasm = st.selectbox(
         "Cytoplasm",
-        ["", "Scant", "Moderate", "Abundant", "Clear / pale", "Plasmacytoid", "Eosinophilic"],
+        CYTOPLASM_OPTIONS,
     )
 
     st.subheader("Background milieu / microenvironment")
 
     background_cells = st.multiselect(
         "Background cells / features",
-        [
-            "Eosinophils",
-            "Plasma cells",
-            "Histiocytes / epithelioid histiocytes",
-            "Tingible-body macrophages",
-            "High endothelial venules (HEVs)",
-            "Expanded follicular dendritic cell meshworks",
-            "Starry-sky pattern",
-            "Granulomas",
-        ],
+        BACKGROUND_CELLS,
     )
 
     sclerosis_pattern = st.selectbox(
         "Fibrosis / sclerosis",
-        [
-            "",
-            "Broad bands of collagen (NS-CHL-like)",
-            "Fine compartmentalizing fibrosis (PMBL-like)",
-            "Perivascular fibrosis",
-        ],
+        SCLEROSIS_PATTERNS,
     )
 
     # Skin-specific
@@ -553,32 +336,15 @@ with tab1:
     if specimen_class == "Skin":
         skin_epidermis = st.multiselect(
             "Epidermal features",
-            [
-                "Epidermotropism of atypical lymphocytes",
-                "Pautrier microabscesses",
-                "Spongiosis (minimal / absent)",
-                "Spongiosis (marked)",
-                "Parakeratosis",
-            ],
+            SKIN_EPIDERMIS_FEATURES,
         )
         skin_dermis = st.multiselect(
             "Dermal features",
-            [
-                "Band-like (lichenoid) infiltrate",
-                "Perivascular infiltrate",
-                "Periadnexal infiltrate",
-                "Papillary dermal fibrosis ('wire-like' collagen)",
-                "Subcutaneous panniculitis-like infiltrate",
-                "Angiocentric / angiodestructive infiltrate",
-            ],
+            SKIN_DERMIS_FEATURES,
         )
         skin_other = st.multiselect(
             "Other cutaneous features",
-            [
-                "Epidermal ulceration",
-                "Necrosis",
-                "Large CD30+ cells in clusters",
-            ],
+            SKIN_OTHER_FEATURES,
         )
     else:
         skin_epidermis = []
@@ -614,10 +380,13 @@ with tab1:
 
         combined = spec_sentence + " " + micro_sentence
         st.session_state["microscopic_text"] = combined
+        log_generation("microscopic_text", GENERATE_MICROSCOPIC, combined)
 
     st.text_area(
         "Microscopic Description (editable)",
         key="microscopic_text",
+        on_change=log_manual_edit,
+        args=("microscopic_text", EDIT_MICROSCOPIC),
         height=260,
     )
 
@@ -693,13 +462,7 @@ with tab2:
     else:
         st.write("No TFH markers selected.")
 
-    tfh_comment = ""
-    if tfh_count >= 3:
-        tfh_comment = f"Immunophenotype supports a T-follicular helper phenotype (≥3 TFH markers: {', '.join(tfh_positive)})."
-    elif 2 <= tfh_count < 3:
-        tfh_comment = f"At least 2 TFH markers expressed ({', '.join(tfh_positive)}); compatible with TFH phenotype but correlation with morphology is required."
-    elif tfh_count < 2:
-        tfh_comment = "Insufficient TFH markers for a definitive nTFHL diagnosis; consider PTCL, NOS or reactive conditions depending on morphology."
+    tfh_comment = build_tfh_comment(tfh_positive)
 
     st.info(tfh_comment)
 
@@ -710,13 +473,7 @@ with tab3:
     st.subheader("Flow cytometry")
     flow_status = st.selectbox(
         "Flow cytometry interpretation",
-        [
-            "",
-            "Polyclonal / no evidence of clonal population",
-            "Clonal B-cell population",
-            "Clonal T-cell population",
-            "Not performed / not available",
-        ],
+        FLOW_STATUSES,
     )
 
     flow_sentence = build_flow_sentence(flow_status)
@@ -728,6 +485,7 @@ with tab3:
         "Summarize key molecular results (e.g., IGH / TRG clonality, MYD88 L265P, BCL2/BCL6 mutations, etc.)",
         height=120,
     )
+    show_terms(molecular_findings)
 
     st.subheader("Cytogenetics / FISH")
     fish_myc = st.checkbox("FISH: MYC rearranged")
@@ -735,28 +493,13 @@ with tab3:
     fish_bcl6 = st.checkbox("FISH: BCL6 rearranged")
     fish_11q = st.checkbox("FISH: 11q aberration (high-grade B-cell lymphoma with 11q)")
     fish_other = st.text_area("Other cytogenetic / FISH findings", height=80)
+    show_terms(fish_other)
 
-    fish_summary_parts = []
-    hits = []
-    if fish_myc:
-        hits.append("MYC")
-    if fish_bcl2:
-        hits.append("BCL2")
-    if fish_bcl6:
-        hits.append("BCL6")
-    if hits:
-        fish_summary_parts.append("Rearrangements detected involving " + ", ".join(hits) + ".")
-    if fish_11q:
-        fish_summary_parts.append("11q aberration present, compatible with high-grade B-cell lymphoma with 11q aberration in the appropriate morphologic and clinical setting.")
-    if fish_other.strip():
-        fish_summary_parts.append(fish_other.strip())
-    fish_summary = " ".join(fish_summary_parts)
+    fish_summary = build_fish_summary(fish_myc, fish_bcl2, fish_bcl6, fish_11q, fish_other)
 
     st.text_area(
         "Ancillary studies text (auto-populated + editable suggestion)",
-        value="\n".join(
-            [x for x in [flow_sentence, build_molecular_sentence(molecular_findings), fish_summary] if x]
-        ),
+        value=build_ancillary_text(flow_status, molecular_findings, fish_summary),
         height=200,
     )
 
@@ -766,79 +509,44 @@ with tab4:
 
     diag_family = st.selectbox(
         "Diagnostic family",
-        [
-            "Reactive / non-neoplastic",
-            "Mature B-cell neoplasm",
-            "Mature T / NK-cell neoplasm",
-            "Hodgkin lymphoma",
-            "Primary cutaneous T-cell lymphoma / LPD",
-            "Primary cutaneous B-cell lymphoma",
-            "Other / histiocytic / stromal",
-        ],
+        list(DIAGNOSTIC_FAMILIES),
     )
 
-    if diag_family == "Reactive / non-neoplastic":
-        options = REACTIVE_ENTITIES
-    elif diag_family == "Mature B-cell neoplasm":
-        options = B_CELL_NODAL
-    elif diag_family == "Mature T / NK-cell neoplasm":
-        options = T_NK_NODAL
-    elif diag_family == "Hodgkin lymphoma":
-        options = HODGKIN
-    elif diag_family == "Primary cutaneous T-cell lymphoma / LPD":
-        options = CUTANEOUS_T
-    elif diag_family == "Primary cutaneous B-cell lymphoma":
-        options = CUTANEOUS_B
-    else:
-        options = OTHER_STROMAL_HISTIOCYTIC
-
-    primary_entity = st.selectbox("Primary diagnostic entity (WHO5 terminology)", [""] + options)
+    primary_entity = st.selectbox("Primary diagnostic entity (WHO5 terminology)", ENTITY_OPTIONS[diag_family])
 
     qualifier = st.selectbox(
         "Diagnostic qualifier",
-        [
-            "Definitive",
-            "Suspicious for",
-            "Favour",
-            "Indeterminate, cannot exclude",
-            "Limited for diagnosis; see comment",
-        ],
+        QUALIFIERS,
     )
 
     # nTFHL / TFH guidance display
-    if "T-follicular helper" in primary_entity:
+    if is_tfh_entity(primary_entity):
         st.info("Selected entity is an nTFHL subtype. Ensure TFH phenotype (≥2 markers), expanded HEVs, and FDC meshwork are present morphologically.")
 
     # DLBCL / HGBL logic hints
-    if "large B-cell lymphoma" in primary_entity.lower():
+    if has_lbcl_addons(primary_entity):
         st.warning(
-            "For large B-cell lymphomas, ensure cell-of-origin (Hans), MYC/BCL2 expression, and MYC/BCL2/BCL6 FISH are assessed when clinically relevant."
+            "For large B-cell and high-grade B-cell lymphomas, ensure cell-of-origin (Hans), MYC/BCL2 expression, and MYC/BCL2/BCL6 FISH are assessed when clinically relevant."
         )
 
     st.subheader("Recommendations / additional comments")
-    default_recs = ""
-    if primary_entity in REACTIVE_ENTITIES or "Atypical lymphoid hyperplasia" in primary_entity:
-        default_recs = "Clinical and radiologic correlation is recommended. Repeat biopsy can be considered if lymphadenopathy persists or progresses."
-    elif "large B-cell lymphoma" in primary_entity.lower():
-        default_recs = "Clinical staging, bone marrow evaluation as indicated, and multidisciplinary discussion (lymphoma tumor board) are recommended."
-    elif "Mycosis fungoides" in primary_entity or "Sézary" in primary_entity:
-        default_recs = "Correlation with clinical staging (TNMB), additional skin biopsies as needed, and hematologic evaluation for blood involvement are recommended."
-    elif "anaplastic large cell lymphoma" in primary_entity.lower():
-        default_recs = "Staging imaging and evaluation for systemic involvement are recommended. Distinguish primary cutaneous from systemic ALCL based on clinical data."
+    default_recs = default_recommendations(primary_entity)
 
     recommendations = st.text_area(
         "Recommendations (editable)",
         value=default_recs,
         height=120,
     )
+    show_terms(recommendations)
 
     comment = st.text_area(
         "Comment (optional; for grey-zone / limitations / differential diagnosis)",
         height=160,
     )
+    show_terms(comment)
 
     # Build tfh_text for final diagnosis, based on TFH markers
-    if "T-follicular helper" in primary_entity:
+    if is_tfh_entity(primary_entity):
         tfh_text = tfh_comment
     else:
         tfh_text = ""
@@ -850,9 +558,9 @@ with tab4:
             site_text=site_text,
             specimen_class=specimen_class,
             procedure_type=procedure_type,
-            coo_text=coo_text if "large B-cell lymphoma" in (primary_entity or "").lower() else "",
-            de_status=de_result if "large B-cell lymphoma" in (primary_entity or "").lower() else "",
-            fish_summary=fish_summary if "large B-cell lymphoma" in (primary_entity or "").lower() else "",
+            coo_text=coo_text if has_lbcl_addons(primary_entity) else "",
+            de_status=de_result if has_lbcl_addons(primary_entity) else "",
+            fish_summary=fish_summary if has_lbcl_addons(primary_entity) else "",
             tfh_text=tfh_text,
             core_length=core_length,
             integrity=integrity,
@@ -860,35 +568,213 @@ with tab4:
             comment=comment,
         )
         st.session_state["final_diagnosis_text"] = final_dx
+        log_generation("final_diagnosis_text", GENERATE_FINAL_DIAGNOSIS, final_dx)
 
     st.text_area(
         "Final Diagnosis (editable)",
         key="final_diagnosis_text",
+        on_change=log_manual_edit,
+        args=("final_diagnosis_text", EDIT_FINAL_DIAGNOSIS),
         height=280,
     )
 
+    st.subheader("Similar prior cases")
+    st.caption("Nearest signed-out cases by morphology, immunophenotype and FISH profile (not by diagnosis text).")
+    if st.button("Find similar cases"):
+        similar = get_similarity_index().query(current_case_inputs(), k=10, exclude=accession or None)
+        if not similar:
+            st.write("No similar cases in the archive.")
+        for similar_accession, similarity, similar_dx in similar:
+            st.write(f"**{similar_accession}** · {similarity:.0%} feature overlap · {similar_dx}")
+
 # ---------- Tab 5: Combined report ----------
 with tab5:
-    st.header("Generated Report")
+    if tab5.open:
+        st.header("Generated Report")
 
-    st.subheader("Clinical History")
-    st.code(clinical_hx or "", language="markdown")
+        st.subheader("Clinical History")
+        st.code(clinical_hx or "", language="markdown")
 
-    st.subheader("Microscopic Description")
-    st.code(
-        st.session_state.get("microscopic_text", ""),
-        language="markdown",
-    )
+        st.subheader("Microscopic Description")
+        st.code(
+            st.session_state.get("microscopic_text", ""),
+            language="markdown",
+        )
 
-    st.subheader("Final Diagnosis")
-    st.code(
-        st.session_state.get("final_diagnosis_text", ""),
-        language="markdown",
-    )
+        st.subheader("Final Diagnosis")
+        st.code(
+            st.session_state.get("final_diagnosis_text", ""),
+            language="markdown",
+        )
 
-    st.markdown(
-        """
+        st.markdown(
+            """
 You can copy-paste the **Microscopic Description** and **Final Diagnosis** into your LIS.
 Both sections update from the editable fields in the earlier tabs and persist while you switch tabs.
 """
-    )
+        )
+
+        # ---------- Sign-out / amendments ----------
+        st.markdown("---")
+        st.subheader("Sign-out & amendments")
+
+        if not accession:
+            st.info("Enter an accession number in the sidebar to sign out or amend this case.")
+        else:
+            archive = get_archive()
+            latest_version = archive.latest_version(accession)
+            if latest_version:
+                version_kind = st.selectbox("Version type", [AMENDMENT, ADDENDUM])
+                amendment_reason = st.text_input(
+                    "Reason (e.g., 'FISH: MYC and BCL2 rearranged; diagnosis revised to HGBL')"
+                )
+                save_label = f"Save version {latest_version + 1}"
+            else:
+                version_kind = ORIGINAL
+                amendment_reason = ""
+                save_label = "Sign out"
+
+            if st.button(save_label):
+                report_texts = {
+                    "microscopic_description": st.session_state.get("microscopic_text", ""),
+                    "final_diagnosis": st.session_state.get("final_diagnosis_text", ""),
+                }
+                signed_out_fields = current_case_inputs()
+                # Tag the recommendations as rendered, before a default is stored as None
+                terminology = tag_case(signed_out_fields)
+                if recommendations == default_recs:
+                    signed_out_fields["recommendations"] = None  # follows the default-recommendations rule
+                generated = generated_record(signed_out_fields)
+                signed_out_fields["terminology"] = terminology
+                try:
+                    get_audit_log().check()  # no sign-out that cannot be audited
+                    saved_version = archive.save_version(
+                        accession,
+                        signed_out_fields,
+                        report_texts,
+                        user=reporting_user,
+                        kind=version_kind,
+                        reason=amendment_reason,
+                        generated=generated,
+                    )
+                except (ArchiveError, AuditError) as exc:
+                    st.error(str(exc))
+                else:
+                    get_audit_log().record(
+                        SIGN_OUT,
+                        reporting_user,
+                        accession,
+                        st.session_state["_session_id"],
+                        version=saved_version,
+                        kind=version_kind,
+                        reason=amendment_reason,
+                        ruleset=RULESET_VERSION,
+                        text=report_texts["final_diagnosis"],
+                    )
+                    from similarity import diagnosis_line
+
+                    get_similarity_index().add(
+                        accession, signed_out_fields, diagnosis_line(signed_out_fields, report_texts)
+                    )
+                    st.success(f"Saved {accession} version {saved_version} ({version_kind}).")
+
+            history = archive.history(accession)
+            if history:
+                st.markdown("**Version history**")
+                for version, ts, user, kind, reason in history:
+                    stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts))
+                    st.write(f"v{version} · {stamp} · {kind} · {user or 'unknown'}" + (f" — {reason}" if reason else ""))
+
+                shown_version = st.selectbox(
+                    "View version",
+                    [h[0] for h in history],
+                    index=len(history) - 1,
+                    format_func=lambda v: f"Version {v}",
+                )
+                shown = archive.get_version(accession, shown_version)
+                st.code(shown.texts.get("final_diagnosis", ""), language="markdown")
+
+                field_changes, text_diffs = changes_since_previous(archive, accession, shown_version)
+                with st.expander("Changes since previous version", expanded=shown_version > 1):
+                    if not field_changes and not text_diffs:
+                        st.write("No changes.")
+                    for field, old, new in field_changes:
+                        st.write(f"**{field}**: {old!r} → {new!r}")
+                    for section, diff in text_diffs.items():
+                        st.markdown(f"**{section.replace('_', ' ').capitalize()}**")
+                        st.code(diff, language="diff")
+
+# ---------- Tab 6: Departmental analytics ----------
+with tab6:
+    if tab6.open:
+        st.header("Department Analytics")
+        st.caption("Counts cover the latest version of every signed-out case, by month of original sign-out.")
+
+        aggregates = get_archive().load_aggregates()
+        case_total = analytics.totals(aggregates, "cases").get("total", 0)
+
+        if not case_total:
+            st.info("No signed-out cases yet.")
+        else:
+            lbcl = analytics.totals(aggregates, "lbcl").get("total", 0)
+            de = analytics.totals(aggregates, "double_expressor")
+            cores = analytics.totals(aggregates, "core_biopsy")
+            de_rate = analytics.rate(de.get("yes", 0), lbcl)
+            limited_rate = analytics.rate(cores.get("limited", 0), cores.get("total", 0))
+
+            col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+            col_m1.metric("Signed-out cases", case_total)
+            col_m2.metric("Large B-cell lymphomas", lbcl)
+            col_m3.metric("Double-expressor rate (LBCL)", "–" if de_rate is None else f"{de_rate:.0%}")
+            col_m4.metric("Limited core biopsies (< 0.5 cm)", "–" if limited_rate is None else f"{limited_rate:.0%}")
+
+            st.subheader("Entity mix by family")
+            st.bar_chart({"Cases": analytics.totals(aggregates, "family")})
+
+            col_g1, col_g2 = st.columns(2)
+            with col_g1:
+                st.subheader("Cell of origin (LBCL, Hans)")
+                coo_totals = analytics.totals(aggregates, "coo")
+                if coo_totals:
+                    st.bar_chart({"Cases": coo_totals})
+                else:
+                    st.write("No LBCL cases signed out yet.")
+            with col_g2:
+                st.subheader("Diagnostic qualifier usage")
+                st.bar_chart({"Cases": analytics.totals(aggregates, "qualifier")})
+
+            st.subheader("Over time")
+            months = sorted(analytics.monthly(aggregates, "cases", "total"))
+            lbcl_by_month = analytics.monthly(aggregates, "lbcl", "total")
+            de_by_month = analytics.monthly(aggregates, "double_expressor", "yes")
+            core_by_month = analytics.monthly(aggregates, "core_biopsy", "total")
+            limited_by_month = analytics.monthly(aggregates, "core_biopsy", "limited")
+            trends = {
+                "Double-expressor rate (LBCL)": {
+                    m: de_by_month.get(m, 0) / lbcl_by_month[m] for m in months if lbcl_by_month.get(m)
+                },
+                "Limited core biopsy share": {
+                    m: limited_by_month.get(m, 0) / core_by_month[m] for m in months if core_by_month.get(m)
+                },
+            }
+            trends = {label: series for label, series in trends.items() if series}
+            if trends:
+                st.line_chart(trends)
+            else:
+                st.write("No LBCL or core biopsy cases signed out yet.")
+
+            st.subheader("nTFHL – TFH markers expressed per case")
+            tfh_rows = {
+                f"{n} marker(s)": analytics.monthly(aggregates, "tfh_markers", str(n))
+                for n in range(len(TFH_MARKERS) + 1)
+            }
+            if any(tfh_rows.values()):
+                st.bar_chart({label: {m: by_month.get(m, 0) for m in months} for label, by_month in tfh_rows.items()})
+            else:
+                st.write("No nTFHL cases signed out yet.")
+
+# =========================================
+# Startup metrics
+# =========================================
+
+startup.record_render(time.perf_counter() - _render_started, st.session_state)
@@ -0,0 +1,895 @@
+"""
+Report-building logic for the lymph node & cutaneous lymphoma reporting app.
+
+Everything here is free of Streamlit so the same prose can be produced by the
+UI (lnreport.py) and by headless callers such as report_service.py.
+"""
+
+import collections
+import dataclasses
+import hashlib
+import math
+
+# ---------- WHO5-style entity lists (filtered to nodal / cutaneous lymphomas) ----------
+
+REACTIVE_ENTITIES = [
+    "Reactive follicular hyperplasia",
+    "Paracortical (interfollicular) hyperplasia",
+    "Sinus histiocytosis",
+    "Granulomatous lymphadenitis",
+    "Necrotizing lymphadenitis",
+    "Dermatopathic lymphadenitis",
+    "Castleman disease, hyaline-vascular type",
+    "Castleman disease, plasma cell type",
+    "Atypical lymphoid hyperplasia (indeterminate for lymphoma)",
+]
+
+B_CELL_NODAL = [
+    # Classic nodal / systemic B-cell neoplasms
+    "Chronic lymphocytic leukemia / Small lymphocytic lymphoma (CLL/SLL)",
+    "Follicular lymphoma, classic (WHO5)",
+    "Follicular large B-cell lymphoma",
+    "Follicular lymphoma with unusual cytologic features",
+    "Primary cutaneous follicle center lymphoma (PCFCL)",
+    "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)",
+    "Diffuse large B-cell lymphoma, EBV-positive",
+    "Primary mediastinal (thymic) large B-cell lymphoma",
+    "High-grade B-cell lymphoma (HGBL) with MYC and BCL2 and/or BCL6 rearrangements",
+    "High-grade B-cell lymphoma with 11q aberration",
+    "Burkitt lymphoma",
+    "Mantle cell lymphoma, classic",
+    "Mantle cell lymphoma, blastoid / pleomorphic",
+    "Leukemic non-nodal mantle cell lymphoma",
+    "Marginal zone lymphoma, nodal",
+    "Marginal zone lymphoma, extranodal (MALT-type)",
+    "Splenic marginal zone lymphoma",
+    "Lymphoplasmacytic lymphoma / Waldenström macroglobulinemia",
+    "Primary cutaneous diffuse large B-cell lymphoma, leg type (PCDLBCL-LT)",
+]
+
+T_NK_NODAL = [
+    # WHO5 nTFH family
+    "Nodal T-follicular helper cell lymphoma, angioimmunoblastic type (nTFHL-AI)",
+    "Nodal T-follicular helper cell lymphoma, follicular type (nTFHL-F)",
+    "Nodal T-follicular helper cell lymphoma, NOS (nTFHL-NOS)",
+    # Other mature T/NK
+    "Peripheral T-cell lymphoma, NOS",
+    "Anaplastic large cell lymphoma (ALCL), ALK-positive",
+    "Anaplastic large cell lymphoma (ALCL), ALK-negative",
+    "EBV-positive nodal T- or NK-cell lymphoma, NOS",
+    "Extranodal NK/T-cell lymphoma, nasal type",
+    "Hepatosplenic T-cell lymphoma",
+]
+
+HODGKIN = [
+    "Classical Hodgkin lymphoma, nodular sclerosis",
+    "Classical Hodgkin lymphoma, mixed cellularity",
+    "Classical Hodgkin lymphoma, lymphocyte-rich",
+    "Classical Hodgkin lymphoma, lymphocyte-depleted",
+    "Nodular lymphocyte-predominant Hodgkin lymphoma (NLPHL)",
+]
+
+CUTANEOUS_T = [
+    "Mycosis fungoides (MF)",
+    "Sézary syndrome (SS)",
+    "Primary cutaneous CD4+ small/medium T-cell lymphoproliferative disorder",
+    "Primary cutaneous acral CD8+ T-cell lymphoproliferative disorder",
+    "Primary cutaneous CD8+ aggressive epidermotropic cytotoxic T-cell lymphoma",
+    "Subcutaneous panniculitis-like T-cell lymphoma",
+    "Primary cutaneous gamma/delta T-cell lymphoma",
+    "Primary cutaneous peripheral T-cell lymphoma, NOS",
+    "Lymphomatoid papulosis (LyP), type A",
+    "Lymphomatoid papulosis (LyP), type B",
+    "Lymphomatoid papulosis (LyP), type C",
+    "Lymphomatoid papulosis (LyP), type D",
+    "Lymphomatoid papulosis (LyP), type E",
+    "Primary cutaneous anaplastic large cell lymphoma (pcALCL)",
+]
+
+CUTANEOUS_B = [
+    "Primary cutaneous follicle center lymphoma (PCFCL)",
+    "Primary cutaneous marginal zone lymphoma (PCMZL)",
+    "Primary cutaneous diffuse large B-cell lymphoma, leg type (PCDLBCL-LT)",
+]
+
+OTHER_STROMAL_HISTIOCYTIC = [
+    "Rosai-Dorfman disease",
+    "Langerhans cell histiocytosis",
+    "Follicular dendritic cell sarcoma",
+    "Fibroblastic reticular cell tumor",
+]
+
+ALL_ENTITIES = (
+    REACTIVE_ENTITIES
+    + B_CELL_NODAL
+    + T_NK_NODAL
+    + HODGKIN
+    + CUTANEOUS_T
+    + CUTANEOUS_B
+    + OTHER_STROMAL_HISTIOCYTIC
+)
+
+# Diagnostic family -> entity list, in the order shown in the Diagnosis tab
+DIAGNOSTIC_FAMILIES = {
+    "Reactive / non-neoplastic": REACTIVE_ENTITIES,
+    "Mature B-cell neoplasm": B_CELL_NODAL,
+    "Mature T / NK-cell neoplasm": T_NK_NODAL,
+    "Hodgkin lymphoma": HODGKIN,
+    "Primary cutaneous T-cell lymphoma / LPD": CUTANEOUS_T,
+    "Primary cutaneous B-cell lymphoma": CUTANEOUS_B,
+    "Other / histiocytic / stromal": OTHER_STROMAL_HISTIOCYTIC,
+}
+
+QUALIFIERS = [
+    "Definitive",
+    "Suspicious for",
+    "Favour",
+    "Indeterminate, cannot exclude",
+    "Limited for diagnosis; see comment",
+]
+
+TFH_MARKERS = {
+    # case field -> marker name used in report text
+    "tfh_cd10": "CD10",
+    "tfh_bcl6": "BCL6",
+    "tfh_pd1": "PD-1",
+    "tfh_cxcl13": "CXCL13",
+    "tfh_icos": "ICOS",
+}
+
+# ---------- Widget option lists ----------
+# Built once per process and shared by every session, rather than rebuilt on
+# each script rerun.
+
+SPECIMEN_CLASSES = ["Lymph node", "Skin", "Other"]
+PROCEDURE_TYPES = [
+    "Needle core biopsy", "Excisional biopsy", "Incisional biopsy", "Punch biopsy", "Shave biopsy", "Excision (skin)",
+]
+INTEGRITY_OPTIONS = ["Intact", "Fragmented", "Crushed"]
+SKIN_DEPTH_OPTIONS = ["Epidermis", "Papillary dermis", "Reticular dermis", "Subcutis"]
+
+NODAL_ARCH_OPTIONS = ["Preserved", "Partially effaced", "Effaced", "Not assessable"]
+GROWTH_PATTERNS = ["Nodular", "Follicular", "Diffuse", "Interfollicular", "Sinusoidal", "Mantle zone", "Marginal zone"]
+FOLLICLE_TYPES = [
+    "",
+    "Secondary, reactive",
+    "Crowded / back-to-back, suspicious for neoplastic",
+    "Regressed / atrophic (AITL / nTFHL-like)",
+    "Expanded mantle zones",
+]
+MANTLE_ZONE_OPTIONS = ["", "Intact", "Attenuated", "Absent"]
+
+CELL_SIZES = ["", "Small", "Medium", "Large", "Mixed (polymorphous)"]
+NUCLEAR_FEATURES = [
+    "Round",
+    "Irregular",
+    "Cleaved / angulated (centrocyte-like)",
+    "Cerebriform (Sezary / MF-like)",
+    "Kidney-shaped / reniform (hallmark cells, ALCL-like)",
+    "Multilobated / 'popcorn' (LP cells)",
+]
+CHROMATIN_OPTIONS = ["", "Condensed / clumped", "Fine", "Vesicular / open"]
+NUCLEOLI_OPTIONS = ["", "Inconspicuous", "Small basophilic", "Multiple peripheral", "Prominent central / single eosinophilic"]
+CYTOPLASM_OPTIONS = ["", "Scant", "Moderate", "Abundant", "Clear / pale", "Plasmacytoid", "Eosinophilic"]
+
+BACKGROUND_CELLS = [
+    "Eosinophils",
+    "Plasma cells",
+    "Histiocytes / epithelioid histiocytes",
+    "Tingible-body macrophages",
+    "High endothelial venules (HEVs)",
+    "Expanded follicular dendritic cell meshworks",
+    "Starry-sky pattern",
+    "Granulomas",
+]
+SCLEROSIS_PATTERNS = [
+    "",
+    "Broad bands of collagen (NS-CHL-like)",
+    "Fine compartmentalizing fibrosis (PMBL-like)",
+    "Perivascular fibrosis",
+]
+
+SKIN_EPIDERMIS_FEATURES = [
+    "Epidermotropism of atypical lymphocytes",
+    "Pautrier microabscesses",
+    "Spongiosis (minimal / absent)",
+    "Spongiosis (marked)",
+    "Parakeratosis",
+]
+SKIN_DERMIS_FEATURES = [
+    "Band-like (lichenoid) infiltrate",
+    "Perivascular infiltrate",
+    "Periadnexal infiltrate",
+    "Papillary dermal fibrosis ('wire-like' collagen)",
+    "Subcutaneous panniculitis-like infiltrate",
+    "Angiocentric / angiodestructive infiltrate",
+]
+SKIN_OTHER_FEATURES = [
+    "Epidermal ulceration",
+    "Necrosis",
+    "Large CD30+ cells in clusters",
+]
+
+FLOW_STATUSES = [
+    "",
+    "Polyclonal / no evidence of clonal population",
+    "Clonal B-cell population",
+    "Clonal T-cell population",
+    "Not performed / not available",
+]
+
+# Primary-entity choices per diagnostic family, with the leading blank option
+ENTITY_OPTIONS = {family: [""] + entities for family, entities in DIAGNOSTIC_FAMILIES.items()}
+
+# ---------- Helper functions ----------
+
+def hans_algorithm(cd10, bcl6, mum1):
+    """
+    Implement Hans cell-of-origin algorithm for DLBCL.
+    Inputs are True/False for positivity.
+    Returns 'GCB', 'Non-GCB', or 'Indeterminate'.
+    """
+    if cd10:
+        return "Germinal center B-cell (GCB) type"
+    if not cd10 and not bcl6:
+        return "Activated B-cell (ABC / non-GCB) type"
+    if not cd10 and bcl6 and mum1:
+        return "Activated B-cell (ABC / non-GCB) type"
+    if not cd10 and bcl6 and not mum1:
+        return "Germinal center B-cell (GCB) type"
+    return "Indeterminate by Hans algorithm"
+
+
+def tfh_marker_summary(markers_dict):
+    """
+    markers_dict: dict of {marker_name: bool}
+    Returns text and count.
+    """
+    positive = [m for m, v in markers_dict.items() if v]
+    return positive, len(positive)
+
+
+def double_expressor_status(myc_pct, bcl2_pct, myc_cutoff=40, bcl2_cutoff=50):
+    if myc_pct is None or bcl2_pct is None:
+        return "Not assessable"
+    if myc_pct >= myc_cutoff and bcl2_pct >= bcl2_cutoff:
+        return "Meets immunohistochemical criteria for MYC/BCL2 double-expressor status."
+    return "Does not meet double-expressor cutoffs."
+
+
+def build_specimen_sentence(specimen_class, procedure_type, site_text, core_count,
+                            core_length, integrity, skin_depth):
+    parts = []
+    if specimen_class == "Lymph node":
+        if procedure_type == "Needle core biopsy":
+            base = f"Needle core biopsy of {site_text} lymph node."
+            cores = []
+            if core_count:
+                cores.append(f"{core_count} cores")
+            if core_length:
+                cores.append(f"aggregate length {core_length:.1f} cm")
+            if cores:
+                base += f" The specimen consists of {', '.join(cores)}."
+            if integrity:
+                base += f" The cores are {integrity.lower()}."
+            if core_length is not None and core_length < 0.5:
+                base += " The limited tissue sampling may restrict comprehensive architectural assessment."
+            parts.append(base)
+        elif procedure_type in ["Excisional biopsy", "Incisional biopsy"]:
+            parts.append(f"{procedure_type} of {site_text} lymph node.")
+        else:
+            parts.append(f"{procedure_type} of {site_text}.")
+    elif specimen_class == "Skin":
+        base = f"{procedure_type} of skin, {site_text}."
+        if skin_depth:
+            base += " The biopsy includes: " + ", ".join(skin_depth) + "."
+        parts.append(base)
+    else:
+        parts.append(f"{procedure_type} of {site_text}.")
+    return " ".join(parts)
+
+
+def build_microscopic_description(
+    specimen_class,
+    nodal_arch,
+    pattern,
+    follicles_present,
+    follicle_desc,
+    follicles_polarized,
+    tingible_macrophages,
+    mantle_zones,
+    cell_size,
+    nuclear_features,
+    chromatin,
+    nucleoli,
+    cytoplasm,
+    background_cells,
+    sclerosis_pattern,
+    skin_epidermis,
+    skin_dermis,
+    skin_other
+):
+    sentences = []
+
+    # Architecture
+    if specimen_class == "Lymph node":
+        if nodal_arch == "Preserved":
+            s = "Sections show a lymph node with preserved overall architecture."
+        elif nodal_arch == "Partially effaced":
+            s = "Sections show partial effacement of the lymph node architecture."
+        elif nodal_arch == "Effaced":
+            s = "Sections show near-complete effacement of the lymph node architecture."
+        else:
+            s = "Sections show lymphoid tissue."
+        if pattern:
+            s += " The infiltrate is arranged in a " + " and ".join(pattern).lower() + " pattern."
+        sentences.append(s)
+
+        if follicles_present:
+            follicle_sentence = "Numerous follicles are present, showing "
+            if follicle_desc:
+                follicle_sentence += follicle_desc.lower()
+            else:
+                follicle_sentence += "reactive features"
+            extras = []
+            if follicles_polarized:
+                extras.append("polarization with dark and light zones")
+            if tingible_macrophages:
+                extras.append("prominent tingible-body macrophages")
+            if mantle_zones:
+                extras.append(f"mantle zones that are {mantle_zones.lower()}")
+            if extras:
+                follicle_sentence += ", with " + ", ".join(extras)
+            follicle_sentence += "."
+            sentences.append(follicle_sentence)
+
+    # Cytology
+    if cell_size or nuclear_features or chromatin or nucleoli or cytoplasm:
+        cyto_parts = []
+        if cell_size:
+            cyto_parts.append(f"{cell_size.lower()} to intermediate-sized lymphoid cells")
+        else:
+            cyto_parts.append("lymphoid cells")
+        if nuclear_features:
+            cyto_parts.append("with " + ", ".join([nf.lower() for nf in nuclear_features]) + " nuclei")
+        if chromatin:
+            cyto_parts.append(f"and {chromatin.lower()} chromatin")
+        if nucleoli:
+            cyto_parts.append(f"and {nucleoli.lower()} nucleoli")
+        if cytoplasm:
+            cyto_parts.append(f"and {cytoplasm.lower()} cytoplasm")
+        cyto_sentence = "The infiltrate is composed predominantly of " + " ".join(cyto_parts) + "."
+        sentences.append(cyto_sentence)
+
+    # Background cells
+    if background_cells or sclerosis_pattern:
+        bg = []
+        if background_cells:
+            bg.append("a background rich in " + ", ".join([b.lower() for b in background_cells]))
+        if sclerosis_pattern:
+            bg.append(sclerosis_pattern.lower() + " fibrosis")
+        if bg:
+            sentences.append("The microenvironment shows " + " and ".join(bg) + ".")
+
+    # Skin-specific description
+    if specimen_class == "Skin":
+        if skin_epidermis or skin_dermis or skin_other:
+            skin_sentence = "In the skin biopsy, "
+            subparts = []
+            if skin_epidermis:
+                subparts.append("epidermis with " + ", ".join([e.lower() for e in skin_epidermis]))
+            if skin_dermis:
+                subparts.append("dermis with " + ", ".join([d.lower() for d in skin_dermis]))
+            if skin_other:
+                subparts.append(", ".join([o.lower() for o in skin_other]))
+            skin_sentence += "; ".join(subparts) + "."
+            sentences.append(skin_sentence)
+
+    if not sentences:
+        sentences.append("Sections show lymphoid tissue; please see immunophenotypic and molecular studies.")
+    return " ".join(sentences)
+
+
+def build_flow_sentence(flow_status):
+    if flow_status == "Polyclonal / no evidence of clonal population":
+        return "Flow cytometry shows a polytypic B-cell population without evidence of a clonal B- or aberrant T-cell population."
+    elif flow_status == "Clonal B-cell population":
+        return "Flow cytometry identifies a clonal B-cell population with light chain restriction."
+    elif flow_status == "Clonal T-cell population":
+        return "Flow cytometry identifies an aberrant T-cell population."
+    elif flow_status == "Not performed / not available":
+        return "Flow cytometry was not performed or not available for review."
+    return ""
+
+
+def build_molecular_sentence(molecular_findings):
+    if not molecular_findings:
+        return ""
+    return "Molecular studies: " + molecular_findings.strip()
+
+
+def build_final_diagnosis(
+    qualifier,
+    primary_entity,
+    site_text,
+    specimen_class,
+    procedure_type,
+    coo_text,
+    de_status,
+    fish_summary,
+    tfh_text,
+    core_length,
+    integrity,
+    recommendations,
+    comment
+):
+    lines = []
+
+    # Line 1: Diagnosis header
+    if primary_entity:
+        prefix = ""
+        if qualifier in ["Suspicious for", "Favour", "Indeterminate, cannot exclude"]:
+            prefix = qualifier + " "
+        elif qualifier == "Limited for diagnosis; see comment":
+            prefix = "Limited for diagnosis. Features are suggestive of "
+        elif qualifier == "Definitive":
+            prefix = ""
+        diagnosis_line = prefix + primary_entity
+        if site_text:
+            diagnosis_line += f", {site_text}"
+        diagnosis_line += "."
+        lines.append(diagnosis_line)
+    else:
+        lines.append("No specific lymphoma identified. See comment.")
+
+    # Disclaimers for core biopsies
+    if specimen_class == "Lymph node" and procedure_type == "Needle core biopsy":
+        disc = "This diagnosis is rendered on a needle core biopsy. "
+        if core_length is not None and core_length < 0.5:
+            disc += "The limited tissue and fragmented cores restrict evaluation of nodal architecture; correlation with clinical, radiologic, and, if indicated, an excisional biopsy is recommended."
+        else:
+            disc += "Architectural assessment is inherently limited in core biopsies; correlation with clinical and imaging findings is advised."
+        lines.append(disc)
+
+    # DLBCL / HGBL add-ons
+    if has_lbcl_addons(primary_entity):
+        if coo_text:
+            lines.append(f"Cell-of-origin (Hans algorithm): {coo_text}.")
+        if de_status and de_status != "Not assessable":
+            lines.append(de_status)
+        if fish_summary:
+            lines.append(fish_summary)
+
+    # nTFHL / TFH markers
+    if primary_entity and "t-follicular helper" in primary_entity.lower():
+        if tfh_text:
+            lines.append(tfh_text)
+
+    # Recommendations
+    if recommendations:
+        lines.append("Recommendations: " + recommendations.strip())
+
+    # Comment
+    if comment:
+        lines.append("Comment: " + comment.strip())
+
+    return "\n".join(lines)
+
+
+def is_large_b_cell(primary_entity):
+    return "large b-cell lymphoma" in (primary_entity or "").lower()
+
+
+def is_high_grade_b_cell(primary_entity):
+    return (primary_entity or "").startswith("High-grade B-cell lymphoma")
+
+
+def has_lbcl_addons(primary_entity):
+    """
+    True for the entities whose final diagnosis carries the DLBCL / HGBL
+    add-ons (Hans COO, MYC/BCL2 expression, FISH summary) and the LBCL
+    recommendations: the large B-cell lymphomas, and both high-grade B-cell
+    lymphomas, whose diagnosis rests on the FISH result.
+    """
+    return is_large_b_cell(primary_entity) or is_high_grade_b_cell(primary_entity)
+
+
+def is_tfh_entity(primary_entity):
+    return "T-follicular helper" in (primary_entity or "")
+
+
+def build_tfh_comment(tfh_positive):
+    tfh_count = len(tfh_positive)
+    if tfh_count >= 3:
+        return f"Immunophenotype supports a T-follicular helper phenotype (≥3 TFH markers: {', '.join(tfh_positive)})."
+    elif 2 <= tfh_count < 3:
+        return f"At least 2 TFH markers expressed ({', '.join(tfh_positive)}); compatible with TFH phenotype but correlation with morphology is required."
+    return "Insufficient TFH markers for a definitive nTFHL diagnosis; consider PTCL, NOS or reactive conditions depending on morphology."
+
+
+def build_fish_summary(fish_myc, fish_bcl2, fish_bcl6, fish_11q, fish_other):
+    fish_summary_parts = []
+    hits = []
+    if fish_myc:
+        hits.append("MYC")
+    if fish_bcl2:
+        hits.append("BCL2")
+    if fish_bcl6:
+        hits.append("BCL6")
+    if hits:
+        fish_summary_parts.append("Rearrangements detected involving " + ", ".join(hits) + ".")
+    if fish_11q:
+        fish_summary_parts.append("11q aberration present, compatible with high-grade B-cell lymphoma with 11q aberration in the appropriate morphologic and clinical setting.")
+    if (fish_other or "").strip():
+        fish_summary_parts.append(fish_other.strip())
+    return " ".join(fish_summary_parts)
+
+
+def default_recommendations(primary_entity):
+    primary_entity = primary_entity or ""
+    if primary_entity in REACTIVE_ENTITIES or "Atypical lymphoid hyperplasia" in primary_entity:
+        return "Clinical and radiologic correlation is recommended. Repeat biopsy can be considered if lymphadenopathy persists or progresses."
+    elif has_lbcl_addons(primary_entity):
+        return "Clinical staging, bone marrow evaluation as indicated, and multidisciplinary discussion (lymphoma tumor board) are recommended."
+    elif "Mycosis fungoides" in primary_entity or "Sézary" in primary_entity:
+        return "Correlation with clinical staging (TNMB), additional skin biopsies as needed, and hematologic evaluation for blood involvement are recommended."
+    elif "anaplastic large cell lymphoma" in primary_entity.lower():
+        return "Staging imaging and evaluation for systemic involvement are recommended. Distinguish primary cutaneous from systemic ALCL based on clinical data."
+    return ""
+
+
+def build_ancillary_text(flow_status, molecular_findings, fish_summary):
+    return "\n".join(
+        [x for x in [build_flow_sentence(flow_status), build_molecular_sentence(molecular_findings), fish_summary] if x]
+    )
+
+
+# =========================================
+# Structured cases
+# =========================================
+
+# Every input the UI collects, keyed by the variable name used in lnreport.py.
+# Defaults are deliberately neutral (nothing asserted) rather than the widget
+# defaults, so a caller that omits a field never gets findings it did not send.
+CASE_DEFAULTS = {
+    # Specimen & clinical
+    "specimen_class": "Lymph node",
+    "procedure_type": "Excisional biopsy",
+    "site_text": "",
+    "clinical_hx": "",
+    "core_count": None,
+    "core_length": None,
+    "integrity": None,
+    "skin_depth": [],
+    # Morphology
+    "nodal_arch": "Not assessable",
+    "pattern": [],
+    "follicles_present": False,
+    "follicle_desc": None,
+    "follicles_polarized": False,
+    "tingible_macrophages": False,
+    "mantle_zones": None,
+    "cell_size": "",
+    "nuclear_features": [],
+    "chromatin": "",
+    "nucleoli": "",
+    "cytoplasm": "",
+    "background_cells": [],
+    "sclerosis_pattern": "",
+    "skin_epidermis": [],
+    "skin_dermis": [],
+    "skin_other": [],
+    # Immunophenotype
+    "cd3": False,
+    "cd20": False,
+    "cd5": False,
+    "cd23": False,
+    "cd10": False,
+    "bcl6": False,
+    "bcl2": False,
+    "cyclin_d1": False,
+    "sox11": False,
+    "cd30": False,
+    "alk": False,
+    "mum1": False,
+    "eber": False,
+    "cd21_fdc": False,
+    "ki67_pct": None,
+    "myc_pct": None,
+    "bcl2_pct": None,
+    "tfh_cd10": False,
+    "tfh_bcl6": False,
+    "tfh_pd1": False,
+    "tfh_cxcl13": False,
+    "tfh_icos": False,
+    # Ancillary studies
+    "flow_status": "",
+    "molecular_findings": "",
+    "fish_myc": False,
+    "fish_bcl2": False,
+    "fish_bcl6": False,
+    "fish_11q": False,
+    "fish_other": "",
+    # Diagnosis
+    "diag_family": "",
+    "primary_entity": "",
+    "qualifier": "Definitive",
+    "recommendations": None,  # None -> default_recommendations(primary_entity)
+    "comment": "",
+}
+
+_PCT_FIELDS = {"ki67_pct", "myc_pct", "bcl2_pct"}
+
+# Fields the UI fills from a fixed option list -> the values it can produce
+_CHOICES = {key: frozenset(options) for key, options in {
+    "specimen_class": SPECIMEN_CLASSES,
+    "procedure_type": PROCEDURE_TYPES,
+    "integrity": INTEGRITY_OPTIONS,
+    "skin_depth": SKIN_DEPTH_OPTIONS,
+    "nodal_arch": NODAL_ARCH_OPTIONS + ["Not applicable"],  # skin specimens
+    "pattern": GROWTH_PATTERNS,
+    "follicle_desc": FOLLICLE_TYPES,
+    "mantle_zones": MANTLE_ZONE_OPTIONS,
+    "cell_size": CELL_SIZES,
+    "nuclear_features": NUCLEAR_FEATURES,
+    "chromatin": CHROMATIN_OPTIONS,
+    "nucleoli": NUCLEOLI_OPTIONS,
+    "cytoplasm": CYTOPLASM_OPTIONS,
+    "background_cells": BACKGROUND_CELLS,
+    "sclerosis_pattern": SCLEROSIS_PATTERNS,
+    "skin_epidermis": SKIN_EPIDERMIS_FEATURES,
+    "skin_dermis": SKIN_DERMIS_FEATURES,
+    "skin_other": SKIN_OTHER_FEATURES,
+    "flow_status": FLOW_STATUSES,
+    "diag_family": ["", *DIAGNOSTIC_FAMILIES],
+    "primary_entity": ["", *ALL_ENTITIES],
+    "qualifier": QUALIFIERS,
+}.items()}
+
+
+class CaseError(ValueError):
+    pass
+
+
+def normalize_case(case):
+    """
+    Merge a (possibly partial) case dict over CASE_DEFAULTS and check types
+    and option values. null stands for the default of fields the UI can leave
+    unset (None in CASE_DEFAULTS) and for the default value of every other
+    field. Raises CaseError naming the first offending field.
+    """
+    if not isinstance(case, dict):
+        raise CaseError("case must be an object")
+    unknown = set(case) - set(CASE_DEFAULTS)
+    if unknown:
+        raise CaseError(f"unknown field(s): {', '.join(sorted(unknown))}")
+
+    out = dict(CASE_DEFAULTS)
+    for key, value in case.items():
+        default = CASE_DEFAULTS[key]
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise CaseError(f"{key} must be true or false")
+        elif isinstance(default, list):
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                raise CaseError(f"{key} must be a list of strings")
+        elif key in _PCT_FIELDS:
+            if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 100:
+                raise CaseError(f"{key} must be an integer between 0 and 100")
+        elif key == "core_count":
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise CaseError(f"{key} must be a non-negative integer")
+        elif key == "core_length":
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < math.inf:
+                # json.loads accepts NaN / Infinity; neither is a length
+                raise CaseError(f"{key} must be a finite non-negative number")
+            value = float(value)
+        elif not isinstance(value, str):
+            raise CaseError(f"{key} must be a string")
+        choices = _CHOICES.get(key)
+        if choices is not None:
+            for v in value if isinstance(value, list) else [value]:
+                if v not in choices:
+                    raise CaseError(f"{key}: {v!r} is not one of the options")
+        out[key] = value
+
+    family, entity = out["diag_family"], out["primary_entity"]
+    if family and entity and entity not in DIAGNOSTIC_FAMILIES[family]:
+        raise CaseError(f"primary_entity: {entity!r} is not in the {family!r} family")
+    return out
+
+
+def render_case(case):
+    """
+    Render every report section for a structured case, with the same gating
+    the UI applies (COO / DE / FISH only for large B-cell lymphomas, TFH text
+    only for nTFHL). Returns a dict of section name -> text.
+    """
+    c = normalize_case(case)
+    lymph_node = c["specimen_class"] == "Lymph node"
+
+    spec_sentence = build_specimen_sentence(
+        c["specimen_class"], c["procedure_type"], c["site_text"], c["core_count"],
+        c["core_length"], c["integrity"], c["skin_depth"],
+    )
+    micro_sentence = build_microscopic_description(
+        c["specimen_class"],
+        c["nodal_arch"] if lymph_node else "Not applicable",
+        c["pattern"] if lymph_node else [],
+        c["follicles_present"] and lymph_node,
+        c["follicle_desc"],
+        c["follicles_polarized"],
+        c["tingible_macrophages"],
+        c["mantle_zones"],
+        c["cell_size"],
+        c["nuclear_features"],
+        c["chromatin"],
+        c["nucleoli"],
+        c["cytoplasm"],
+        c["background_cells"],
+        c["sclerosis_pattern"],
+        c["skin_epidermis"],
+        c["skin_dermis"],
+        c["skin_other"],
+    )
+
+    coo_text = hans_algorithm(c["cd10"], c["bcl6"], c["mum1"])
+    de_result = double_expressor_status(c["myc_pct"], c["bcl2_pct"])
+    tfh_positive, _ = tfh_marker_summary({name: c[field] for field, name in TFH_MARKERS.items()})
+    tfh_comment = build_tfh_comment(tfh_positive)
+    fish_summary = build_fish_summary(
+        c["fish_myc"], c["fish_bcl2"], c["fish_bcl6"], c["fish_11q"], c["fish_other"]
+    )
+
+    primary_entity = c["primary_entity"]
+    large_b = has_lbcl_addons(primary_entity)
+    recommendations = c["recommendations"]
+    if recommendations is None:
+        recommendations = default_recommendations(primary_entity)
+
+    final_dx = build_final_diagnosis(
+        qualifier=c["qualifier"],
+        primary_entity=primary_entity,
+        site_text=c["site_text"],
+        specimen_class=c["specimen_class"],
+        procedure_type=c["procedure_type"],
+        coo_text=coo_text if large_b else "",
+        de_status=de_result if large_b else "",
+        fish_summary=fish_summary if large_b else "",
+        tfh_text=tfh_comment if is_tfh_entity(primary_entity) else "",
+        core_length=c["core_length"],
+        integrity=c["integrity"],
+        recommendations=recommendations,
+        comment=c["comment"],
+    )
+
+    return {
+        "microscopic_description": spec_sentence + " " + micro_sentence,
+        "ancillary_studies": build_ancillary_text(c["flow_status"], c["molecular_findings"], fish_summary),
+        "final_diagnosis": final_dx,
+        "coo": coo_text,
+        "double_expressor": de_result,
+        "tfh_comment": tfh_comment,
+    }
+
+
+# =========================================
+# Rule set versions
+# =========================================
+
+# Bump a rule's version whenever its logic, thresholds or wording change, and
+# RULESET_VERSION with every release that changes any rule. Each signed-out
+# case records the versions it was generated under, with the values of each
+# rule's inputs; reaudit.py uses them to find the archived cases a rule change
+# could affect.
+RULESET_VERSION = "2026.2"
+
+
+@dataclasses.dataclass(frozen=True)
+class Rule:
+    name: str
+    version: int
+    inputs: tuple    # CASE_DEFAULTS fields the rule reads
+    applies: object  # normalized case -> True when the rule's output reaches the report
+
+
+RULES = {rule.name: rule for rule in [
+    Rule(
+        "hans", 2,
+        ("primary_entity", "cd10", "bcl6", "mum1"),
+        lambda c: has_lbcl_addons(c["primary_entity"]),
+    ),
+    Rule(
+        "double_expressor", 2,
+        ("primary_entity", "myc_pct", "bcl2_pct"),
+        lambda c: has_lbcl_addons(c["primary_entity"]),
+    ),
+    Rule(
+        "tfh_thresholds", 1,
+        ("primary_entity", *TFH_MARKERS),
+        lambda c: is_tfh_entity(c["primary_entity"]),
+    ),
+    Rule(
+        "limited_core", 1,
+        ("specimen_class", "procedure_type", "core_length"),
+        lambda c: c["specimen_class"] == "Lymph node" and c["procedure_type"] == "Needle core biopsy",
+    ),
+    Rule(
+        "default_recommendations", 2,
+        ("primary_entity", "recommendations"),
+        lambda c: c["recommendations"] is None,
+    ),
+]}
+
+assert all(set(rule.inputs) <= set(CASE_DEFAULTS) for rule in RULES.values())
+
+
+def case_inputs(fields):
+    """The CASE_DEFAULTS fields of an archived case, without derived keys."""
+    return {key: fields[key] for key in CASE_DEFAULTS if key in fields}
+
+
+# Rendered keys kept verbatim in a generated record; the text sections are
+# stored as hashes only.
+CLASSIFICATIONS = ("coo", "double_expressor", "tfh_comment")
+
+
+def generated_output(case):
+    """The rendered sections of `case`, with the classifications only where the report shows them."""
+    c = normalize_case(case)
+    output = render_case(c)
+    if not has_lbcl_addons(c["primary_entity"]):
+        del output["coo"], output["double_expressor"]
+    if not is_tfh_entity(c["primary_entity"]):
+        del output["tfh_comment"]
+    return output
+
+
+def output_digest(output):
+    """`output` with every text section replaced by its SHA-256."""
+    return {
+        key: value if key in CLASSIFICATIONS else hashlib.sha256(value.encode()).hexdigest()
+        for key, value in output.items()
+    }
+
+
+def generated_record(case):
+    """
+    What the current rule set generates for `case`, as stored alongside a
+    signed-out version (CaseArchive.save_version): each rule's version and the
+    values of its inputs, plus the digest of the rendered output.
+    """
+    inputs = {**CASE_DEFAULTS, **case_inputs(case)}
+    return {
+        "ruleset": RULESET_VERSION,
+        "rules": {
+            name: {"version": rule.version, "inputs": {key: inputs[key] for key in rule.inputs}}
+            for name, rule in RULES.items()
+        },
+        "output": output_digest(generated_output(case)),
+    }
+
+
+# =========================================
+# Batch jobs over the archive
+# =========================================
+
+def map_batches(fn, batches, workers):
+    """
+    Yield fn(batch) for each of `batches`, in order, computed in a pool of
+    `workers` processes. At most two batches per worker are loaded and in
+    flight at a time; Executor.map would read every batch into pending work
+    items before the first result.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch in batches:
+            pending.append(pool.submit(fn, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
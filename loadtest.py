@@ -0,0 +1,537 @@
+"""
+Concurrent-session load test for the lymph node reporting app.
+
+Starts a real `streamlit run` server and drives N simulated pathologist
+sessions against it through realistic click paths, one websocket client per
+session sending the widget states a browser would. Sessions rerun
+concurrently in the server process, so throughput, latency percentiles and
+server memory show how many pathologists one process supports. Each session
+count gets a fresh server process so the memory figures are per-process.
+
+--cold-start instead measures time-to-first-render on fresh processes, with
+and without the serve.py warm-up, tagged with the release (git describe) so
+the figure can be tracked across deploys.
+
+    python loadtest.py --sessions 1 2 4 8 16 --iterations 3
+    python loadtest.py --cold-start --repeat 5 --json coldstart.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import queue as queue_module
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+# =========================================
+# Click paths
+# =========================================
+
+IHC_LABELS = [
+    "CD3 positive",
+    "CD20 positive",
+    "CD5 positive",
+    "CD23 positive",
+    "CD10 positive",
+    "BCL6 positive",
+    "BCL2 positive",
+    "Cyclin D1 positive",
+    "SOX11 positive",
+    "CD30 positive (strong / diffuse)",
+    "ALK positive",
+    "MUM1 positive",
+    "EBER positive (ISH)",
+    "CD21 highlights expanded FDC meshworks",
+    "TFH CD10+",
+    "TFH BCL6+",
+    "PD-1+",
+    "CXCL13+",
+    "ICOS+",
+]
+
+FISH_LABELS = [
+    "FISH: MYC rearranged",
+    "FISH: BCL2 rearranged",
+    "FISH: BCL6 rearranged",
+]
+
+# (diagnostic family, primary entity) pairs exercised by the simulated sessions
+ENTITY_PATHS = [
+    ("Mature B-cell neoplasm", "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)"),
+    ("Mature B-cell neoplasm", "Follicular lymphoma, classic (WHO5)"),
+    ("Mature T / NK-cell neoplasm", "Nodal T-follicular helper cell lymphoma, angioimmunoblastic type (nTFHL-AI)"),
+    ("Hodgkin lymphoma", "Classical Hodgkin lymphoma, nodular sclerosis"),
+    ("Reactive / non-neoplastic", "Reactive follicular hyperplasia"),
+    ("Primary cutaneous T-cell lymphoma / LPD", "Mycosis fungoides (MF)"),
+]
+
+TAB_LABELS = [
+    "Morphology",
+    "Immunophenotype",
+    "Ancillary Studies",
+    "Diagnosis",
+    "Generated Report",
+    "Department Analytics",
+]
+
+
+class LoadTestError(Exception):
+    pass
+
+
+class Session:
+    """
+    One simulated pathologist: a websocket client of a running server that
+    sends the widget states a browser would. Every widget interaction
+    triggers a rerun, timed from the request to the server's script_finished.
+    Sessions are independent connections, so they rerun concurrently in the
+    server exactly as browser tabs would.
+    """
+
+    def __init__(self, url, rng, timeout):
+        self.url = url
+        self.rng = rng
+        self.timeout = timeout
+        self.ws = None
+        self.states = {}    # widget id -> WidgetState the browser would send back
+        self.widgets = {}   # (element type, label) -> widget proto from the last run
+        self.tab_container_id = None
+        self.tab_labels = []
+        self.code = []
+        self.headings = []
+        self.latencies = []
+
+    async def connect(self):
+        import websockets
+
+        self.ws = await websockets.connect(self.url, max_size=None)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def _run(self, trigger=None):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        msg.rerun_script.widget_states.widgets.extend(self.states.values())
+        if trigger is not None:
+            msg.rerun_script.widget_states.widgets.append(trigger)
+        start = time.perf_counter()
+        await self.ws.send(msg.SerializeToString())
+        try:
+            await asyncio.wait_for(self._read_run(), self.timeout)
+        except asyncio.TimeoutError:
+            raise LoadTestError(f"rerun took longer than {self.timeout:.0f} s") from None
+        self.latencies.append(time.perf_counter() - start)
+
+    async def _read_run(self):
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        self.widgets, self.tab_labels, self.code, self.headings = {}, [], [], []
+        exception = None
+        while True:
+            msg = ForwardMsg()
+            msg.ParseFromString(await self.ws.recv())
+            kind = msg.WhichOneof("type")
+            if kind == "script_finished":
+                break
+            if kind != "delta":
+                continue
+            delta = msg.delta
+            if delta.WhichOneof("type") == "add_block":
+                block = delta.add_block
+                if block.WhichOneof("type") == "tab_container":
+                    self.tab_container_id = block.tab_container.id
+                elif block.WhichOneof("type") == "tab":
+                    self.tab_labels.append(block.tab.label)
+            elif delta.WhichOneof("type") == "new_element":
+                element_type = delta.new_element.WhichOneof("type")
+                element = getattr(delta.new_element, element_type)
+                if element_type == "exception":
+                    exception = exception or element.message
+                elif element_type == "code":
+                    self.code.append(element.code_text)
+                elif element_type == "heading":
+                    self.headings.append(element.body)
+                elif hasattr(element, "id") and hasattr(element, "label"):
+                    self.widgets[element_type, element.label] = element
+        if exception:
+            raise LoadTestError(exception)
+
+    def _state(self, kind, label):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        try:
+            widget = self.widgets[kind, label]
+        except KeyError:
+            raise LoadTestError(f"No {kind} labelled {label!r}") from None
+        return WidgetState(id=widget.id)
+
+    async def set(self, kind, label, value):
+        state = self._state(kind, label)
+        if kind == "checkbox":
+            state.bool_value = value
+        elif kind == "slider":
+            state.double_array_value.data.append(value)
+        else:  # selectbox, radio, text_input: the formatted option / text
+            state.string_value = value
+        self.states[state.id] = state
+        await self._run()
+
+    async def click(self, label):
+        state = self._state("button", label)
+        state.trigger_value = True
+        await self._run(trigger=state)
+
+    async def open_tab(self, label):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        state = WidgetState(id=self.tab_container_id, string_value=label)
+        self.states[state.id] = state
+        await self._run()
+
+    async def click_path(self):
+        rng = self.rng
+        await self._run()
+
+        # Sidebar
+        await self.set("selectbox", "Procedure type", rng.choice(["Needle core biopsy", "Excisional biopsy"]))
+        await self.set(
+            "text_input", "Site (e.g., 'left axillary', 'right cervical', 'left forearm')",
+            rng.choice(["left axillary", "right cervical", "left inguinal"]),
+        )
+
+        # Tab 1: Morphology
+        await self.set("radio", "Overall nodal architecture", rng.choice(["Preserved", "Partially effaced", "Effaced"]))
+        await self.set("selectbox", "Cell size", rng.choice(["Small", "Medium", "Large"]))
+        await self.click("Generate / update Microscopic Description")
+
+        # Tab 2: Immunophenotype
+        for label in rng.sample(IHC_LABELS, rng.randint(3, 8)):
+            await self.set("checkbox", label, True)
+        await self.set("slider", "Ki-67 proliferation index (%)", rng.randint(5, 95))
+
+        # Tab 3: Ancillary studies
+        for label in rng.sample(FISH_LABELS, rng.randint(0, 2)):
+            await self.set("checkbox", label, True)
+
+        # Tab 4: Diagnosis
+        family, entity = rng.choice(ENTITY_PATHS)
+        await self.set("selectbox", "Diagnostic family", family)
+        await self.set("selectbox", "Primary diagnostic entity (WHO5 terminology)", entity)
+        await self.click("Generate / update Final Diagnosis")
+
+        for label in TAB_LABELS:
+            if label not in self.tab_labels:
+                raise LoadTestError(f"Tab {label!r} not rendered")
+
+        # Tabs 5 and 6 are built only while open; switching tabs is a rerun,
+        # and _run raises if the opened tab renders an exception
+        for label in TAB_LABELS[1:] + TAB_LABELS[:1]:
+            await self.open_tab(label)
+            if label == "Generated Report" and not any(self.code):
+                raise LoadTestError("Generated Report tab is empty after generation")
+            if label == "Department Analytics" and label not in self.headings:
+                raise LoadTestError("Department Analytics tab did not render")
+
+
+# =========================================
+# Measurement
+# =========================================
+
+def _rss_mb(pid):
+    with open(f"/proc/{pid}/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / (1024 * 1024)
+
+
+def _peak_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def _scratch_stores(directory):
+    """
+    Environment pointing the app's audit log, archive and similarity index
+    into `directory`, so simulated sessions never write to the real
+    (hash-chained, append-only) audit store.
+    """
+    return {
+        "LNREPORT_AUDIT_DB": os.path.join(directory, "audit.db"),
+        "LNREPORT_ARCHIVE_DB": os.path.join(directory, "archive.db"),
+        "LNREPORT_SIMILARITY_INDEX": os.path.join(directory, "similarity.npz"),
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def app_server(script, startup_timeout=60.0):
+    """A fresh `streamlit run` process serving `script`; yields (process, websocket URL)."""
+    port = _free_port()
+    scratch = tempfile.TemporaryDirectory(prefix="loadtest-")
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", script,
+            "--server.headless", "true", "--server.address", "127.0.0.1", "--server.port", str(port),
+            "--server.enableXsrfProtection", "false", "--browser.gatherUsageStats", "false",
+        ],
+        env={**os.environ, **_scratch_stores(scratch.name)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if proc.poll() is not None:
+                raise LoadTestError(f"server exited with code {proc.returncode} during startup")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise LoadTestError(f"server not healthy after {startup_timeout:.0f} s") from None
+                time.sleep(0.2)
+        yield proc, f"ws://127.0.0.1:{port}/_stcore/stream"
+    finally:
+        proc.kill()
+        proc.wait()
+        scratch.cleanup()
+
+
+async def _drive(proc, url, n_sessions, iterations, seed, timeout, level_timeout):
+    # One throwaway run so the baseline includes the script's first-run imports
+    warm = Session(url, random.Random(seed), timeout)
+    await warm.connect()
+    await warm._run()
+    await warm.close()
+    baseline_mb = _rss_mb(proc.pid)
+
+    sessions = [Session(url, random.Random(seed + i), timeout) for i in range(n_sessions)]
+    errors = []
+
+    async def drive(session):
+        try:
+            await session.connect()
+            for _ in range(iterations):
+                await session.click_path()
+        except Exception as exc:  # reported, not raised, so other sessions finish
+            errors.append(f"{type(exc).__name__}: {exc}")
+        finally:
+            await session.close()
+
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(drive(s) for s in sessions)), level_timeout)
+    except asyncio.TimeoutError:
+        raise LoadTestError(f"{n_sessions} sessions: no result after {level_timeout:.0f} s") from None
+    return sessions, errors, baseline_mb, time.perf_counter() - start
+
+
+def run_level(script, n_sessions, iterations, seed, timeout, level_timeout):
+    """Run `n_sessions` concurrent sessions against a fresh server process and summarize."""
+    with app_server(script) as (proc, url):
+        sessions, errors, baseline_mb, elapsed = asyncio.run(
+            _drive(proc, url, n_sessions, iterations, seed, timeout, level_timeout)
+        )
+        if proc.poll() is not None:
+            errors.append(f"server exited with code {proc.returncode}")
+            rss_mb = peak_rss_mb = 0.0
+        else:
+            rss_mb, peak_rss_mb = _rss_mb(proc.pid), _peak_rss_mb(proc.pid)
+
+    latencies = sorted(l for s in sessions for l in s.latencies)
+    return {
+        "sessions": n_sessions,
+        "reruns": len(latencies),
+        "elapsed_s": elapsed,
+        "reruns_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p90_ms": _percentile(latencies, 90) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "rss_mb": rss_mb,
+        "peak_rss_mb": peak_rss_mb,
+        "rss_per_session_mb": (rss_mb - baseline_mb) / n_sessions if rss_mb else 0.0,
+        "errors": errors,
+    }
+
+
+def _child_result(proc, queue, timeout, what):
+    """
+    Wait up to `timeout` seconds for the result a child process posts. A child
+    that dies without posting one (OOM kill, segfault) raises LoadTestError
+    instead of hanging the harness.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            result = queue.get(timeout=1.0)
+            break
+        except queue_module.Empty:
+            if not proc.is_alive():
+                raise LoadTestError(f"{what}: worker exited with code {proc.exitcode} without a result")
+            if time.monotonic() > deadline:
+                proc.kill()
+                proc.join()
+                raise LoadTestError(f"{what}: no result after {timeout:.0f} s")
+    proc.join()
+    return result
+
+
+# =========================================
+# Cold start
+# =========================================
+
+def measure_cold_start(script, timeout, warm_up):
+    """
+    Called in a fresh process: time process readiness (Streamlit import plus
+    the optional warm-up), then the first render of two sessions as measured
+    by the app itself (see startup.record_render and startup.metrics).
+    """
+    start = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+
+    import startup
+
+    if warm_up:
+        startup.warm_up()
+    ready_ms = (time.perf_counter() - start) * 1000
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as scratch:
+        os.environ.update(_scratch_stores(scratch))
+        for _ in range(2):
+            at = AppTest.from_file(script, default_timeout=timeout)
+            at.run()
+            if at.exception:
+                raise LoadTestError(at.exception[0].message)
+    metrics = startup.metrics()
+    return {
+        "ready_ms": ready_ms,
+        "warm_up_ms": metrics["warm_up_ms"] or 0.0,
+        "first_render_ms": metrics["first_render_ms"],
+        "second_session_render_ms": at.session_state["_first_render_ms"],
+    }
+
+
+def _cold_start_worker(queue, *args):
+    try:
+        queue.put(measure_cold_start(*args))
+    except Exception as exc:
+        queue.put({"error": f"{type(exc).__name__}: {exc}"})
+
+
+def run_cold_start(script, timeout, warm_up, repeat, sample_timeout):
+    """Median cold-start figures over `repeat` fresh processes."""
+    ctx = mp.get_context("spawn")
+    samples = []
+    for _ in range(repeat):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_cold_start_worker, args=(queue, script, timeout, warm_up))
+        proc.start()
+        result = _child_result(proc, queue, sample_timeout, "cold start")
+        if "error" in result:
+            raise LoadTestError(f"cold start: {result['error']}")
+        samples.append(result)
+    summary = {key: statistics.median(s[key] for s in samples) for key in samples[0]}
+    summary["warm_up"] = warm_up
+    summary["repeat"] = repeat
+    return summary
+
+
+def _release():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_table(results):
+    header = f"{'sessions':>8} {'reruns':>7} {'reruns/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'RSS MB':>8} {'MB/sess':>8} {'errors':>6}"
+    rows = [header, "-" * len(header)]
+    for r in results:
+        rows.append(
+            f"{r['sessions']:>8} {r['reruns']:>7} {r['reruns_per_s']:>9.1f} {r['p50_ms']:>8.1f} "
+            f"{r['p90_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['rss_mb']:>8.1f} {r['rss_per_session_mb']:>8.2f} "
+            f"{len(r['errors']):>6}"
+        )
+    return "\n".join(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--script", default="lnreport.py", help="Streamlit script to drive")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="session counts to measure, one process per count")
+    parser.add_argument("--iterations", type=int, default=3, help="click paths per session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-rerun timeout (s)")
+    parser.add_argument("--level-timeout", type=float, default=1800.0,
+                        help="give up on a session count (or cold-start sample) after this long (s)")
+    parser.add_argument("--json", metavar="PATH", help="also write raw results as JSON")
+    parser.add_argument("--cold-start", action="store_true",
+                        help="measure time-to-first-render on fresh processes instead")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per cold-start mode")
+    args = parser.parse_args(argv)
+
+    if args.cold_start:
+        report = {"release": _release(), "results": []}
+        print(f"{'warm-up':>8} {'ready ms':>9} {'warm-up ms':>11} {'first render ms':>16} {'2nd session ms':>15}")
+        for warm_up in (False, True):
+            r = run_cold_start(args.script, args.timeout, warm_up, args.repeat, args.level_timeout)
+            report["results"].append(r)
+            print(f"{'yes' if warm_up else 'no':>8} {r['ready_ms']:>9.0f} {r['warm_up_ms']:>11.0f} "
+                  f"{r['first_render_ms']:>16.1f} {r['second_session_render_ms']:>15.1f}", flush=True)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        return 0
+
+    results = []
+    print("\n".join(format_table([]).splitlines()[:2]), flush=True)
+    for n in args.sessions:
+        results.append(run_level(args.script, n, args.iterations, args.seed, args.timeout, args.level_timeout))
+        print(format_table(results[-1:]).splitlines()[-1], flush=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    for r in results:
+        for err in r["errors"]:
+            print(f"[{r['sessions']} sessions] {err}")
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
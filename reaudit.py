@@ -0,0 +1,177 @@
+"""
+Re-audit archived cases after a diagnostic rule changes.
+
+Every signed-out version records, next to its fields, what the rule set
+generated for it (lnreport_core.generated_record): each rule's version and the
+values of that rule's declared inputs, plus a digest of the rendered output.
+A case is a candidate when a rule whose version differs from the one it
+recorded (or a rule named with --rule) applies to it. The archive indexes the
+recorded inputs per rule, so `applies` is evaluated once per distinct set of
+input values rather than once per case, and only candidates are loaded. A
+rule added after a case was signed out has no recorded inputs for it; such
+cases are loaded and `applies` is judged on their stored fields, and they are
+counted per rule in the report.
+Candidates are then re-rendered in parallel with the current rules; a section
+whose digest changed is shown as a diff of the signed-out report text against
+the current output. Cases with no generated record (signed out before
+versioning) are counted but cannot be compared.
+
+    python reaudit.py archive.db
+    python reaudit.py archive.db --rule double_expressor --json reaudit.json
+"""
+
+import argparse
+import collections
+import difflib
+import json
+import os
+
+from lnreport_core import (
+    CLASSIFICATIONS,
+    RULES,
+    case_inputs,
+    generated_output,
+    map_batches,
+    normalize_case,
+    output_digest,
+)
+
+
+def select_candidates(archive, forced=()):
+    """
+    Returns (candidates, scanned, unversioned, unrecorded). A candidate is
+    (accession, version, [changed rules that apply]); unrecorded maps a rule
+    to the number of cases signed out before it existed.
+    """
+    scanned, unversioned = archive.count_cases()
+    applicable = collections.defaultdict(list)
+    unrecorded = {}
+    for name, rule in RULES.items():
+        # No recorded inputs for a rule newer than the case: judge each case
+        missing = archive.cases_without_rule(name)
+        if missing:
+            unrecorded[name] = len(missing)
+        for accession, version in missing:
+            fields = archive.get_version(accession, version).fields
+            if rule.applies(normalize_case(case_inputs(fields))):
+                applicable[accession, version].append(name)
+        exclude = None if name in forced else rule.version
+        for inputs, cases in archive.rule_input_groups(name, exclude).items():
+            inputs = json.loads(inputs)
+            if set(rule.inputs) <= set(inputs):
+                # The rule reads only these values, so one evaluation covers the group
+                if rule.applies(normalize_case({key: inputs[key] for key in rule.inputs})):
+                    for key in cases:
+                        applicable[key].append(name)
+                continue
+            # Recorded under a version of the rule with other inputs: judge each case
+            for accession, version in cases:
+                fields = archive.get_version(accession, version).fields
+                if rule.applies(normalize_case(case_inputs(fields))):
+                    applicable[accession, version].append(name)
+    candidates = [(accession, version, sorted(rules)) for (accession, version), rules in sorted(applicable.items())]
+    return candidates, scanned, unversioned, unrecorded
+
+
+def _compare(recorded, signed_out, new):
+    classification = {
+        key: [recorded.get(key), new.get(key)]
+        for key in CLASSIFICATIONS
+        if recorded.get(key) != new.get(key)
+    }
+    digest = output_digest(new)
+    texts = {}
+    for section in ("microscopic_description", "ancillary_studies", "final_diagnosis"):
+        if recorded.get(section) != digest.get(section):
+            texts[section] = "\n".join(difflib.unified_diff(
+                signed_out.get(section, "").splitlines(), new.get(section, "").splitlines(),
+                "signed out", "current rules", lineterm="",
+            ))
+    return classification, texts
+
+
+def _reevaluate(batch):
+    out = []
+    for accession, version, inputs, recorded, signed_out, rules in batch:
+        classification, texts = _compare(recorded, signed_out, generated_output(inputs))
+        if classification or texts:
+            out.append({
+                "accession": accession,
+                "version": version,
+                "rules": rules,
+                "classification": classification,
+                "texts": texts,
+            })
+    return out
+
+
+def reaudit(archive, forced=(), workers=None, batch_size=200):
+    """Re-evaluate affected cases; returns a report dict (see main)."""
+    unknown = set(forced) - set(RULES)
+    if unknown:
+        raise ValueError(f"unknown rule(s): {', '.join(sorted(unknown))}")
+    candidates, scanned, unversioned, unrecorded = select_candidates(archive, forced)
+    workers = workers or os.cpu_count() or 1
+
+    def batches():
+        for i in range(0, len(candidates), batch_size):
+            batch = []
+            for accession, version, rules in candidates[i:i + batch_size]:
+                case = archive.get_version(accession, version)
+                _, recorded = archive.get_generated(accession, version)
+                batch.append((accession, version, case_inputs(case.fields), recorded, case.texts, rules))
+            yield batch
+
+    differences = []
+    if candidates:
+        for results in map_batches(_reevaluate, batches(), workers):
+            differences.extend(results)
+
+    return {
+        "rules": {name: rule.version for name, rule in RULES.items()},
+        "scanned": scanned,
+        "unversioned": unversioned,
+        "unrecorded": unrecorded,
+        "reevaluated": len(candidates),
+        "differences": differences,
+    }
+
+
+def main(argv=None):
+    from archive import CaseArchive
+
+    parser = argparse.ArgumentParser(description="Re-audit archived cases against the current rule set")
+    parser.add_argument("archive")
+    parser.add_argument("--rule", action="append", default=[], choices=sorted(RULES),
+                        help="re-check this rule even where the recorded version matches (repeatable)")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--json", help="write the full report here")
+    args = parser.parse_args(argv)
+
+    archive = CaseArchive(args.archive)
+    report = reaudit(archive, args.rule, args.workers)
+    archive.close()
+
+    print(
+        f"Scanned {report['scanned']} case(s), re-evaluated {report['reevaluated']}, "
+        f"{len(report['differences'])} would now differ"
+        + (f" ({report['unversioned']} without a recorded rule set)" if report["unversioned"] else "")
+    )
+    for name, n in report["unrecorded"].items():
+        print(f"{n} case(s) signed out before rule {name} existed; judged on their stored fields")
+    for diff in report["differences"]:
+        print(f"\n{diff['accession']} v{diff['version']} — rules: {', '.join(diff['rules'])}")
+        for key, (old, new) in diff["classification"].items():
+            print(f"  {key}: {old!r} -> {new!r}")
+        for section, text in diff["texts"].items():
+            print(f"  {section}:")
+            print("\n".join("    " + line for line in text.splitlines()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
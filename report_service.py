@@ -0,0 +1,327 @@
+"""
+Standalone HTTP rendering service for LIS middleware and synoptic templates.
+
+Accepts structured cases as JSON (fields as in lnreport_core.CASE_DEFAULTS)
+and returns the same Microscopic Description / Final Diagnosis prose the
+Streamlit app produces, without a human in the UI.
+
+    POST /render     {"case": {...}}            -> {"sections": {...}}
+                     {"cases": [{...}, ...]}    -> {"results": [{"sections": {...}} | {"error": "..."}]}
+    GET  /healthz    liveness / readiness, with the rule set version
+    GET  /metrics    Prometheus text format
+
+    python report_service.py --port 8601 --workers 32 --processes 4
+
+Connections are HTTP/1.1 keep-alive and are served from a bounded thread pool;
+when the pool and its backlog are full, new connections get 503 instead of
+queueing without limit. With --processes > 1 the listening socket is shared
+by pre-forked processes and /metrics reports the process that answered it
+(see the X-Worker-Pid header).
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from lnreport_core import RULESET_VERSION, CaseError, render_case
+
+MAX_BODY_BYTES = 4 * 1024 * 1024
+MAX_BATCH = 1000
+
+# Latency histogram bucket bounds (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+# =========================================
+# Metrics
+# =========================================
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}  # (path, status) -> count
+        self.cases_rendered = 0
+        self.case_errors = 0
+        self.rejected_connections = 0
+        self.open_connections = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def observe(self, path, status, seconds, rendered=0, failed=0):
+        with self._lock:
+            key = (path, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.cases_rendered += rendered
+            self.case_errors += failed
+            self.latency_sum += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency_counts[i] += 1
+                    break
+            else:
+                self.latency_counts[-1] += 1
+
+    def connection(self, delta):
+        with self._lock:
+            self.open_connections += delta
+
+    def rejected(self):
+        with self._lock:
+            self.rejected_connections += 1
+
+    def render(self, pool_size, max_pending):
+        with self._lock:
+            lines = [
+                "# TYPE lnreport_requests_total counter",
+                *(
+                    f'lnreport_requests_total{{path="{path}",status="{status}"}} {n}'
+                    for (path, status), n in sorted(self.requests.items())
+                ),
+                "# TYPE lnreport_cases_rendered_total counter",
+                f"lnreport_cases_rendered_total {self.cases_rendered}",
+                "# TYPE lnreport_case_errors_total counter",
+                f"lnreport_case_errors_total {self.case_errors}",
+                "# TYPE lnreport_rejected_connections_total counter",
+                f"lnreport_rejected_connections_total {self.rejected_connections}",
+                "# TYPE lnreport_open_connections gauge",
+                f"lnreport_open_connections {self.open_connections}",
+                "# TYPE lnreport_worker_pool_size gauge",
+                f"lnreport_worker_pool_size {pool_size}",
+                "# TYPE lnreport_worker_pool_max_pending gauge",
+                f"lnreport_worker_pool_max_pending {max_pending}",
+                "# TYPE lnreport_uptime_seconds gauge",
+                f"lnreport_uptime_seconds {time.time() - self.started:.3f}",
+                "# TYPE lnreport_request_duration_seconds histogram",
+            ]
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, self.latency_counts):
+                cumulative += n
+                lines.append(f'lnreport_request_duration_seconds_bucket{{le="{bound}"}} {cumulative}')
+            cumulative += self.latency_counts[-1]
+            lines.append(f'lnreport_request_duration_seconds_bucket{{le="+Inf"}} {cumulative}')
+            lines.append(f"lnreport_request_duration_seconds_sum {self.latency_sum:.6f}")
+            lines.append(f"lnreport_request_duration_seconds_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+# =========================================
+# Request handling
+# =========================================
+
+def render_batch(cases):
+    """Render a list of cases; one bad case does not fail the others."""
+    results = []
+    failed = 0
+    for case in cases:
+        try:
+            results.append({"sections": render_case(case)})
+        except CaseError as exc:
+            failed += 1
+            results.append({"error": str(exc)})
+    return results, failed
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    server_version = "lnreport-service"
+    # Headers and body go out as two writes; without TCP_NODELAY the second
+    # one waits on the client's delayed ACK (~40 ms per request).
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Idle keep-alive connections hold a pool worker; time them out.
+        self.timeout = self.server.idle_timeout
+        super().setup()
+
+    def log_message(self, format, *args):
+        if self.server.access_log:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._send(status, body, "application/json; charset=utf-8")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Worker-Pid", str(os.getpid()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        if self.path == "/healthz":
+            status = 200
+            self._send_json(status, {"status": "ok", "pid": os.getpid(), "ruleset": RULESET_VERSION})
+        elif self.path == "/metrics":
+            status = 200
+            text = self.server.metrics.render(self.server.workers, self.server.max_pending)
+            self._send(status, text.encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            status = 404
+            self._send_json(status, {"error": "not found"})
+        self.server.metrics.observe(self.path if status != 404 else "other", status, time.perf_counter() - start)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        status, payload, rendered, failed = self._handle_post()
+        self._send_json(status, payload)
+        path = self.path if status != 404 else "other"
+        self.server.metrics.observe(path, status, time.perf_counter() - start, rendered, failed)
+
+    def _handle_post(self):
+        if self.path != "/render":
+            return 404, {"error": "not found"}, 0, 0
+
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            return 411, {"error": "Content-Length required"}, 0, 0
+        if length < 0:
+            self.close_connection = True
+            return 400, {"error": "invalid Content-Length"}, 0, 0
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            return 413, {"error": f"body exceeds {MAX_BODY_BYTES} bytes"}, 0, 0
+
+        try:
+            body = json.loads(self.rfile.read(length))
+        except (UnicodeDecodeError, json.JSONDecodeError) as exc:
+            return 400, {"error": f"invalid JSON: {exc}"}, 0, 0
+        if not isinstance(body, dict):
+            return 400, {"error": "body must be an object with 'case' or 'cases'"}, 0, 0
+
+        if "cases" in body:
+            cases = body["cases"]
+            if not isinstance(cases, list):
+                return 400, {"error": "'cases' must be a list"}, 0, 0
+            if len(cases) > MAX_BATCH:
+                return 413, {"error": f"at most {MAX_BATCH} cases per request"}, 0, 0
+            results, failed = render_batch(cases)
+            return 200, {"results": results}, len(cases) - failed, failed
+
+        if "case" in body:
+            try:
+                return 200, {"sections": render_case(body["case"])}, 1, 0
+            except CaseError as exc:
+                return 422, {"error": str(exc)}, 0, 1
+
+        return 400, {"error": "body must contain 'case' or 'cases'"}, 0, 0
+
+
+# =========================================
+# Server
+# =========================================
+
+class ReportServer(HTTPServer):
+    """
+    HTTPServer whose connections run on a bounded thread pool. At most
+    `workers` connections are served concurrently and `max_pending` more may
+    wait; beyond that a connection is answered 503 and closed.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, workers=32, max_pending=256, idle_timeout=5.0,
+                 access_log=False, bind_and_activate=True):
+        super().__init__(address, ReportHandler, bind_and_activate)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.access_log = access_log
+        self.metrics = Metrics()
+        # The pool starts its threads lazily, so it is safe to fork after this.
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            self.metrics.rejected()
+            try:
+                request.sendall(
+                    b"HTTP/1.1 503 Service Unavailable\r\n"
+                    b"Content-Length: 0\r\nConnection: close\r\nRetry-After: 1\r\n\r\n"
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self._serve_connection, request, client_address)
+
+    def _serve_connection(self, request, client_address):
+        self.metrics.connection(+1)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.metrics.connection(-1)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(host, port, workers, max_pending, processes, idle_timeout, access_log):
+    server = ReportServer((host, port), workers, max_pending, idle_timeout, access_log)
+    children = []
+    for _ in range(processes - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = None
+            break
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children or ():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # shutdown() blocks until serve_forever returns; call it off-thread.
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    if children is not None:
+        print(f"Serving on http://{host}:{port} ({processes} process(es) x {workers} workers)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for pid in children or ():
+            os.waitpid(pid, 0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lymph node report rendering service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8601)
+    parser.add_argument("--workers", type=int, default=32, help="concurrent connections per process")
+    parser.add_argument("--max-pending", type=int, default=256,
+                        help="connections allowed to wait for a worker before 503")
+    parser.add_argument("--processes", type=int, default=1, help="pre-forked processes sharing the socket")
+    parser.add_argument("--idle-timeout", type=float, default=5.0, help="keep-alive idle timeout (s)")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.processes < 1 or args.max_pending < 0:
+        parser.error("--workers and --processes must be >= 1, --max-pending >= 0")
+    serve(args.host, args.port, args.workers, args.max_pending, args.processes,
+          args.idle_timeout, args.access_log)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Start the reporting app on a warmed-up server process.
+
+Runs startup.warm_up() and then `streamlit run lnreport.py` in the same
+interpreter, so the first session after a deploy finds its imports and
+process-level caches already built. Any `streamlit run` option is passed
+through.
+
+    python serve.py
+    python serve.py --server.port 8502 --server.headless true
+"""
+
+import logging
+import os
+import sys
+
+import startup
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lnreport.py")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+    startup.warm_up()
+
+    from streamlit.web import cli
+
+    sys.argv = ["streamlit", "run", APP, *argv]
+    return cli.main()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,334 @@
+"""
+Similar-case retrieval over packed feature bit vectors.
+
+Each signed-out case is reduced to a set of morphologic / immunophenotypic
+features (growth pattern, cytology, background milieu, skin features, the
+IHC checkbox panel, binned Ki-67 / MYC / BCL2, FISH flags). Every possible
+feature is enumerated from the option lists in lnreport_core and owns one
+bit of a fixed-width vector, so two features never share a bit. Similarity
+is the Jaccard index of two vectors, computed for the whole archive at once
+with AND + popcount over uint64 words. Vectors are stored word-major (one
+contiguous array per word), so a query is WORDS passes over flat arrays and
+a top-k lookup over a million cases takes tens of milliseconds. The
+diagnosis itself is not a feature; it is what the lookup returns.
+
+Percentages use thermometer coding (a bit for every threshold reached), so
+cases with close Ki-67 values share more bits than distant ones.
+
+    python similarity.py sync archive.db similarity.npz
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from lnreport_core import (
+    BACKGROUND_CELLS,
+    CASE_DEFAULTS,
+    CELL_SIZES,
+    CHROMATIN_OPTIONS,
+    CYTOPLASM_OPTIONS,
+    FOLLICLE_TYPES,
+    GROWTH_PATTERNS,
+    MANTLE_ZONE_OPTIONS,
+    NODAL_ARCH_OPTIONS,
+    NUCLEAR_FEATURES,
+    NUCLEOLI_OPTIONS,
+    SCLEROSIS_PATTERNS,
+    SKIN_DERMIS_FEATURES,
+    SKIN_EPIDERMIS_FEATURES,
+    SKIN_OTHER_FEATURES,
+    SPECIMEN_CLASSES,
+    TFH_MARKERS,
+)
+
+FEATURE_BITS = 256
+WORDS = FEATURE_BITS // 64
+
+# field -> the values it can take
+CATEGORICAL_FEATURES = {
+    "specimen_class": SPECIMEN_CLASSES,
+    "nodal_arch": NODAL_ARCH_OPTIONS,
+    "follicle_desc": FOLLICLE_TYPES,
+    "mantle_zones": MANTLE_ZONE_OPTIONS,
+    "cell_size": CELL_SIZES,
+    "chromatin": CHROMATIN_OPTIONS,
+    "nucleoli": NUCLEOLI_OPTIONS,
+    "cytoplasm": CYTOPLASM_OPTIONS,
+    "sclerosis_pattern": SCLEROSIS_PATTERNS,
+}
+MULTI_FEATURES = {
+    "pattern": GROWTH_PATTERNS,
+    "nuclear_features": NUCLEAR_FEATURES,
+    "background_cells": BACKGROUND_CELLS,
+    "skin_epidermis": SKIN_EPIDERMIS_FEATURES,
+    "skin_dermis": SKIN_DERMIS_FEATURES,
+    "skin_other": SKIN_OTHER_FEATURES,
+}
+FLAG_FEATURES = [
+    "follicles_present",
+    "follicles_polarized",
+    "tingible_macrophages",
+    "cd3", "cd20", "cd5", "cd23", "cd10", "bcl6", "bcl2", "cyclin_d1", "sox11",
+    "cd30", "alk", "mum1", "eber", "cd21_fdc",
+    *TFH_MARKERS,
+    "fish_myc", "fish_bcl2", "fish_bcl6", "fish_11q",
+]
+PCT_THRESHOLDS = {
+    "ki67_pct": (10, 20, 40, 60, 80, 90),
+    "myc_pct": (20, 40, 60),
+    "bcl2_pct": (25, 50, 75),
+}
+
+assert set([*CATEGORICAL_FEATURES, *MULTI_FEATURES, *FLAG_FEATURES, *PCT_THRESHOLDS]) <= set(CASE_DEFAULTS)
+
+_NOT_A_FINDING = ("", "Not assessable", "Not applicable")
+
+
+def _all_features():
+    features = []
+    for name, options in CATEGORICAL_FEATURES.items():
+        features += [f"{name}={value}" for value in options if value not in _NOT_A_FINDING]
+    for name, options in MULTI_FEATURES.items():
+        features += [f"{name}={value}" for value in options]
+    features += FLAG_FEATURES
+    for name, thresholds in PCT_THRESHOLDS.items():
+        features.append(f"{name}:recorded")
+        features += [f"{name}>={t}" for t in thresholds]
+    return features
+
+
+# Every feature owns one bit. Values outside the option lists (e.g. from an
+# older catalogue) have no bit and do not count towards similarity.
+FEATURES = _all_features()
+FEATURE_INDEX = {feature: bit for bit, feature in enumerate(FEATURES)}
+assert len(FEATURE_INDEX) == len(FEATURES) <= FEATURE_BITS, "feature catalogue outgrew FEATURE_BITS"
+
+# Identifies the bit layout, so an index saved under another catalogue is rebuilt
+FEATURE_LAYOUT = hashlib.blake2b("\n".join(FEATURES).encode("utf-8"), digest_size=8).hexdigest()
+
+
+class SimilarityError(Exception):
+    pass
+
+
+def case_features(fields):
+    """The feature strings present in a case."""
+    features = []
+    for name in CATEGORICAL_FEATURES:
+        value = fields.get(name)
+        if value not in _NOT_A_FINDING:
+            features.append(f"{name}={value}")
+    for name in MULTI_FEATURES:
+        for value in fields.get(name) or ():
+            features.append(f"{name}={value}")
+    for name in FLAG_FEATURES:
+        if fields.get(name):
+            features.append(name)
+    for name, thresholds in PCT_THRESHOLDS.items():
+        value = fields.get(name)
+        if value is not None:
+            features.append(f"{name}:recorded")
+            features.extend(f"{name}>={t}" for t in thresholds if value >= t)
+    return features
+
+
+def feature_vector(fields):
+    vector = np.zeros(WORDS, dtype=np.uint64)
+    for feature in case_features(fields):
+        bit = FEATURE_INDEX.get(feature)
+        if bit is None:
+            continue
+        vector[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+    return vector
+
+
+if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+    _popcount = np.bitwise_count
+else:
+    _BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        return _BYTE_POPCOUNT[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def _popcount_columns(bits):
+    """Set bits per column of a (WORDS, n) word-major array."""
+    total = np.zeros(bits.shape[1], dtype=np.uint16)
+    for word in bits:
+        total += _popcount(word)
+    return total
+
+
+def _pack_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(blob, offsets):
+    raw = blob.tobytes()
+    return [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def diagnosis_line(fields, texts):
+    final = (texts or {}).get("final_diagnosis", "").strip()
+    return final.splitlines()[0] if final else (fields.get("primary_entity") or "")
+
+
+class SimilarityIndex:
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._bits = np.zeros((WORDS, capacity), dtype=np.uint64)  # word-major
+        self._popcount = np.zeros(capacity, dtype=np.uint16)
+        self._accessions = []
+        self._diagnoses = []
+        self._row_of = {}
+        self.watermark = 0.0
+
+    def __len__(self):
+        return len(self._accessions)
+
+    def add(self, accession, fields, diagnosis):
+        """Insert or replace (for an amended case) one archived case."""
+        vector = feature_vector(fields)
+        with self._lock:
+            row = self._row_of.get(accession)
+            if row is None:
+                row = len(self._accessions)
+                if row == self._bits.shape[1]:
+                    self._grow(2 * row)
+                self._row_of[accession] = row
+                self._accessions.append(accession)
+                self._diagnoses.append(diagnosis)
+            else:
+                self._diagnoses[row] = diagnosis
+            self._bits[:, row] = vector
+            self._popcount[row] = int(_popcount(vector).sum())
+
+    def _grow(self, capacity):
+        n = self._bits.shape[1]
+        bits = np.zeros((WORDS, capacity), dtype=np.uint64)
+        popcount = np.zeros(capacity, dtype=np.uint16)
+        bits[:, :n] = self._bits
+        popcount[:n] = self._popcount
+        self._bits, self._popcount = bits, popcount
+
+    def query(self, fields, k=10, exclude=None):
+        """[(accession, similarity, diagnosis), ...], most similar first."""
+        q = feature_vector(fields)
+        q_count = int(_popcount(q).sum())
+        with self._lock:
+            n = len(self._accessions)
+            if n == 0 or q_count == 0:
+                return []
+            inter = np.zeros(n, dtype=np.uint16)
+            scratch = np.empty(n, dtype=np.uint64)
+            for w in np.flatnonzero(q):
+                np.bitwise_and(self._bits[w, :n], q[w], out=scratch)
+                inter += _popcount(scratch)
+            union = self._popcount[:n] + np.uint16(q_count) - inter
+            sim = inter.astype(np.float32) / union.astype(np.float32)
+            if exclude is not None and exclude in self._row_of:
+                sim[self._row_of[exclude]] = -1.0
+            k = min(k, n)
+            top = np.argpartition(-sim, k - 1)[:k]
+            top = top[np.argsort(-sim[top], kind="stable")]
+            return [
+                (self._accessions[i], float(sim[i]), self._diagnoses[i])
+                for i in top if sim[i] > 0
+            ]
+
+    # ---------- Persistence ----------
+
+    def sync(self, archive):
+        """Add every case signed out or amended since the last sync. Returns the count."""
+        n = 0
+        for case, _, updated_at in archive.iter_updated(self.watermark):
+            self.add(case.accession, case.fields, diagnosis_line(case.fields, case.texts))
+            self.watermark = max(self.watermark, updated_at)
+            n += 1
+        return n
+
+    def save(self, path):
+        with self._lock:
+            n = len(self._accessions)
+            accessions, accession_offsets = _pack_strings(self._accessions)
+            diagnoses, diagnosis_offsets = _pack_strings(self._diagnoses)
+            tmp = path + ".tmp.npz"
+            np.savez(
+                tmp,
+                bits=self._bits[:, :n],
+                accessions=accessions,
+                accession_offsets=accession_offsets,
+                diagnoses=diagnoses,
+                diagnosis_offsets=diagnosis_offsets,
+                watermark=np.array(self.watermark),
+                feature_bits=np.array(FEATURE_BITS),
+                feature_layout=np.array(FEATURE_LAYOUT),
+            )
+            os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        if int(data["feature_bits"]) != FEATURE_BITS or (
+            "feature_layout" not in data.files or str(data["feature_layout"]) != FEATURE_LAYOUT
+        ):
+            raise SimilarityError(f"{path} was built with a different feature layout; rebuild it")
+        bits = data["bits"]
+        n = bits.shape[1]
+        index = cls(capacity=max(1024, 2 * n))
+        index._bits[:, :n] = bits
+        index._popcount[:n] = _popcount_columns(bits)
+        index._accessions = _unpack_strings(data["accessions"], data["accession_offsets"])
+        index._diagnoses = _unpack_strings(data["diagnoses"], data["diagnosis_offsets"])
+        index._row_of = {a: i for i, a in enumerate(index._accessions)}
+        index.watermark = float(data["watermark"])
+        return index
+
+
+def open_index(archive, path):
+    """
+    Load the saved index (if any), catch up with the archive and save it back.
+    An index saved under another feature layout is rebuilt from scratch.
+    """
+    index = None
+    if os.path.exists(path):
+        try:
+            index = SimilarityIndex.load(path)
+        except SimilarityError:
+            pass
+    if index is None:
+        index = SimilarityIndex()
+    if index.sync(archive):
+        index.save(path)
+    return index
+
+
+def main(argv=None):
+    from archive import CaseArchive
+
+    parser = argparse.ArgumentParser(description="Maintain the similar-case index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_sync = sub.add_parser("sync", help="add cases signed out or amended since the last sync")
+    p_sync.add_argument("archive")
+    p_sync.add_argument("index")
+    p_sync.add_argument("--rebuild", action="store_true", help="start from an empty index")
+    args = parser.parse_args(argv)
+
+    archive = CaseArchive(args.archive)
+    if args.rebuild and os.path.exists(args.index):
+        os.remove(args.index)
+    index = open_index(archive, args.index)
+    archive.close()
+    print(f"Index holds {len(index)} case(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
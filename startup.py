@@ -0,0 +1,84 @@
+"""
+Cold-start instrumentation and warm-up for the reporting app.
+
+lnreport.py times each session's first script run and passes it to
+`record_render()`. The first such run in a server process is the cold
+time-to-first-render tracked across releases (`python loadtest.py
+--cold-start`). `warm_up()` does the process-level work that the first render
+on a fresh worker would otherwise pay for; serve.py calls it before the
+server starts accepting sessions.
+"""
+
+import collections
+import inspect
+import logging
+import statistics
+import threading
+import time
+
+log = logging.getLogger("lnreport.startup")
+
+_lock = threading.Lock()
+_warm_up_ms = None
+_first_render_ms = None
+_session_first_render_ms = collections.deque(maxlen=1024)
+
+
+def warm_up():
+    """Import and build process-level resources ahead of the first session. Returns seconds taken."""
+    global _warm_up_ms
+    start = time.perf_counter()
+
+    # Streamlit imports these lazily on the first chart, which costs most of a
+    # second on a cold process.
+    import altair  # noqa: F401
+    import pandas  # noqa: F401
+
+    # App modules the script imports on first run, plus the ones it only
+    # imports on demand (similarity pulls in numpy).
+    import analytics  # noqa: F401
+    import archive  # noqa: F401
+    import audit  # noqa: F401
+    import lnreport_core  # noqa: F401
+    import similarity  # noqa: F401
+    import terminology
+
+    terminology.default_automaton()
+
+    # Streamlit walks the stack once per process, on the first element any
+    # session renders, to detect a REPL. The first walk resolves the source
+    # file of every loaded module (~100 ms); inspect caches that, so do it now.
+    inspect.stack()
+
+    elapsed = time.perf_counter() - start
+    with _lock:
+        _warm_up_ms = elapsed * 1000
+    log.info("warm-up took %.0f ms", elapsed * 1000)
+    return elapsed
+
+
+def record_render(elapsed, session_state):
+    """Record `elapsed` seconds as this session's first render, if it is one."""
+    if "_first_render_ms" in session_state:
+        return
+    ms = elapsed * 1000
+    session_state["_first_render_ms"] = ms
+    global _first_render_ms
+    with _lock:
+        cold = _first_render_ms is None
+        if cold:
+            _first_render_ms = ms
+        _session_first_render_ms.append(ms)
+    log.info("first render %.0f ms (%s)", ms, "first session in process" if cold else "process already warm")
+
+
+def metrics():
+    """Snapshot of the startup metrics for this process."""
+    with _lock:
+        sessions = sorted(_session_first_render_ms)
+        return {
+            "warm_up_ms": _warm_up_ms,
+            "first_render_ms": _first_render_ms,
+            "sessions": len(sessions),
+            "session_first_render_p50_ms": statistics.median(sessions) if sessions else None,
+        }
@@ -0,0 +1,367 @@
+"""
+Terminology tagging of free-text fields with an Aho-Corasick automaton.
+
+A dictionary of genes, variants / translocations, IHC markers, WHO5 entity
+names and their abbreviations is compiled once per process into a single
+automaton; tagging a text is then one linear pass regardless of how many
+terms the dictionary holds. Matching is case-insensitive, respects word
+boundaries, and keeps the leftmost-longest match, so "MYD88 L265P" is tagged
+as the variant rather than the gene alone.
+
+    python terminology.py tag "MYD88 L265P detected; t(14;18) by FISH"
+    python terminology.py tag-archive archive.db tags.jsonl --workers 8
+"""
+
+import argparse
+import collections
+import dataclasses
+import functools
+import html
+import json
+import re
+
+from lnreport_core import ALL_ENTITIES, default_recommendations, map_batches
+
+# Free-text inputs of a structured case that get tagged
+FREE_TEXT_FIELDS = ["clinical_hx", "molecular_findings", "fish_other", "recommendations", "comment"]
+
+GENE = "gene"
+VARIANT = "variant"
+MARKER = "marker"
+ENTITY = "entity"
+
+GENES = [
+    "ALK", "ATM", "B2M", "BCL2", "BCL6", "BRAF", "BTK", "CARD11", "CCND1", "CCND3", "CD28",
+    "CDKN2A", "CIITA", "CREBBP", "CXCR4", "DNMT3A", "DUSP22", "EZH2", "FOXO1", "FOXP1",
+    "GNA13", "ID3", "IDH2", "IGH", "IGK", "IGL", "IRF4", "JAK2", "KMT2D", "KRAS", "MAP2K1",
+    "MYC", "MYD88", "NOTCH1", "NOTCH2", "NRAS", "PAX5", "PLCG2", "RHOA", "SF3B1", "SOCS1",
+    "STAT3", "STAT5B", "TCF3", "TET2", "TNFAIP3", "TP53", "TP63", "TRB", "TRG", "XPO1",
+]
+
+# (term, code); several spellings can share one code
+VARIANTS = [
+    ("MYD88 L265P", "MYD88 p.L265P"),
+    ("BRAF V600E", "BRAF p.V600E"),
+    ("RHOA G17V", "RHOA p.G17V"),
+    ("IDH2 R172", "IDH2 p.R172"),
+    ("EZH2 Y641", "EZH2 p.Y641"),
+    ("EZH2 Y646", "EZH2 p.Y641"),
+    ("STAT3 Y640F", "STAT3 p.Y640F"),
+    ("NPM1::ALK", "NPM1::ALK"),
+    ("NPM1-ALK", "NPM1::ALK"),
+    ("t(14;18)", "t(14;18)(q32;q21) IGH::BCL2"),
+    ("IGH::BCL2", "t(14;18)(q32;q21) IGH::BCL2"),
+    ("t(11;14)", "t(11;14)(q13;q32) CCND1::IGH"),
+    ("CCND1::IGH", "t(11;14)(q13;q32) CCND1::IGH"),
+    ("t(8;14)", "t(8;14)(q24;q32) MYC::IGH"),
+    ("MYC::IGH", "t(8;14)(q24;q32) MYC::IGH"),
+    ("t(2;5)", "t(2;5)(p23;q35) NPM1::ALK"),
+    ("t(11;18)", "t(11;18)(q21;q21) BIRC3::MALT1"),
+    ("BIRC3::MALT1", "t(11;18)(q21;q21) BIRC3::MALT1"),
+    ("t(3;14)", "t(3;14)(q27;q32) BCL6::IGH"),
+    ("11q aberration", "11q-gain/loss"),
+    ("del(17p)", "del(17p) TP53"),
+    ("17p deletion", "del(17p) TP53"),
+    ("double hit", "MYC+BCL2 rearranged (double hit)"),
+    ("double-hit", "MYC+BCL2 rearranged (double hit)"),
+]
+
+MARKERS = [
+    "CD1a", "CD2", "CD3", "CD4", "CD5", "CD7", "CD8", "CD10", "CD15", "CD19", "CD20", "CD21",
+    "CD23", "CD25", "CD30", "CD35", "CD43", "CD45", "CD56", "CD57", "CD68", "CD79a", "CD103",
+    "CD123", "CD138", "CD163", "CD200", "Ki-67", "Ki67", "MIB-1", "PD-1", "PD1", "PD-L1", "ICOS",
+    "CXCL13", "MUM1", "EBER", "LMP1", "Cyclin D1", "SOX11", "LEF1", "TdT", "BOB1", "OCT2",
+    "LMO2", "kappa", "lambda", "TCR gamma", "TCR beta", "TIA-1", "granzyme B", "perforin",
+    "Langerin", "S100", "CD207", "Fascin", "EMA",
+]
+
+# Spellings that should resolve to one canonical marker code
+MARKER_ALIASES = {"Ki67": "Ki-67", "MIB-1": "Ki-67", "PD1": "PD-1", "CD207": "Langerin"}
+
+_ABBREVIATION_RE = re.compile(r"\(([^()]+)\)")
+
+# Parentheticals in entity names that are qualifiers rather than abbreviations
+_NOT_ABBREVIATIONS = {"WHO5"}
+
+# Family name -> abbreviations that name the family rather than one subtype.
+# These (and any abbreviation or short name shared by several entities) get a
+# family-level code instead of pointing at an arbitrary member.
+ENTITY_FAMILIES = {
+    "Diffuse large B-cell lymphoma": ["DLBCL"],
+    "High-grade B-cell lymphoma": ["HGBL"],
+    "Follicular lymphoma": ["FL"],
+    "Mantle cell lymphoma": ["MCL"],
+    "Marginal zone lymphoma": ["MZL"],
+    "Nodal T-follicular helper cell lymphoma": ["nTFHL"],
+    "Peripheral T-cell lymphoma": ["PTCL"],
+    "Anaplastic large cell lymphoma": ["ALCL"],
+    "Classical Hodgkin lymphoma": ["cHL"],
+    "Lymphomatoid papulosis": ["LyP"],
+    "Castleman disease": [],
+}
+
+# Synonyms for exactly one entity
+ENTITY_SYNONYMS = [
+    ("AITL", "Nodal T-follicular helper cell lymphoma, angioimmunoblastic type (nTFHL-AI)"),
+    ("PTCL, NOS", "Peripheral T-cell lymphoma, NOS"),
+    ("ALK-positive ALCL", "Anaplastic large cell lymphoma (ALCL), ALK-positive"),
+    ("ALK-negative ALCL", "Anaplastic large cell lymphoma (ALCL), ALK-negative"),
+    ("PMBL", "Primary mediastinal (thymic) large B-cell lymphoma"),
+    ("LPL", "Lymphoplasmacytic lymphoma / Waldenström macroglobulinemia"),
+    ("LCH", "Langerhans cell histiocytosis"),
+]
+
+
+def _squash(text):
+    return re.sub(r"\s+", " ", text).replace(" ,", ",").strip().rstrip(",")
+
+
+def _entity_terms():
+    """(term, code) for entity names, their short forms and abbreviations.
+
+    "Lymphomatoid papulosis (LyP), type C" yields the full name, "Lymphomatoid
+    papulosis, type C", "LyP, type C" and "LyP type C" for the entity; the bare
+    "LyP" is shared by five entities and so names the family.
+    """
+    candidates = collections.defaultdict(set)  # folded term -> {entity}
+    spelling = {}
+    for entity in dict.fromkeys(ALL_ENTITIES):
+        forms = [entity, _squash(_ABBREVIATION_RE.sub("", entity))]
+        for match in _ABBREVIATION_RE.finditer(entity):
+            abbreviation = match.group(1)
+            if abbreviation in _NOT_ABBREVIATIONS or len(abbreviation) > 20:
+                continue
+            if not any(c.isupper() for c in abbreviation):
+                continue
+            forms.append(abbreviation)
+            if "," in abbreviation:
+                forms.append(abbreviation.split(",")[0])
+            rest = _squash(_ABBREVIATION_RE.sub("", entity[match.end():]))
+            if rest.startswith(", "):
+                forms += [abbreviation + rest, f"{abbreviation} {rest[2:]}"]
+        for form in forms:
+            candidates[_fold(form)].add(entity)
+            spelling.setdefault(_fold(form), form)
+    for term, entity in ENTITY_SYNONYMS:
+        candidates[_fold(term)].add(entity)
+        spelling.setdefault(_fold(term), term)
+
+    family_terms = {}
+    for family, abbreviations in ENTITY_FAMILIES.items():
+        for term in [family, *abbreviations]:
+            family_terms[_fold(term)] = (term, f"entity-family:{family}")
+
+    terms = []
+    for folded, entities in candidates.items():
+        if folded in family_terms:
+            continue
+        if len(entities) == 1:
+            terms.append((spelling[folded], f"entity:{next(iter(entities))}"))
+        # Shared by several entities and not a known family: ambiguous, skip
+    return terms + list(family_terms.values())
+
+
+def default_terms():
+    """[(term, code, category), ...] for the built-in dictionary."""
+    terms = [(g, f"gene:{g}", GENE) for g in GENES]
+    terms += [(t, f"variant:{c}", VARIANT) for t, c in VARIANTS]
+    terms += [(m, f"marker:{MARKER_ALIASES.get(m, m)}", MARKER) for m in MARKERS]
+    terms += [(t, c, ENTITY) for t, c in _entity_terms()]
+    return terms
+
+
+# =========================================
+# Automaton
+# =========================================
+
+@dataclasses.dataclass(frozen=True)
+class Mention:
+    start: int
+    end: int
+    text: str
+    code: str
+    category: str
+
+
+def _fold(text):
+    """Lowercase without changing string length, so match offsets map back."""
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+class TermAutomaton:
+    def __init__(self, terms):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # node -> [(term length, code, category)]
+        for term, code, category in terms:
+            self._add(_fold(term), code, category)
+        self._build_failure_links()
+
+    def _add(self, term, code, category):
+        node = 0
+        for ch in term:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        if not any(c == code for _, c, _ in self._out[node]):
+            self._out[node].append((len(term), code, category))
+
+    def _build_failure_links(self):
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(ch, 0) if node else 0
+                # Outputs reachable through the failure link are matches here too
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def _raw_matches(self, folded):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(folded):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, code, category in out[node]:
+                yield i + 1 - length, i + 1, code, category
+
+    def tag(self, text):
+        """Non-overlapping, word-bounded, leftmost-longest mentions in `text`."""
+        if not text:
+            return []
+        folded = _fold(text)
+        n = len(folded)
+        candidates = [
+            (start, end, code, category)
+            for start, end, code, category in self._raw_matches(folded)
+            if (start == 0 or not folded[start - 1].isalnum()) and (end == n or not folded[end].isalnum())
+        ]
+        candidates.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        mentions = []
+        last_end = 0
+        for start, end, code, category in candidates:
+            if start >= last_end:
+                mentions.append(Mention(start, end, text[start:end], code, category))
+                last_end = end
+        return mentions
+
+
+@functools.lru_cache(maxsize=1)
+def default_automaton():
+    """Compiled once per process."""
+    return TermAutomaton(default_terms())
+
+
+def tag(text):
+    return default_automaton().tag(text)
+
+
+def codes(mentions):
+    """Unique codes in first-mention order."""
+    return list(dict.fromkeys(m.code for m in mentions))
+
+
+def tag_case(fields):
+    """{free-text field: [codes]} for the non-empty free-text fields of a case."""
+    automaton = default_automaton()
+    out = {}
+    for field in FREE_TEXT_FIELDS:
+        found = codes(automaton.tag(fields.get(field) or ""))
+        if found:
+            out[field] = found
+    return out
+
+
+def highlight_html(text, mentions):
+    """Escaped HTML of `text` with each mention wrapped in <mark title=code>."""
+    parts = []
+    pos = 0
+    for m in mentions:
+        parts.append(html.escape(text[pos:m.start]))
+        parts.append(
+            f'<mark class="term-{m.category}" title="{html.escape(m.code)}">{html.escape(m.text)}</mark>'
+        )
+        pos = m.end
+    parts.append(html.escape(text[pos:]))
+    return "".join(parts).replace("\n", "<br>")
+
+
+# =========================================
+# Batch tagging of the archive
+# =========================================
+
+def _tag_batch(batch):
+    return [(accession, tag_case(fields)) for accession, fields in batch]
+
+
+def tag_archive(archive, out_path, workers=None, batch_size=500):
+    """Write one JSON line per archived case: {"accession": ..., "tags": {...}}."""
+    import os
+
+    workers = workers or os.cpu_count() or 1
+
+    def batches():
+        batch = []
+        for case in archive.iter_latest():
+            fields = {f: case.fields.get(f) for f in FREE_TEXT_FIELDS}
+            if fields["recommendations"] is None:  # the default was rendered, as at sign-out
+                fields["recommendations"] = default_recommendations(case.fields.get("primary_entity"))
+            batch.append((case.accession, fields))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    n = 0
+    with open(out_path, "w") as f:
+        for results in map_batches(_tag_batch, batches(), workers):
+            n += _write_tags(f, results)
+    return n
+
+
+def _write_tags(f, results):
+    for accession, tags in results:
+        f.write(json.dumps({"accession": accession, "tags": tags}, ensure_ascii=False) + "\n")
+    return len(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Terminology tagging of free-text report fields")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_tag = sub.add_parser("tag", help="tag a piece of text")
+    p_tag.add_argument("text")
+    p_archive = sub.add_parser("tag-archive", help="tag the free text of every archived case")
+    p_archive.add_argument("archive")
+    p_archive.add_argument("out")
+    p_archive.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "tag":
+        for m in tag(args.text):
+            print(f"{m.start:>5}-{m.end:<5} {m.category:<8} {m.text!r} -> {m.code}")
+        return 0
+
+    from archive import CaseArchive
+
+    archive = CaseArchive(args.archive)
+    n = tag_archive(archive, args.out, args.workers)
+    archive.close()
+    print(f"Tagged {n} case(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from analytics import NO_ENTITY, load_aggregates, rebuild_aggregates, totals
+from archive import ADDENDUM, AMENDMENT, CaseArchive
+
+ENTITIES = [
+    "",
+    "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)",
+    "High-grade B-cell lymphoma (HGBL) with MYC and BCL2 and/or BCL6 rearrangements",
+    "Nodal T-follicular helper cell lymphoma, angioimmunoblastic type (nTFHL-AI)",
+    "Follicular lymphoma, classic (WHO5)",
+    "Reactive follicular hyperplasia",
+]
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = CaseArchive(str(tmp_path / "archive.db"))
+    yield archive
+    archive.close()
+
+
+def _fields(rng):
+    return {
+        "primary_entity": rng.choice(ENTITIES),
+        "procedure_type": rng.choice(["Needle core biopsy", "Excisional biopsy"]),
+        "core_length": rng.choice([None, 0.3, 1.2]),
+        "cd10": rng.random() < 0.5,
+        "bcl6": rng.random() < 0.5,
+        "mum1": rng.random() < 0.5,
+        "myc_pct": rng.choice([None, 20, 60]),
+        "bcl2_pct": rng.choice([None, 30, 80]),
+        "tfh_pd1": rng.random() < 0.5,
+        "tfh_icos": rng.random() < 0.5,
+        "qualifier": rng.choice(["Definitive", "Favour"]),
+    }
+
+
+def test_incremental_aggregates_match_a_rebuild(archive):
+    rng = random.Random(7)
+    for i in range(40):
+        archive.save_version(f"S{i}", _fields(rng), {"final_diagnosis": str(i)})
+    # Amend a third of the cases, some of them twice, changing entity and markers
+    for i in range(0, 40, 3):
+        for n in range(1 + i % 2):
+            archive.save_version(
+                f"S{i}", _fields(rng), {"final_diagnosis": f"{i} amended {n}"},
+                kind=AMENDMENT if n == 0 else ADDENDUM, reason="revised",
+            )
+    incremental = archive.load_aggregates()
+
+    assert rebuild_aggregates(archive) == 40
+    rebuilt = archive.load_aggregates()
+    assert {m: {k: dict(v) for k, v in keys.items()} for m, keys in incremental.items()} == \
+        {m: {k: dict(v) for k, v in keys.items()} for m, keys in rebuilt.items()}
+    assert totals(rebuilt, "cases") == {"total": 40}
+
+
+def test_amendment_moves_the_case_between_entities(archive):
+    dlbcl = ENTITIES[1]
+    archive.save_version("S1", {"primary_entity": dlbcl}, {"final_diagnosis": "a"})
+    assert totals(archive.load_aggregates(), "lbcl") == {"total": 1}
+    archive.save_version("S1", {"primary_entity": ""}, {"final_diagnosis": "b"}, kind=AMENDMENT, reason="r")
+    aggregates = archive.load_aggregates()
+    assert totals(aggregates, "entity") == {NO_ENTITY: 1}
+    assert totals(aggregates, "lbcl") == {}
+    assert totals(aggregates, "cases") == {"total": 1}
+    with archive.transaction() as conn:
+        assert load_aggregates(conn) == aggregates
@@ -0,0 +1,106 @@
+import pytest
+
+from archive import (
+    ADDENDUM,
+    SNAPSHOT_EVERY,
+    ArchiveError,
+    CaseArchive,
+    apply_fields_delta,
+    apply_text_delta,
+    changes_since_previous,
+    fields_delta,
+    text_delta,
+)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = CaseArchive(str(tmp_path / "archive.db"))
+    yield archive
+    archive.close()
+
+
+@pytest.mark.parametrize("old, new", [
+    ("", ""),
+    ("", "Diffuse large B-cell lymphoma."),
+    ("Diffuse large B-cell lymphoma.", ""),
+    ("Follicular lymphoma, grade 1-2.", "Follicular lymphoma, classic.\nSee comment."),
+    ("a  b\tc\n\nd", "a b  c\nd "),
+    ("CD20+ CD10+ BCL6+", "CD20+ BCL6+ MUM1+ CD10-"),
+])
+def test_text_delta_round_trips(old, new):
+    assert apply_text_delta(old, text_delta(old, new)) == new
+
+
+def test_fields_delta_round_trips_set_and_unset():
+    old = {"primary_entity": "Burkitt lymphoma", "cd10": True, "comment": "x"}
+    new = {"primary_entity": "Burkitt lymphoma", "cd10": False, "myc_pct": 80}
+    delta = fields_delta(old, new)
+    assert delta == {"set": {"cd10": False, "myc_pct": 80}, "unset": ["comment"]}
+    assert apply_fields_delta(old, delta) == new
+
+
+def _case(i):
+    fields = {"primary_entity": "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)", "ki67_pct": i}
+    if i % 3 == 1:
+        fields["comment"] = f"comment {i}"  # present in some versions only, so deltas unset it
+    texts = {"final_diagnosis": f"Diffuse large B-cell lymphoma, version {i}.\nKi-67 {i}%."}
+    if i % 4 == 0:
+        texts["addendum"] = f"Addendum {i}"
+    return fields, texts
+
+
+def test_every_version_replays_across_snapshot_boundaries(archive):
+    n = 2 * SNAPSHOT_EVERY + 3
+    for i in range(1, n + 1):
+        fields, texts = _case(i)
+        assert archive.save_version("S26-1", fields, texts, kind=None if i == 1 else ADDENDUM, reason=f"r{i}") == i
+    for i in range(1, n + 1):
+        fields, texts = _case(i)
+        version = archive.get_version("S26-1", i)
+        assert (version.fields, version.texts) == (fields, texts)
+    assert archive.get_version("S26-1").version == n
+
+
+def test_snapshots_are_stored_every_snapshot_every_versions(archive):
+    for i in range(1, SNAPSHOT_EVERY + 3):
+        archive.save_version("S26-1", *_case(i), kind=None if i == 1 else ADDENDUM, reason="r")
+    snapshots = [v for v, s in archive._conn.execute(
+        "SELECT version, snapshot FROM versions WHERE accession = 'S26-1' ORDER BY version"
+    ) if s]
+    assert snapshots == [1, SNAPSHOT_EVERY + 1]
+
+
+def test_unchanged_version_is_rejected(archive):
+    archive.save_version("S26-1", *_case(1))
+    with pytest.raises(ArchiveError):
+        archive.save_version("S26-1", *_case(1), kind=ADDENDUM, reason="again")
+
+
+def test_amendment_requires_a_reason(archive):
+    archive.save_version("S26-1", *_case(1))
+    with pytest.raises(ArchiveError):
+        archive.save_version("S26-1", *_case(2), kind=ADDENDUM, reason=" ")
+
+
+def test_changes_since_previous(archive):
+    archive.save_version("S26-1", {"primary_entity": "Burkitt lymphoma", "comment": "x"}, {"final_diagnosis": "A."})
+    archive.save_version(
+        "S26-1", {"primary_entity": "Burkitt lymphoma", "cd10": True}, {"final_diagnosis": "A. B."},
+        kind=ADDENDUM, reason="IHC",
+    )
+    field_changes, text_diffs = changes_since_previous(archive, "S26-1", 2)
+    assert field_changes == [("cd10", None, True), ("comment", "x", None)]
+    assert "+B." in text_diffs["final_diagnosis"]
+
+
+def test_changes_since_previous_skips_derived_keys(archive):
+    archive.save_version("S26-1", {"primary_entity": "Burkitt lymphoma", "terminology": {}}, {"final_diagnosis": "A."})
+    archive.save_version(
+        "S26-1",
+        {"primary_entity": "Burkitt lymphoma", "comment": "MYC", "terminology": {"comment": ["gene:MYC"]}},
+        {"final_diagnosis": "A."},
+        kind=ADDENDUM, reason="comment",
+    )
+    field_changes, _ = changes_since_previous(archive, "S26-1", 2)
+    assert field_changes == [("comment", None, "MYC")]
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+from audit import AuditError, AuditLog, verify_chain
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "audit.db")
+
+
+def _log(path, **kwargs):
+    # A long flush interval keeps the background flusher out of the way
+    return AuditLog(path, flush_interval=60, **kwargs)
+
+
+def _records(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT seq, event, accession FROM audit ORDER BY seq").fetchall()
+    finally:
+        conn.close()
+
+
+def test_chain_verifies_and_continues_across_instances(path):
+    first = _log(path)
+    for i in range(3):
+        first.record("generate_final_diagnosis", "u", f"S{i}", "s", text=f"t{i}")
+    first.close()
+    second = _log(path)
+    second.record("sign_out", "u", "S0", "s", version=1)
+    second.close()
+    assert verify_chain(path) == (True, None)
+    assert [r[0] for r in _records(path)] == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("tamper, broken_at", [
+    ("UPDATE audit SET payload = '{\"text\": \"edited\"}' WHERE seq = 2", 2),
+    ("DELETE FROM audit WHERE seq = 2", 3),
+    ("UPDATE audit SET ts = ts + 1 WHERE seq = 3", 3),
+])
+def test_tampering_is_detected(path, tamper, broken_at):
+    log = _log(path)
+    for i in range(4):
+        log.record("generate_microscopic", "u", "S1", "s", text=str(i))
+    log.close()
+    conn = sqlite3.connect(path)
+    conn.execute(tamper)
+    conn.commit()
+    conn.close()
+    assert verify_chain(path) == (False, broken_at)
+
+
+def test_records_survive_a_locked_store(path):
+    log = _log(path)
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    log.record("generate_microscopic", "u", "S1", "s", text="a")
+    log._conn.execute("PRAGMA busy_timeout = 0")
+    with pytest.raises(sqlite3.OperationalError):
+        log.flush()
+    blocker.execute("ROLLBACK")
+    blocker.close()
+    log.record("generate_microscopic", "u", "S2", "s", text="b")
+    log.close()
+    assert [r[2] for r in _records(path)] == ["S1", "S2"]
+    assert verify_chain(path) == (True, None)
+
+
+def test_full_buffer_refuses_records(path):
+    log = _log(path, capacity=4, max_buffered=6, batch_size=100)
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    log._conn.execute("PRAGMA busy_timeout = 0")
+    for i in range(6):
+        log.record("e", "u", "S1", "s", i=i)
+    with pytest.raises(AuditError):
+        log.record("e", "u", "S1", "s", i=6)
+    blocker.execute("ROLLBACK")
+    blocker.close()
+    log.flush()
+    log.check()
+    log.close()
+    assert len(_records(path)) == 6
+    assert verify_chain(path) == (True, None)
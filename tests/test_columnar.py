@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from columnar import ColumnarError, ColumnarStore, append_cases
+from lnreport_core import CASE_DEFAULTS
+
+
+def _fields(entity, ki67):
+    return CASE_DEFAULTS | {"diag_family": "Mature B-cell neoplasms", "primary_entity": entity,
+                            "ki67_pct": ki67}
+
+
+def _live_accessions(store):
+    return sorted(a for seg in store.segments for a, live in zip(seg.accessions(), seg.live()) if live)
+
+
+def test_long_and_non_ascii_accessions_ingest(tmp_path):
+    path = str(tmp_path / "cases.col")
+    long = "S26-" + "0" * 200
+    append_cases(path, [(long, _fields("Burkitt lymphoma", 95), 0.0),
+                        ("S26-ÄÖ-1", _fields("Burkitt lymphoma", 90), 0.0)], watermark=1.0)
+    append_cases(path, [(long, _fields("Burkitt lymphoma", 99), 0.0),
+                        ("S26-2", _fields("Burkitt lymphoma", 80), 0.0)], watermark=2.0)
+
+    store = ColumnarStore(path)
+    assert _live_accessions(store) == sorted([long, "S26-ÄÖ-1", "S26-2"])
+    assert store.meta["watermark"] == 2.0
+    assert store.distribution("ki67_pct", by="primary_entity")["Burkitt lymphoma"]["n"] == 3
+
+
+def test_accessions_sharing_a_prefix_do_not_supersede_each_other(tmp_path):
+    path = str(tmp_path / "cases.col")
+    prefix = "S26-" + "1" * 60
+    append_cases(path, [(prefix + "A", _fields("Burkitt lymphoma", 90), 0.0)])
+    append_cases(path, [(prefix + "B", _fields("Burkitt lymphoma", 90), 0.0)])
+    assert len(ColumnarStore(path)) == 2
+
+
+def test_append_refuses_an_old_format_store(tmp_path):
+    path = str(tmp_path / "cases.col")
+    append_cases(path, [("S26-1", _fields("Burkitt lymphoma", 90), 0.0)])
+    meta_path = os.path.join(path, "meta.json")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta["format"] = 1
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    with pytest.raises(ColumnarError, match="rebuild"):
+        append_cases(path, [("S26-2", _fields("Burkitt lymphoma", 90), 0.0)])
+
+
+def test_retirements_only_take_effect_when_meta_is_replaced(tmp_path, monkeypatch):
+    import columnar
+
+    path = str(tmp_path / "cases.col")
+    append_cases(path, [("S26-1", _fields("Burkitt lymphoma", 90), 0.0),
+                        ("S26-2", _fields("Burkitt lymphoma", 80), 0.0)], watermark=1.0)
+    before = ColumnarStore(path)
+
+    def crash(path, meta):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(columnar, "_save_meta", crash)
+    with pytest.raises(OSError):
+        append_cases(path, [("S26-1", _fields("Burkitt lymphoma", 99), 0.0)], watermark=2.0)
+    monkeypatch.undo()
+
+    after_crash = ColumnarStore(path)
+    assert _live_accessions(after_crash) == ["S26-1", "S26-2"]
+    assert after_crash.meta["watermark"] == 1.0
+
+    # The retried ingest applies the retirement; an already open store keeps its view
+    append_cases(path, [("S26-1", _fields("Burkitt lymphoma", 99), 0.0)], watermark=2.0)
+    assert _live_accessions(before) == ["S26-1", "S26-2"]
+    store = ColumnarStore(path)
+    assert len(store) == 2
+    assert store.distribution("ki67_pct", by="primary_entity")["Burkitt lymphoma"]["p90"] == 99
+
+    # Only the current and the previous generation of live bits are kept
+    append_cases(path, [("S26-2", _fields("Burkitt lymphoma", 85), 0.0)], watermark=3.0)
+    live_files = sorted(e for e in os.listdir(os.path.join(path, "seg-000001")) if e.startswith("live"))
+    assert live_files == ["live-seg-000002.npy", "live-seg-000003.npy"]
+    assert len(ColumnarStore(path)) == 2
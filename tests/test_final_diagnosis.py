@@ -0,0 +1,84 @@
+import pytest
+
+from lnreport_core import generated_output, has_lbcl_addons, normalize_case, render_case
+
+DLBCL = "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)"
+HGBL_DH = "High-grade B-cell lymphoma (HGBL) with MYC and BCL2 and/or BCL6 rearrangements"
+HGBL_11Q = "High-grade B-cell lymphoma with 11q aberration"
+LBCL_RECS = (
+    "Recommendations: Clinical staging, bone marrow evaluation as indicated, and multidisciplinary "
+    "discussion (lymphoma tumor board) are recommended."
+)
+
+
+def final_diagnosis(**case):
+    return render_case(normalize_case(case))["final_diagnosis"]
+
+
+@pytest.mark.parametrize("entity", [
+    DLBCL,
+    "Diffuse large B-cell lymphoma, EBV-positive",
+    "Primary mediastinal (thymic) large B-cell lymphoma",
+    "Primary cutaneous diffuse large B-cell lymphoma, leg type (PCDLBCL-LT)",
+    "Follicular large B-cell lymphoma",
+    HGBL_DH,
+    HGBL_11Q,
+])
+def test_lbcl_and_hgbl_get_addons(entity):
+    assert has_lbcl_addons(entity)
+
+
+@pytest.mark.parametrize("entity", [
+    "",
+    "Follicular lymphoma, classic (WHO5)",
+    "Burkitt lymphoma",
+    "Mantle cell lymphoma, blastoid / pleomorphic",
+    "Anaplastic large cell lymphoma (ALCL), ALK-positive",
+])
+def test_other_entities_do_not(entity):
+    assert not has_lbcl_addons(entity)
+
+
+def test_dlbcl_final_diagnosis():
+    assert final_diagnosis(
+        primary_entity=DLBCL, site_text="left axillary", cd10=True,
+        myc_pct=50, bcl2_pct=70, fish_myc=True,
+    ) == "\n".join([
+        f"{DLBCL}, left axillary.",
+        "Cell-of-origin (Hans algorithm): Germinal center B-cell (GCB) type.",
+        "Meets immunohistochemical criteria for MYC/BCL2 double-expressor status.",
+        "Rearrangements detected involving MYC.",
+        LBCL_RECS,
+    ])
+
+
+def test_double_expressor_line_omitted_when_not_assessable():
+    dx = final_diagnosis(primary_entity=DLBCL, cd10=True, myc_pct=50)
+    assert "Not assessable" not in dx
+    assert "double-expressor" not in dx
+
+
+def test_lbcl_amended_to_hgbl_keeps_fish_result():
+    # The amendment scenario: FISH shows MYC and BCL2 rearrangements and the
+    # entity is revised from DLBCL to HGBL; the FISH result must stay.
+    dx = final_diagnosis(primary_entity=HGBL_DH, fish_myc=True, fish_bcl2=True, cd10=True)
+    assert "Rearrangements detected involving MYC, BCL2." in dx.splitlines()
+    assert dx.splitlines()[-1] == LBCL_RECS
+
+
+def test_hgbl_11q_final_diagnosis_reports_11q():
+    dx = final_diagnosis(primary_entity=HGBL_11Q, fish_11q=True)
+    assert any(line.startswith("11q aberration present") for line in dx.splitlines())
+
+
+def test_non_lbcl_final_diagnosis_has_no_addons():
+    dx = final_diagnosis(
+        primary_entity="Follicular lymphoma, classic (WHO5)", cd10=True,
+        myc_pct=50, bcl2_pct=70, fish_bcl2=True,
+    )
+    assert dx == "Follicular lymphoma, classic (WHO5)."
+
+
+def test_generated_output_keeps_classifications_only_for_lbcl():
+    assert {"coo", "double_expressor"} <= set(generated_output({"primary_entity": HGBL_DH}))
+    assert "coo" not in generated_output({"primary_entity": "Burkitt lymphoma"})
@@ -0,0 +1,41 @@
+import math
+
+import pytest
+
+from lnreport_core import CASE_DEFAULTS, CaseError, normalize_case
+
+
+def test_null_falls_back_to_the_default():
+    case = normalize_case({"specimen_class": "Skin", "procedure_type": None, "cd10": None, "pattern": None})
+    assert case["procedure_type"] == CASE_DEFAULTS["procedure_type"]
+    assert case["cd10"] is False
+    assert case["pattern"] == []
+
+
+def test_null_keeps_unset_fields_unset():
+    case = normalize_case({"myc_pct": None, "integrity": None, "recommendations": None})
+    assert case["myc_pct"] is None and case["integrity"] is None and case["recommendations"] is None
+
+
+@pytest.mark.parametrize("case", [
+    {"specimen_class": "Bone"},
+    {"procedure_type": "Autopsy"},
+    {"qualifier": "Maybe"},
+    {"diag_family": "Leukemia"},
+    {"primary_entity": "Lymphoma"},
+    {"pattern": ["Nodular", "Starry"]},
+    {"diag_family": "Hodgkin lymphoma", "primary_entity": "Burkitt lymphoma"},
+])
+def test_values_outside_the_option_lists_are_rejected(case):
+    with pytest.raises(CaseError):
+        normalize_case(case)
+
+
+def test_skin_specimens_may_have_no_nodal_architecture():
+    assert normalize_case({"specimen_class": "Skin", "nodal_arch": "Not applicable"})["nodal_arch"] == "Not applicable"
+
+
+@pytest.mark.parametrize("value", [math.nan, math.inf, -0.1, True, "1"])
+def test_core_length_must_be_a_finite_non_negative_number(value):
+    with pytest.raises(CaseError):
+        normalize_case({"core_length": value})
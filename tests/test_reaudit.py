@@ -0,0 +1,54 @@
+import pytest
+
+from archive import CaseArchive
+from lnreport_core import CASE_DEFAULTS, generated_record
+from reaudit import reaudit, select_candidates
+
+DLBCL = "Diffuse large B-cell lymphoma, NOS (DLBCL, NOS)"
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = CaseArchive(str(tmp_path / "archive.db"))
+    yield archive
+    archive.close()
+
+
+def _sign_out(archive, accession, entity, generated=True):
+    fields = CASE_DEFAULTS | {"diag_family": "Mature B-cell neoplasm", "primary_entity": entity,
+                              "recommendations": "Staging."}
+    archive.save_version(accession, fields, {"final_diagnosis": entity},
+                         generated=generated_record(fields) if generated else None)
+
+
+def test_current_cases_are_not_candidates(archive):
+    _sign_out(archive, "S26-1", DLBCL)
+    assert select_candidates(archive) == ([], 1, 0, {})
+
+
+def test_cases_signed_out_before_a_rule_existed_are_judged_on_their_fields(archive):
+    _sign_out(archive, "S26-1", DLBCL)
+    _sign_out(archive, "S26-2", "Burkitt lymphoma")
+    _sign_out(archive, "S26-3", DLBCL, generated=False)
+    # As if double_expressor had been added to the rule set after these sign-outs
+    archive._conn.execute("DELETE FROM rule_inputs WHERE rule = 'double_expressor'")
+
+    candidates, scanned, unversioned, unrecorded = select_candidates(archive)
+    assert candidates == [("S26-1", 1, ["double_expressor"])]
+    assert (scanned, unversioned) == (3, 1)
+    assert unrecorded == {"double_expressor": 2}
+
+
+def test_forced_rule_selects_cases_it_applies_to(archive):
+    _sign_out(archive, "S26-1", DLBCL)
+    _sign_out(archive, "S26-2", "Burkitt lymphoma")
+    candidates, _, _, _ = select_candidates(archive, forced=["hans"])
+    assert candidates == [("S26-1", 1, ["hans"])]
+
+
+def test_reaudit_reports_unchanged_output_as_no_difference(archive):
+    _sign_out(archive, "S26-1", DLBCL)
+    _sign_out(archive, "S26-2", DLBCL)
+    report = reaudit(archive, forced=["hans"], workers=1, batch_size=1)
+    assert report["reevaluated"] == 2
+    assert report["differences"] == []
@@ -0,0 +1,22 @@
+import json
+
+from archive import CaseArchive
+from lnreport_core import CASE_DEFAULTS
+from terminology import tag_archive
+
+ALCL = "Anaplastic large cell lymphoma (ALCL), ALK-positive"
+
+
+def test_tag_archive_tags_default_recommendations(tmp_path):
+    archive = CaseArchive(str(tmp_path / "archive.db"))
+    fields = CASE_DEFAULTS | {"diag_family": "Mature T / NK-cell neoplasm", "primary_entity": ALCL}
+    archive.save_version("S26-1", fields, {"final_diagnosis": "ALCL."})
+    archive.save_version("S26-2", fields | {"recommendations": "TP53 sequencing is recommended."},
+                         {"final_diagnosis": "ALCL."})
+
+    out = tmp_path / "tags.jsonl"
+    assert tag_archive(archive, str(out), workers=1) == 2
+    archive.close()
+    tags = {r["accession"]: r["tags"] for r in map(json.loads, out.read_text().splitlines())}
+    assert tags["S26-1"]["recommendations"] == ["entity-family:Anaplastic large cell lymphoma"]
+    assert tags["S26-2"]["recommendations"] == ["gene:TP53"]